@@ -0,0 +1,86 @@
+import argparse
+import csv
+import time
+
+import torch
+
+from plantseg.predictions.functional.affinities import embeddings_to_affinities
+from plantseg.training.embeddings import embeddings_to_affinities as padded_embeddings_to_affinities
+
+OFFSETS = {2: [[-1, 0], [0, -1]], 3: [[-1, 0, 0], [0, -1, 0], [0, 0, -1]]}
+
+
+def write_csv(output_path, results):
+    print(f'Saving results to {output_path}...')
+    with open(output_path, "w") as output_file:
+        dict_writer = csv.DictWriter(output_file, results[0].keys())
+        dict_writer.writeheader()
+        dict_writer.writerows(results)
+
+
+IMPLEMENTATIONS = {'padded': padded_embeddings_to_affinities, 'fused': embeddings_to_affinities}
+
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def benchmark(shape, device, repeats=5, delta=0.5):
+    """Time and peak memory (CUDA only) of the padded and fused conversions of a random (B, C, ...) embedding."""
+    device = torch.device(device)
+    embeddings = torch.randn(shape, device=device)
+    offsets = OFFSETS[len(shape) - 2]
+    results, reference = [], None
+    for name, implementation in IMPLEMENTATIONS.items():
+        with torch.no_grad():
+            # a first run warms up the allocator
+            affs = implementation(embeddings, offsets, delta)
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+            baseline = torch.cuda.memory_allocated(device) if device.type == 'cuda' else 0
+            _synchronize(device)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                affs = implementation(embeddings, offsets, delta)
+            _synchronize(device)
+            elapsed = (time.perf_counter() - start) / repeats
+
+        peak_memory = torch.cuda.max_memory_allocated(device) - baseline if device.type == 'cuda' else None
+        if reference is None:
+            reference = affs
+        results.append(
+            {
+                'implementation': name,
+                'shape': 'x'.join(map(str, shape)),
+                'seconds': elapsed,
+                'peak_memory_mb': None if peak_memory is None else peak_memory / 2**20,
+                'max_abs_error': float((affs - reference).abs().max()),
+            }
+        )
+    return results
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Embeddings to Affinities Benchmark Script')
+    parser.add_argument(
+        '--shape', type=int, nargs='+', default=[4, 16, 32, 128, 128], help='(B, C, [Z,] Y, X) embeddings shape'
+    )
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeats', type=int, default=5, help='number of timed runs')
+    parser.add_argument('--out-file', type=str, help='path of an optional CSV file with the results')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse()
+    results = benchmark(tuple(args.shape), args.device, args.repeats)
+
+    for result in results:
+        peak_memory = 'n/a' if result['peak_memory_mb'] is None else f"{result['peak_memory_mb']:.1f} MB"
+        print(
+            f"{result['implementation']:>7}: {result['seconds'] * 1000:.1f} ms, peak memory {peak_memory}, "
+            f"max error {result['max_abs_error']:.3g}"
+        )
+    if args.out_file is not None:
+        write_csv(args.out_file, results)
@@ -0,0 +1,86 @@
+import argparse
+import csv
+import time
+
+import h5py
+import numpy as np
+import torch
+
+from plantseg.models.zoo import model_zoo
+from plantseg.predictions.functional.array_predictor import SUPPORTED_PRECISIONS
+from plantseg.predictions.functional.predictions import unet_predictions
+
+DEFAULT_MODELS = ['generic_confocal_3D_unet', 'confocal_2D_unet_ovules_ds2x']
+
+
+def write_csv(output_path, results):
+    print(f'Saving results to {output_path}...')
+    with open(output_path, "w") as output_file:
+        dict_writer = csv.DictWriter(output_file, results[0].keys())
+        dict_writer.writeheader()
+        dict_writer.writerows(results)
+
+
+def benchmark(raw, model_name, patch, device, precisions, single_batch_mode=False):
+    """Throughput of `unet_predictions` and maximum absolute error with respect to float32 for each precision."""
+    results, reference = [], None
+    for precision in ['float32'] + [p for p in precisions if p != 'float32']:
+        # a first run warms up the model cache and the memory model, only the second run is timed
+        kwargs = dict(patch=patch, single_batch_mode=single_batch_mode, device=device, disable_tqdm=True)
+        unet_predictions(raw, model_name, None, precision=precision, **kwargs)
+        start = time.perf_counter()
+        pmaps = unet_predictions(raw, model_name, None, precision=precision, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        if reference is None:
+            reference = pmaps
+        results.append(
+            {
+                'model': model_name,
+                'precision': precision,
+                'seconds': elapsed,
+                'voxels_per_s': raw.size / elapsed,
+                'max_abs_error': float(np.abs(pmaps - reference).max()),
+            }
+        )
+    return results
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Prediction Precision Benchmark Script')
+    parser.add_argument('--models', type=str, nargs='+', default=DEFAULT_MODELS, help='PlantSeg zoo model names')
+    parser.add_argument('--input', type=str, help='Path to an H5 file with the raw image, random if not given')
+    parser.add_argument('--key', type=str, default='raw', help='raw dataset name inside h5')
+    parser.add_argument('--shape', type=int, nargs=3, default=[64, 256, 256], help='shape of the random raw image')
+    parser.add_argument('--patch', type=int, nargs=3, default=[32, 128, 128], help='patch shape of the 3D models')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument(
+        '--precisions', type=str, nargs='+', default=list(SUPPORTED_PRECISIONS), help='precisions to benchmark'
+    )
+    parser.add_argument('--single-batch', action='store_true', help='use a batch size of 1')
+    parser.add_argument('--out-file', type=str, help='path of an optional CSV file with the results')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse()
+    if args.input is not None:
+        with h5py.File(args.input, 'r') as f:
+            raw = f[args.key][...].astype('float32')
+    else:
+        raw = np.random.RandomState(0).rand(*args.shape).astype('float32')
+
+    results = []
+    for model_name in args.models:
+        # 2D models predict one slice per patch
+        is_2d = model_zoo.get_model_config_by_name(model_name)['model']['name'] == 'UNet2D'
+        patch = (1,) + tuple(args.patch[1:]) if is_2d else tuple(args.patch)
+        results.extend(benchmark(raw, model_name, patch, args.device, args.precisions, args.single_batch))
+
+    for result in results:
+        print(
+            f"{result['model']:>40} {result['precision']:>9}: {result['voxels_per_s']:.3g} voxels/s, "
+            f"max error {result['max_abs_error']:.3g}"
+        )
+    if args.out_file is not None:
+        write_csv(args.out_file, results)
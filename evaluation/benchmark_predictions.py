@@ -0,0 +1,162 @@
+import argparse
+import csv
+import time
+
+import h5py
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from plantseg.augment.transforms import get_test_augmentations
+from plantseg.predictions.functional.accumulator import SUPPORTED_BLENDING, PatchAccumulator
+from plantseg.predictions.functional.array_dataset import ArrayDataset
+from plantseg.predictions.functional.array_predictor import ArrayPredictor
+from plantseg.predictions.functional.slice_builder import SliceBuilder
+from plantseg.predictions.functional.utils import get_stride_shape
+from plantseg.training.model import UNet3D
+
+
+def legacy_accumulate(predictions, indices, shape):
+    """Reference accumulation: per-sample numpy loop, averaging overlapping patches with a visit counter."""
+    prediction_map = np.zeros(shape, dtype='float32')
+    normalization_mask = np.zeros(shape, dtype='uint8')
+    for prediction, index in zip(predictions, indices):
+        prediction = prediction.cpu().numpy()
+        for pred, idx in zip(prediction, index):
+            idx = (slice(0, shape[0]),) + tuple(idx)
+            prediction_map[idx] += pred
+            normalization_mask[idx] += 1
+    return prediction_map / normalization_mask
+
+
+def blended_accumulate(predictions, indices, shape, device, blending):
+    prediction_map = np.zeros(shape, dtype='float32')
+    accumulator = PatchAccumulator(prediction_map, device, blending=blending)
+    for prediction, index in zip(predictions, indices):
+        accumulator.add(prediction, index)
+    accumulator.close()
+    return prediction_map
+
+
+def seam_score(pmaps, slices):
+    """Ratio between the mean absolute gradient across the patch borders and the mean absolute gradient elsewhere.
+
+    A score close to 1 means that the patch borders are not visible in the prediction maps, a score larger than 1
+    means seams between neighbouring patches.
+    """
+    scores = []
+    for axis in range(3):
+        size = pmaps.shape[axis + 1]
+        borders = {s[axis].start for s in slices} | {s[axis].stop for s in slices}
+        borders = sorted(b for b in borders if 0 < b < size)
+        if not borders:
+            continue
+        # gradient[i] is the difference between voxels i + 1 and i, i.e. across the border at i + 1
+        gradient = np.abs(np.diff(pmaps, axis=axis + 1))
+        at_border = np.zeros(size - 1, dtype=bool)
+        at_border[np.array(borders) - 1] = True
+        gradient = np.moveaxis(gradient, axis + 1, 0)
+        if at_border.all():
+            continue
+        scores.append(gradient[at_border].mean() / max(gradient[~at_border].mean(), 1e-12))
+    return float(np.mean(scores)) if scores else 1.0
+
+
+def write_csv(output_path, results):
+    print(f'Saving results to {output_path}...')
+    with open(output_path, "w") as output_file:
+        dict_writer = csv.DictWriter(output_file, results[0].keys())
+        dict_writer.writeheader()
+        dict_writer.writerows(results)
+
+
+def benchmark(raw, model, patch, halo, device, batch_size=1, repeats=3):
+    """Compare throughput and seam quality of the patch accumulation modes on `raw`.
+
+    The model is run once and its predictions are cached, the accumulation of the cached predictions is then
+    timed `repeats` times for the legacy per-sample averaging and for every blending mode of `PatchAccumulator`.
+    """
+    predictor = ArrayPredictor(
+        model=model,
+        in_channels=1,
+        out_channels=1,
+        device=device,
+        patch=patch,
+        patch_halo=halo,
+        single_batch_mode=True,
+        headless=False,
+        disable_tqdm=True,
+    )
+    slice_builder = SliceBuilder(raw, label_dataset=None, patch_shape=patch, stride_shape=get_stride_shape(patch))
+    dataset = ArrayDataset(raw, slice_builder, get_test_augmentations(raw), halo_shape=halo, verbose_logging=False)
+    loader = DataLoader(dataset, batch_size=batch_size, collate_fn=lambda batch: tuple(zip(*batch)))
+
+    predictions, indices = [], []
+    start = time.perf_counter()
+    with torch.no_grad():
+        predictor.model.eval()
+        for input_, index in loader:
+            predictions.append(predictor.predict_batch(torch.stack([torch.as_tensor(x) for x in input_])))
+            indices.append(index)
+    inference_time = time.perf_counter() - start
+
+    shape = (predictor.output_channels(),) + raw.shape
+    modes = {'legacy': lambda: legacy_accumulate(predictions, indices, shape)}
+    for blending in SUPPORTED_BLENDING:
+        modes[blending] = lambda blending=blending: blended_accumulate(predictions, indices, shape, device, blending)
+
+    results = []
+    for mode, accumulate in modes.items():
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            pmaps = accumulate()
+            if device != 'cpu':
+                torch.cuda.synchronize()
+            timings.append(time.perf_counter() - start)
+        accumulation_time = min(timings)
+        results.append(
+            {
+                'mode': mode,
+                'accumulation_s': accumulation_time,
+                'voxels_per_s': raw.size / (inference_time + accumulation_time),
+                'seam_score': seam_score(pmaps, slice_builder.raw_slices),
+            }
+        )
+    return results
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Patch Accumulation Benchmark Script')
+    parser.add_argument('--input', type=str, help='Path to an H5 file with the raw image, random if not given')
+    parser.add_argument('--key', type=str, default='raw', help='raw dataset name inside h5')
+    parser.add_argument('--shape', type=int, nargs=3, default=[64, 256, 256], help='shape of the random raw image')
+    parser.add_argument('--patch', type=int, nargs=3, default=[32, 128, 128], help='patch shape')
+    parser.add_argument('--halo', type=int, nargs=3, default=[4, 8, 8], help='patch halo')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=3, help='number of timed repetitions of every mode')
+    parser.add_argument('--out-file', type=str, help='path of an optional CSV file with the results')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse()
+    if args.input is not None:
+        with h5py.File(args.input, 'r') as f:
+            raw = f[args.key][...].astype('float32')
+    else:
+        raw = np.random.RandomState(0).rand(*args.shape).astype('float32')
+
+    # randomly initialised network, the benchmark only measures how the patches are combined
+    torch.manual_seed(0)
+    model = UNet3D(in_channels=1, out_channels=1, f_maps=8, num_levels=3, num_groups=4)
+
+    results = benchmark(raw, model, tuple(args.patch), tuple(args.halo), args.device, args.batch_size, args.repeats)
+    for result in results:
+        print(
+            f"{result['mode']:>10}: accumulation {result['accumulation_s']:.3f}s, "
+            f"{result['voxels_per_s']:.3g} voxels/s, seam score {result['seam_score']:.3f}"
+        )
+    if args.out_file is not None:
+        write_csv(args.out_file, results)
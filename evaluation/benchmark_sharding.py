@@ -0,0 +1,102 @@
+import argparse
+import csv
+import os
+import time
+
+import h5py
+import numpy as np
+import torch
+
+from plantseg.models.zoo import model_zoo
+from plantseg.predictions.functional.predictions import unet_predictions
+
+DEFAULT_WORKERS = [1, 2, 4, 8]
+
+
+def write_csv(output_path, results):
+    print(f'Saving results to {output_path}...')
+    with open(output_path, "w") as output_file:
+        dict_writer = csv.DictWriter(output_file, results[0].keys())
+        dict_writer.writeheader()
+        dict_writer.writerows(results)
+
+
+def _timed_predictions(raw, model_name, patch, threads, single_batch_mode, **kwargs):
+    torch.set_num_threads(threads)
+    kwargs = dict(patch=patch, single_batch_mode=single_batch_mode, device='cpu', disable_tqdm=True, **kwargs)
+    start = time.perf_counter()
+    pmaps = unet_predictions(raw, model_name, None, **kwargs)
+    return pmaps, time.perf_counter() - start
+
+
+def benchmark(raw, model_name, patch, workers, threads, single_batch_mode=False):
+    """Throughput of the `ShardedPredictor` for each number of workers, compared to a single process.
+
+    All the runs use `threads` threads in total, i.e. `threads // num_workers` threads per worker. With
+    `single_batch_mode` the sharded predictions are also compared with a single process running with the same number
+    of threads as each worker, otherwise the batch sizes of the workers and of the single process differ.
+    """
+    # a first run warms up the model cache and the memory model
+    _timed_predictions(raw, model_name, patch, threads, single_batch_mode)
+    reference, reference_seconds = _timed_predictions(raw, model_name, patch, threads, single_batch_mode)
+
+    results = []
+    for num_workers in workers:
+        threads_per_worker = max(threads // num_workers, 1)
+        pmaps, seconds = _timed_predictions(
+            raw, model_name, patch, threads, single_batch_mode, predictor='ShardedPredictor', num_workers=num_workers
+        )
+        bitwise_identical = None
+        if single_batch_mode:
+            single_process, _ = _timed_predictions(raw, model_name, patch, threads_per_worker, single_batch_mode)
+            bitwise_identical = bool(np.array_equal(pmaps, single_process))
+        results.append(
+            {
+                'model': model_name,
+                'workers': num_workers,
+                'threads_per_worker': threads_per_worker,
+                'seconds': seconds,
+                'voxels_per_s': raw.size / seconds,
+                'speedup': reference_seconds / seconds,
+                'bitwise_identical': bitwise_identical,
+                'max_abs_error': float(np.abs(pmaps - reference).max()),
+            }
+        )
+    return results
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Sharded CPU Prediction Scaling Benchmark Script')
+    parser.add_argument('--model', type=str, default='generic_confocal_3D_unet', help='PlantSeg zoo model name')
+    parser.add_argument('--input', type=str, help='Path to an H5 file with the raw image, random if not given')
+    parser.add_argument('--key', type=str, default='raw', help='raw dataset name inside h5')
+    parser.add_argument('--shape', type=int, nargs=3, default=[128, 256, 256], help='shape of the random raw image')
+    parser.add_argument('--patch', type=int, nargs=3, default=[32, 128, 128], help='patch shape of the 3D models')
+    parser.add_argument('--workers', type=int, nargs='+', default=DEFAULT_WORKERS, help='numbers of workers')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='total number of threads')
+    parser.add_argument('--single-batch', action='store_true', help='use a batch size of 1 and check the results')
+    parser.add_argument('--out-file', type=str, help='path of an optional CSV file with the results')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse()
+    if args.input is not None:
+        with h5py.File(args.input, 'r') as f:
+            raw = f[args.key][...].astype('float32')
+    else:
+        raw = np.random.RandomState(0).rand(*args.shape).astype('float32')
+
+    # 2D models predict one slice per patch
+    is_2d = model_zoo.get_model_config_by_name(args.model)['model']['name'] == 'UNet2D'
+    patch = (1,) + tuple(args.patch[1:]) if is_2d else tuple(args.patch)
+    results = benchmark(raw, args.model, patch, args.workers, args.threads, args.single_batch)
+
+    for result in results:
+        print(
+            f"{result['workers']:>3} workers x {result['threads_per_worker']:>3} threads: "
+            f"{result['voxels_per_s']:.3g} voxels/s, speedup {result['speedup']:.2f}, "
+            f"bitwise identical {result['bitwise_identical']}, max error {result['max_abs_error']:.3g}"
+        )
+    if args.out_file is not None:
+        write_csv(args.out_file, results)
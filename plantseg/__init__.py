@@ -31,12 +31,16 @@ PATH_RAW2SEG_TEMPLATE = PATH_RESOURCES / FILE_RAW2SEG_TEMPLATE
 DIR_PLANTSEG_MODELS = ".plantseg_models"
 DIR_CONFIGS = "configs"
 FILE_MODEL_ZOO_CUSTOM = "custom_zoo.yaml"
+FILE_MEMORY_MODELS = "memory_models.yaml"
+DIR_PATCH_CACHE = "patch_cache"
 
 PATH_HOME = Path(getenv('PLANTSEG_HOME', str(Path.home())))
 
 PATH_PLANTSEG_MODELS = PATH_HOME / DIR_PLANTSEG_MODELS
 PATH_CONFIGS = PATH_PLANTSEG_MODELS / DIR_CONFIGS
 PATH_MODEL_ZOO_CUSTOM = PATH_PLANTSEG_MODELS / FILE_MODEL_ZOO_CUSTOM
+PATH_MEMORY_MODELS = PATH_PLANTSEG_MODELS / FILE_MEMORY_MODELS
+PATH_PATCH_CACHE = PATH_PLANTSEG_MODELS / DIR_PATCH_CACHE
 
 PATH_CONFIGS.mkdir(parents=True, exist_ok=True)
 
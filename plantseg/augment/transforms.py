@@ -1,7 +1,11 @@
+import math
+import os
 from typing import Optional
 
+import h5py
 import numpy as np
 import torch
+import zarr
 
 
 class Compose:
@@ -74,6 +78,9 @@ class Standardize:
         self.channelwise = channelwise
 
     def __call__(self, m: np.ndarray) -> np.ndarray:
+        if not np.issubdtype(m.dtype, np.floating):
+            # patches of integer raw data, which is not converted to float as a whole
+            m = m.astype('float32')
         if self.mean is not None and self.std is not None:
             mean, std = self.mean, self.std
         else:
@@ -84,21 +91,113 @@ class Standardize:
         return (m - mean) / np.clip(std, a_min=self.eps, a_max=None)
 
 
-def get_test_augmentations(raw: Optional[np.ndarray], expand_dims: bool = True) -> Compose:
+SUPPORTED_STATS = ['exact', 'subsampled', 'robust']
+STATS_CHUNK_VOXELS = 2**18  # voxels read at once by the exact statistics, small enough to stay in the cpu cache
+STATS_SAMPLES = 2**22  # voxels of the regular subsample of the approximate statistics
+
+# global statistics of on-disk datasets: (file, dataset, file modification time, shape, stats) -> (mean, std)
+_stats_cache = {}
+
+
+def _chunks(raw, max_voxels: int):
+    """Read `raw` in float64 chunks of at most `max_voxels` voxels (or a single row), slicing the leading axes."""
+    axis = 0
+    while axis < raw.ndim - 1 and math.prod(raw.shape[axis + 1 :]) > max_voxels:
+        axis += 1
+    step = max(max_voxels // math.prod(raw.shape[axis + 1 :]), 1)
+    for outer in np.ndindex(*raw.shape[:axis]):
+        for start in range(0, raw.shape[axis], step):
+            # always a copy, the chunks are modified in place
+            yield np.array(raw[outer + (slice(start, start + step),)], dtype='float64')
+
+
+def _exact_mean_std(raw) -> tuple[float, float]:
+    """Mean and standard deviation of `raw`, merging the statistics of its chunks (Chan et al.)."""
+    count, mean, m2 = 0, 0.0, 0.0
+    for chunk in _chunks(raw, STATS_CHUNK_VOXELS):
+        chunk = chunk.ravel()
+        chunk_mean = float(chunk.mean())
+        chunk -= chunk_mean
+        chunk_m2 = float(np.dot(chunk, chunk))
+        total = count + chunk.size
+        delta = chunk_mean - mean
+        mean += delta * chunk.size / total
+        m2 += chunk_m2 + delta**2 * count * chunk.size / total
+        count = total
+    return mean, math.sqrt(m2 / count)
+
+
+def _subsample(raw, num_samples: int) -> np.ndarray:
+    """Regular subsample of about `num_samples` voxels of `raw`, with the same step along the spatial axes."""
+    spatial_axes = min(raw.ndim, 3)
+    step = max(math.ceil((math.prod(raw.shape) / num_samples) ** (1 / spatial_axes)), 1)
+    return np.asarray(raw[(Ellipsis,) + (slice(None, None, step),) * spatial_axes], dtype='float64')
+
+
+def _stats_cache_key(raw, stats: str) -> Optional[tuple]:
+    """Key of the statistics of an h5py or zarr dataset, None for in-memory arrays."""
+    if isinstance(raw, h5py.Dataset):
+        path, name = raw.file.filename, raw.name
+    elif isinstance(raw, zarr.Array) and isinstance(getattr(raw.store, 'path', None), str):
+        path, name = raw.store.path, raw.path
+    else:
+        return None
+    path = os.path.realpath(path)
+    return path, name, os.stat(path).st_mtime_ns, tuple(raw.shape), stats
+
+
+def global_stats(raw, stats: str = 'exact') -> tuple[float, float]:
+    """
+    Compute the mean and standard deviation of `raw` used for the global normalization of the patches.
+
+    The statistics are computed in the dtype of `raw`, reading chunks of at most `STATS_CHUNK_VOXELS` voxels, so
+    neither in-memory nor on-disk arrays are converted to float as a whole. The statistics of h5py and zarr datasets
+    are cached by file, dataset and file modification time.
+
+    Args:
+        raw: The raw data, either in memory (np.ndarray) or on disk (e.g. h5py.Dataset, zarr.Array).
+        stats (str): 'exact' reads the whole data, 'subsampled' computes the mean and standard deviation of a regular
+            subsample of `STATS_SAMPLES` voxels, 'robust' the median and the interquartile range (scaled to the
+            standard deviation of a normal distribution) of the same subsample, which are insensitive to outliers.
+
+    Returns:
+        tuple[float, float]: The mean and standard deviation.
+    """
+    if stats not in SUPPORTED_STATS:
+        raise ValueError(f'Unsupported statistics {stats}, must be one of {SUPPORTED_STATS}')
+    key = _stats_cache_key(raw, stats)
+    if key is not None and key in _stats_cache:
+        return _stats_cache[key]
+
+    if stats == 'exact':
+        mean, std = _exact_mean_std(raw)
+    elif stats == 'subsampled':
+        sample = _subsample(raw, STATS_SAMPLES)
+        mean, std = float(sample.mean()), float(sample.std())
+    else:
+        q25, median, q75 = np.percentile(_subsample(raw, STATS_SAMPLES), [25, 50, 75])
+        mean, std = float(median), float(q75 - q25) / 1.349
+
+    if key is not None:
+        _stats_cache[key] = (mean, std)
+    return mean, std
+
+
+def get_test_augmentations(raw: Optional[np.ndarray], expand_dims: bool = True, stats: str = 'exact') -> Compose:
     """
     Constructs a set of data transformations for inference.
     Uses global mean and standard deviation of the provided raw data if available;
     otherwise, it calculatesthese statistics on-the-fly per patch.
 
     Args:
-        raw (Optional[ndarray]): The raw data to compute global statistics.
-                                 If None, statistics are computedduring transformation per patch.
+        raw (Optional[ndarray]): The raw data to compute global statistics, either in memory or on disk
+                                 (e.g. h5py.Dataset). If None, statistics are computedduring transformation per patch.
         expand_dims (bool): if True, adds a channel dimension to the input data.
+        stats (str): how the global statistics are computed, 'exact', 'subsampled' or 'robust', see `global_stats`.
 
     Returns:
         Compose: A composed transformation of standardization and tensor conversion.
     """
-    mean = np.mean(raw) if raw is not None else None
-    std = np.std(raw) if raw is not None else None
+    mean, std = global_stats(raw, stats) if raw is not None else (None, None)
 
     return Compose([Standardize(mean=mean, std=std), ToTensor(expand_dims=expand_dims)])
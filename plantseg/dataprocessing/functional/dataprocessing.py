@@ -172,3 +172,39 @@ def normalize_01(data: np.ndarray) -> np.ndarray:
         normalized_data (np.ndarray): Normalized numpy array
     """
     return (data - np.min(data)) / (np.max(data) - np.min(data) + 1e-12).astype('float32')
+
+
+def to_compact_dtype(data: np.ndarray, dtype) -> np.ndarray:
+    """
+    Convert an array with values between 0 and 1 (e.g. probability maps) to a compact dtype. Integer dtypes are
+    quantized over their full range, i.e. the values are clipped to [0, 1], scaled by the dtype maximum and rounded.
+
+    Args:
+        data (np.ndarray): Input numpy array with values between 0 and 1
+        dtype: Output dtype, e.g. 'float16', 'uint16' or 'uint8'
+
+    Returns:
+        compact_data (np.ndarray): The data converted to `dtype`
+    """
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        data = np.rint(np.clip(data, 0, 1) * np.iinfo(dtype).max)
+    return np.asarray(data).astype(dtype, copy=False)
+
+
+def from_compact_dtype(data: np.ndarray) -> np.ndarray:
+    """
+    Convert an array in a compact dtype (see `to_compact_dtype`) back to float32, integer arrays are dequantized to
+    [0, 1]. Float32 arrays are returned without copy.
+
+    Args:
+        data (np.ndarray): Input numpy array
+
+    Returns:
+        float_data (np.ndarray): The data as float32
+    """
+    if np.issubdtype(data.dtype, np.integer):
+        float_data = data.astype('float32')
+        float_data /= np.iinfo(data.dtype).max
+        return float_data
+    return data.astype('float32', copy=False)
@@ -1,4 +1,4 @@
-from plantseg.io.io import smart_load, load_shape, allowed_data_format
+from plantseg.io.io import smart_load, load_shape, open_lazy, allowed_data_format
 from plantseg.io.tiff import load_tiff, read_tiff_voxel_size, create_tiff, TIFF_EXTENSIONS
 from plantseg.io.h5 import load_h5, read_h5_voxel_size, create_h5, H5_EXTENSIONS
 from plantseg.io.pil import load_pill, PIL_EXTENSIONS
@@ -8,6 +8,7 @@ from plantseg.io.zarr import load_zarr, create_zarr, ZARR_EXTENSIONS
 __all__ = [
     "smart_load",
     "load_shape",
+    "open_lazy",
     "allowed_data_format",
     "load_tiff",
     "read_tiff_voxel_size",
@@ -1,11 +1,16 @@
 import os
+from contextlib import contextmanager
 
+import h5py
 import numpy as np
+import zarr
 from typing import Union
 from plantseg.io.h5 import load_h5, H5_EXTENSIONS
+from plantseg.io.h5 import _find_input_key as _find_h5_input_key, read_h5_voxel_size
 from plantseg.io.tiff import load_tiff, TIFF_EXTENSIONS
 from plantseg.io.pil import load_pill, PIL_EXTENSIONS
 from plantseg.io.zarr import load_zarr, ZARR_EXTENSIONS
+from plantseg.io.zarr import _find_input_key as _find_zarr_input_key, read_zarr_voxel_size
 
 allowed_data_format = TIFF_EXTENSIONS + H5_EXTENSIONS + PIL_EXTENSIONS + ZARR_EXTENSIONS
 
@@ -67,3 +72,40 @@ def load_shape(path: str, key: str = None) -> tuple[int, ...]:
     """
     _, data_shape, _, _ = smart_load(path, key=key, info_only=True)
     return data_shape
+
+
+@contextmanager
+def open_lazy(path: str, key: str = None):
+    """
+    Open a dataset without loading it into memory. Only h5 and zarr files are supported, the dataset
+    is read on demand through numpy slicing and is valid until the context is closed.
+
+    Args:
+        path (str): path to the file to open.
+        key (str): key of the dataset to open, if None the key is inferred as in `smart_load`.
+
+    Yields:
+        dataset (h5py.Dataset | zarr.Array): the opened dataset.
+        infos (tuple): tuple with the voxel size, shape, key and voxel size unit.
+
+    Examples:
+        >>> with open_lazy('path/to/file.h5', key='raw') as (raw, (voxel_size, shape, key, unit)):
+        ...     patch = raw[:10, :64, :64]
+    """
+    _, ext = os.path.splitext(path)
+    if ext in H5_EXTENSIONS:
+        with h5py.File(path, 'r') as f:
+            if key is None:
+                key = _find_h5_input_key(f)
+            dataset = f[key]
+            yield dataset, (read_h5_voxel_size(f, key), dataset.shape, key, 'um')
+
+    elif ext in ZARR_EXTENSIONS:
+        zarr_file = zarr.open_group(path, mode='r')
+        if key is None:
+            key = _find_zarr_input_key(zarr_file)
+        dataset = zarr_file[key]
+        yield dataset, (read_zarr_voxel_size(zarr_file, key), dataset.shape, key, 'um')
+
+    else:
+        raise ValueError(f"Lazy loading is only supported for h5 and zarr files, got '{ext}'")
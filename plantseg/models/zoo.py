@@ -1,6 +1,7 @@
 """Model Zoo Singleton"""
 
 import json
+from collections import OrderedDict
 from warnings import warn
 from pathlib import Path
 from shutil import copy2
@@ -15,6 +16,7 @@ from bioimageio.spec.model.v0_4 import ModelDescr as ModelDescr_v0_4
 from bioimageio.spec.model.v0_5 import ModelDescr as ModelDescr_v0_5
 from bioimageio.spec.utils import download
 
+import torch
 from torch.nn import MaxPool3d, MaxPool2d, Conv3d, Conv2d, Module
 from plantseg.training.model import InterpolateUpsampling, AbstractUNet, UNet2D, UNet3D
 
@@ -71,6 +73,9 @@ class ModelZoo:
     The ModelZoo class provides methods to update, query and add records to the DataFrame.
 
     Records are added as ModelZooRecord instances, validated by the ModelZooRecord class.
+
+    Models loaded with `load_model` are kept, weight-loaded and in eval mode, in an in-process LRU cache holding
+    at most `model_cache_max_bytes` of parameters and buffers.
     """
 
     _instance: Optional['ModelZoo'] = None
@@ -84,6 +89,9 @@ class ModelZoo:
     path_zoo: Path = PATH_MODEL_ZOO
     path_zoo_custom: Path = PATH_MODEL_ZOO_CUSTOM
 
+    _model_cache: OrderedDict = OrderedDict()
+    model_cache_max_bytes: int = 2 * 1024**3
+
     models: DataFrame
     models_bioimageio: DataFrame
 
@@ -179,6 +187,15 @@ class ModelZoo:
     def get_model_patch_size(self, model_name: str) -> Optional[Tuple[float, float, float]]:
         return self._get_model_record(model_name).recommended_patch_size
 
+    def set_model_patch_size(self, model_name: str, patch_size: Tuple[int, int, int]) -> bool:
+        """Update the recommended patch size of a custom model in the local record file, False if not a custom model"""
+        if model_name not in self._zoo_custom_dict:
+            return False
+        self._zoo_custom_dict[model_name]['recommended_patch_size'] = [int(p) for p in patch_size]
+        save_config(self._zoo_custom_dict, self.path_zoo_custom)
+        self._init_zoo_df()
+        return True
+
     def _get_unique_metadata(self, metadata_key: str) -> List[str]:
         metadata = self.models.loc[:, metadata_key].dropna().unique()
         return [str(x) for x in metadata]
@@ -255,6 +272,7 @@ class ModelZoo:
         # Update the custom zoo dictionary in ModelZoo and save to file
         self._zoo_custom_dict[new_model_name] = new_model_record
         save_config(self._zoo_custom_dict, self.path_zoo_custom)
+        self.clear_model_cache(new_model_name)
 
         return True, None
 
@@ -312,6 +330,8 @@ class ModelZoo:
 
     def get_model_by_name(self, model_name: str, model_update: bool = False):
         """Load configuration for a model in zoo; return the model, configuration and path."""
+        if model_update:
+            self.clear_model_cache(model_name)
         self.check_models(model_name, update_files=model_update)
         config_path = self._get_model_config_path_by_name(model_name)
         model_weights_path = PATH_PLANTSEG_MODELS / model_name / FILE_BEST_MODEL_PYTORCH
@@ -379,6 +399,78 @@ class ModelZoo:
         zoo_logger.info(f"Loaded model from BioImage.IO Model Zoo: {model_id}")
         return model, model_config, model_weights_path
 
+    def load_model(
+        self,
+        model_name: Optional[str] = None,
+        model_id: Optional[str] = None,
+        config_path: Optional[Path] = None,
+        model_weights_path: Optional[Path] = None,
+        model_update: bool = False,
+        device: str = 'cpu',
+    ):
+        """Return a weight-loaded model in eval mode on `device`, its configuration and weights path.
+
+        The model is chosen by `config_path` (custom model, optionally with `model_weights_path`), `model_id`
+        (BioImage.IO Model Zoo) or `model_name` (PlantSeg zoo), in this order of precedence. Loaded models are
+        cached, so repeated calls skip the model construction and the deserialization of the weights.
+        The returned model is shared between the callers and should not be modified.
+        """
+        if config_path is not None:
+            config_path = Path(config_path)
+            weights_path = Path(model_weights_path or config_path.parent / FILE_BEST_MODEL_PYTORCH)
+            # retrained weights at the same path must not be served from the cache
+            mtime = weights_path.stat().st_mtime if weights_path.exists() else None
+            key = ('config_path', str(config_path), str(weights_path), mtime, str(device))
+        elif model_id is not None:
+            key = ('model_id', model_id, str(device))
+        elif model_name is not None:
+            if model_update:
+                self.clear_model_cache(model_name)
+            key = ('model_name', model_name, str(device))
+        else:
+            raise ValueError('Either `model_name` or `model_id` or `model_path` must be provided.')
+
+        if key in self._model_cache:
+            self._model_cache.move_to_end(key)
+            zoo_logger.info(f"Using cached model: {key[1]}")
+            return self._model_cache[key]
+
+        if config_path is not None:
+            model, model_config, model_path = self.get_model_by_config_path(config_path, model_weights_path)
+        elif model_id is not None:
+            model, model_config, model_path = self.get_model_by_id(model_id)
+        else:
+            model, model_config, model_path = self.get_model_by_name(model_name, model_update=model_update)
+
+        state = torch.load(model_path, map_location='cpu')
+        if 'model_state_dict' in state:  # Model weights format may vary between versions
+            state = state['model_state_dict']
+        model.load_state_dict(state)
+        model = model.to(device).eval()
+
+        self._model_cache[key] = (model, model_config, model_path)
+        self._evict_models()
+        return model, model_config, model_path
+
+    def clear_model_cache(self, name: Optional[str] = None) -> None:
+        """Remove the cached models of `name` (model name, model id or config path), or all if `name` is None."""
+        for key in list(self._model_cache):
+            if name is None or key[1] == str(name):
+                del self._model_cache[key]
+
+    def _evict_models(self) -> None:
+        """Remove the least recently used models until the cache fits in `model_cache_max_bytes`."""
+
+        def model_bytes(model: Module) -> int:
+            tensors = list(model.parameters()) + list(model.buffers())
+            return sum(t.numel() * t.element_size() for t in tensors)
+
+        sizes = {key: model_bytes(value[0]) for key, value in self._model_cache.items()}
+        while len(self._model_cache) > 1 and sum(sizes.values()) > self.model_cache_max_bytes:
+            key, _ = self._model_cache.popitem(last=False)
+            zoo_logger.info(f"Removing model {key[1]} from the model cache")
+            del sizes[key]
+
     def refresh_bioimageio_zoo_urls(self):
         """Initialize the BioImage.IO Model Zoo collection and URL dictionaries.
 
@@ -7,7 +7,7 @@ import yaml
 
 from plantseg.pipeline import gui_logger
 from plantseg import PATH_RAW2SEG_TEMPLATE
-from plantseg.predictions.functional.utils import get_stride_shape
+from plantseg.predictions.functional.utils import get_stride_shape, small_overlap_axes
 from plantseg.segmentation.utils import SUPPORTED_ALGORITHMS
 from plantseg.models.zoo import model_zoo
 
@@ -86,6 +86,51 @@ def filter_name(key, value, fallback=None):
         return value
 
 
+def predictor_name(key, value, fallback=None):
+    predictors = ['ArrayPredictor', 'LazyPredictor', 'ShardedPredictor']
+    if value not in predictors:
+        _error_message(f"value must be one of {predictors}", key, value, fallback)
+        return fallback
+    else:
+        return value
+
+
+def precision_name(key, value, fallback=None):
+    precisions = ['float32', 'bfloat16', 'float16']
+    if value not in precisions:
+        _error_message(f"value must be one of {precisions}", key, value, fallback)
+        return fallback
+    else:
+        return value
+
+
+def output_dtype_name(key, value, fallback=None):
+    output_dtypes = ['float32', 'float16', 'uint16', 'uint8']
+    if value not in output_dtypes:
+        _error_message(f"value must be one of {output_dtypes}", key, value, fallback)
+        return fallback
+    else:
+        return value
+
+
+def normalization_stats_name(key, value, fallback=None):
+    stats = ['exact', 'subsampled', 'robust']
+    if value not in stats:
+        _error_message(f"value must be one of {stats}", key, value, fallback)
+        return fallback
+    else:
+        return value
+
+
+def backend_name(key, value, fallback=None):
+    backends = ['torch', 'onnxruntime']
+    if value not in backends:
+        _error_message(f"value must be one of {backends}", key, value, fallback)
+        return fallback
+    else:
+        return value
+
+
 def is_file_or_dir(key, value, fallback):
     if not (os.path.isdir(value) or os.path.isfile(value)):
         _error_message("value must be a valid file or directory path", key, value, fallback)
@@ -231,16 +276,12 @@ def check_patch_and_stride(config):
     patch = config["cnn_prediction"]["patch"]
     axis = ['z', 'x', 'y']
     stride = get_stride_shape(patch, _stride) if isinstance(_stride, float) else _stride
-    for _ax, _patch, _stride in zip(axis, patch, stride):
-        test_z = _ax == 'z' and 1 < _patch - _stride <= 8
-        test_x = _ax == 'x' and _patch - _stride <= 16
-        test_y = _ax == 'y' and _patch - _stride <= 16
-        if test_z or test_x or test_y:
-            gui_logger.warning(
-                f"Stride along {_ax} axis (axis order zxy) is too large, "
-                f"this might lead to empty strides artifacts in the cnn predictions. "
-                f"Please try to either reduce the stride or to increase the patch size."
-            )
+    for _ax in small_overlap_axes(patch, stride):
+        gui_logger.warning(
+            f"Stride along {axis[_ax]} axis (axis order zxy) is too large, "
+            f"this might lead to empty strides artifacts in the cnn predictions. "
+            f"Please try to either reduce the stride or to increase the patch size."
+        )
     return config
 
 
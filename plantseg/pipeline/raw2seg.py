@@ -52,6 +52,19 @@ def configure_cnn_step(input_paths, config):
     state = config.get('state', True)
     model_update = config.get('model_update', False)
     patch_halo = tuple(config.get('patch_halo', None))
+    predictor = config.get('predictor', 'ArrayPredictor')
+    tta = config.get('tta', False)
+    precision = config.get('precision', 'float32')
+    compiled = config.get('compiled', False)
+    backend = config.get('backend', 'torch')
+    skip_background = config.get('skip_background', False)
+    patch_cache = config.get('patch_cache', False)
+    num_workers = config.get('num_workers', None)
+    output_dtype = config.get('output_dtype', 'float32')
+    normalization_stats = config.get('normalization_stats', 'exact')
+    prefetch = config.get('prefetch', 1)
+    time_series = config.get('time_series', False)
+    rescale_factor = config.get('rescale_factor', None)
     return UnetPredictions(
         input_paths,
         model_name=model_name,
@@ -63,6 +76,19 @@ def configure_cnn_step(input_paths, config):
         model_update=model_update,
         state=state,
         patch_halo=patch_halo,
+        predictor=predictor,
+        tta=tta,
+        precision=precision,
+        compiled=compiled,
+        backend=backend,
+        skip_background=skip_background,
+        patch_cache=patch_cache,
+        num_workers=num_workers,
+        output_dtype=output_dtype,
+        normalization_stats=normalization_stats,
+        prefetch=prefetch,
+        time_series=time_series,
+        rescale_factor=rescale_factor,
     )
 
 
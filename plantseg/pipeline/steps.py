@@ -1,14 +1,33 @@
+import collections
 import os
 from abc import ABC
+from concurrent import futures
 
+import h5py
 import numpy as np
 import yaml
 
 from plantseg.dataprocessing.functional.dataprocessing import normalize_01, fix_input_shape
-from plantseg.io import smart_load, create_tiff, create_h5
+from plantseg.io import smart_load, create_tiff, create_h5, H5_EXTENSIONS
+from plantseg.io.h5 import _find_input_key
 from plantseg.pipeline import gui_logger
 from plantseg.pipeline.utils import SUPPORTED_TYPES
 
+COMPACT_PMAPS_DTYPES = [np.float16, np.uint16, np.uint8]
+COMPACT_PMAPS_ATTR = 'compact_pmaps'  # h5 attribute of the compact prediction maps saved by `UnetPredictions`
+
+
+def is_compact_pmaps(path, key=None):
+    """
+    True if the dataset `key` of `path` holds compact prediction maps saved by `UnetPredictions`, i.e. marked
+    with the `COMPACT_PMAPS_ATTR` attribute
+    """
+    if os.path.splitext(path)[1] not in H5_EXTENSIONS:
+        return False
+    with h5py.File(path, 'r') as f:
+        key = _find_input_key(f) if key is None else key
+        return bool(f[key].attrs.get(COMPACT_PMAPS_ATTR, False))
+
 
 class GenericPipelineStep:
     """
@@ -24,6 +43,8 @@ class GenericPipelineStep:
         state (bool): if True the step is enabled
         h5_output_key (str): output H5 dataset, if None the input key will be used
         save_raw (bool): save raw input in the output H5
+        prefetch (int): number of files loaded ahead and written behind in background threads while a file is
+            processed, 0 processes the files one after another
     """
 
     def __init__(
@@ -39,6 +60,7 @@ class GenericPipelineStep:
         state=True,
         h5_output_key=None,
         save_raw=False,
+        prefetch=0,
     ):
         assert isinstance(input_paths, list)
         assert len(input_paths) > 0, "Input file paths cannot be empty"
@@ -56,6 +78,7 @@ class GenericPipelineStep:
         self.out_ext = out_ext
         self.state = state
         self.save_raw = save_raw
+        self.prefetch = prefetch
 
         # create save_directory if it doesn't exist
         self.save_directory = os.path.join(os.path.dirname(input_paths[0]), save_directory)
@@ -66,6 +89,8 @@ class GenericPipelineStep:
         if not self.state:
             gui_logger.info(f"Skipping '{self.__class__.__name__}'. Disabled by the user.")
             return self.input_paths
+        elif self.prefetch > 0 and len(self.input_paths) > 1:
+            return self._pipelined_read_process_write()
         else:
             return [self.read_process_write(input_path) for input_path in self.input_paths]
 
@@ -82,12 +107,25 @@ class GenericPipelineStep:
         raise NotImplementedError
 
     def read_process_write(self, input_path):
+        input_data, voxel_size = self.read(input_path)
+        output_data = self.process(input_data)
+        return self.write(input_path, input_data.shape, output_data, voxel_size)
+
+    def read(self, input_path):
+        """
+        Load the stack of a file to be processed, see `load_stack`
+        """
         gui_logger.info(f'Loading stack from {input_path}')
-        input_data, voxel_size = self.load_stack(input_path)
+        return self.load_stack(input_path)
 
-        output_data = self.process(input_data)
+    def write(self, input_path, in_shape, output_data, voxel_size):
+        """
+        Save the result of processing the stack of `input_path`, of shape `in_shape`
+
+        Returns:
+            output_path (str): path to the file where the results were saved
+        """
         # voxel_size may change after pre-/post-processing (i.e. when scaling is used)
-        in_shape = input_data.shape
         out_shape = output_data[0].shape if output_data.ndim == 4 else output_data.shape
 
         scale_factor = np.array(out_shape) / np.array(in_shape)
@@ -104,6 +142,41 @@ class GenericPipelineStep:
         # return output_path
         return output_path
 
+    def _pipelined_read_process_write(self):
+        """
+        Process the files as `read_process_write`, loading the next `prefetch` files in a background thread and
+        writing the previous results in another one while a file is processed. At most `prefetch` loaded stacks
+        and `prefetch` results wait in the background, which bounds the memory usage to about `2 * prefetch + 1`
+        times the one of a single file.
+        """
+        output_paths = []
+        reader = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='plantseg_read')
+        writer = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='plantseg_write')
+        try:
+            reads = collections.deque(reader.submit(self.read, path) for path in self.input_paths[: self.prefetch])
+            writes = collections.deque()
+            for i, input_path in enumerate(self.input_paths):
+                # at most `prefetch` stacks are loaded ahead of the one being processed
+                if i + self.prefetch < len(self.input_paths):
+                    reads.append(reader.submit(self.read, self.input_paths[i + self.prefetch]))
+                input_data, voxel_size = reads.popleft().result()
+
+                output_data = self.process(input_data)
+                in_shape = input_data.shape
+                del input_data
+
+                while len(writes) >= self.prefetch:
+                    output_paths.append(writes.popleft().result())
+                writes.append(writer.submit(self.write, input_path, in_shape, output_data, voxel_size))
+                del output_data
+
+            output_paths += [write.result() for write in writes]
+        finally:
+            # on errors, skip the files not loaded yet but finish the pending writes
+            reader.shutdown(wait=True, cancel_futures=True)
+            writer.shutdown(wait=True)
+        return output_paths
+
     def load_stack(self, file_path, check_input_type=True):
         """
         Load data from a given file.
@@ -236,3 +309,13 @@ class AbstractSegmentationStep(GenericPipelineStep, ABC):
             state=state,
             h5_output_key='segmentation',
         )
+
+    def load_stack(self, file_path, check_input_type=True):
+        data, voxel_size = super().load_stack(file_path, check_input_type=False)
+        # compact prediction maps (see `UnetPredictions`) are already in [0, 1] and converted to float32 by the
+        # segmentation functions, avoiding a float32 copy of the whole stack. Any other input, e.g. a raw uint16
+        # stack, is normalized to [0, 1] as usual.
+        compact = data.dtype in COMPACT_PMAPS_DTYPES and is_compact_pmaps(file_path, self.input_key)
+        if check_input_type and not compact:
+            data = self._adjust_input_type(data)
+        return data, voxel_size
@@ -1,6 +1,12 @@
-from plantseg.predictions.functional.predictions import unet_predictions
+from plantseg.predictions.functional.predictions import (
+    unet_predictions,
+    unet_cascade_predictions,
+    unet_ensemble_predictions,
+)
 
 # Use __all__ to let type checkers know what is part of the public API.
 __all__ = [
     "unet_predictions",
+    "unet_cascade_predictions",
+    "unet_ensemble_predictions",
 ]
@@ -0,0 +1,217 @@
+import numpy as np
+import torch
+
+from plantseg.dataprocessing.functional.dataprocessing import to_compact_dtype
+
+SUPPORTED_BLENDING = ['gaussian', 'average']
+
+
+def blending_window(
+    patch_shape: tuple[int, int, int],
+    blending: str = 'gaussian',
+    sigma_scale: float = 0.125,
+    min_weight: float = 1e-4,
+    device: str = 'cpu',
+) -> torch.Tensor:
+    """Compute the weights used to blend overlapping patches into the prediction maps.
+
+    The window is the outer product of one 1D window per axis. With 'gaussian' blending the voxels
+    close to the patch border, where the network sees less context, get a lower weight than the
+    voxels in the patch center, which suppresses the seams between neighbouring patches.
+    With 'average' blending all voxels have the same weight, i.e. overlapping patches are averaged.
+
+    Args:
+        patch_shape (tuple[int, int, int]): Shape of the patch (without halo).
+        blending (str): Either 'gaussian' or 'average'. Defaults to 'gaussian'.
+        sigma_scale (float): Standard deviation of the gaussian relative to the patch size. Defaults to 1/8.
+        min_weight (float): Lower bound of the weights, so that every voxel of a patch contributes. Defaults to 1e-4.
+        device (str): Device where the window is allocated.
+
+    Returns:
+        torch.Tensor: The (Z, Y, X) window, with maximum weight 1.
+    """
+    if blending not in SUPPORTED_BLENDING:
+        raise ValueError(f'Unsupported blending {blending}, must be one of {SUPPORTED_BLENDING}')
+
+    window = torch.ones(tuple(patch_shape), dtype=torch.float32, device=device)
+    if blending == 'average':
+        return window
+
+    for axis, size in enumerate(patch_shape):
+        coords = torch.arange(size, dtype=torch.float32, device=device) - (size - 1) / 2
+        sigma = max(size * sigma_scale, 1e-6)
+        weights = torch.exp(-(coords**2) / (2 * sigma**2))
+        shape = [1, 1, 1]
+        shape[axis] = size
+        window = window * (weights / weights.max()).view(shape)
+    return window.clamp_min(min_weight)
+
+
+class PatchAccumulator:
+    """Blend the patch predictions into the prediction maps, one z-slab at a time.
+
+    Patches are weighted by a precomputed `blending_window` and scatter-added, a whole batch at a time,
+    into a device buffer spanning only the z-range of the patches currently processed. Patches must come
+    ordered along z (as produced by `SliceBuilder`): once a patch starting at `z` is received, the voxels
+    above `z` are final, so they are normalized by the accumulated weights and copied to `sink`.
+    On CUDA devices the copy is asynchronous and overlaps with the following forward passes.
+    Voxels not covered by any patch, e.g. of the patches skipped by a `ForegroundSliceBuilder`, are set to
+    `fill_value`.
+    The patches are blended in float32, the finished slabs are converted to the dtype of `sink` only when written,
+    e.g. float16 or quantized uint8/uint16 (see `to_compact_dtype`) for compact prediction maps.
+
+    Args:
+        sink: Array-like of shape (C, Z, Y, X) supporting numpy slicing assignment (np.ndarray, h5py.Dataset,
+            zarr.Array) where the finished slabs are written.
+        device (str): Device where the accumulation buffer is allocated.
+        blending (str): Blending mode, see `blending_window`. Defaults to 'gaussian'.
+        fill_value (float): Value of the voxels not covered by any patch. Defaults to 0.
+    """
+
+    def __init__(self, sink, device: str, blending: str = 'gaussian', fill_value: float = 0.0):
+        if blending not in SUPPORTED_BLENDING:
+            raise ValueError(f'Unsupported blending {blending}, must be one of {SUPPORTED_BLENDING}')
+        self.sink = sink
+        self.device = torch.device(device)
+        self.blending = blending
+        self.fill_value = fill_value
+        self.out_channels, self.size_z, self.size_y, self.size_x = sink.shape
+
+        # the window and the voxel offsets are computed once the patch shape is known
+        self.patch_shape = None
+        self.window = None
+        self._offsets = None
+
+        # accumulation buffer, starting at z = `z0` and spanning only the rows of patches being processed
+        self.z0 = 0
+        self._prediction = torch.zeros(
+            (self.out_channels, 0, self.size_y, self.size_x), dtype=torch.float32, device=self.device
+        )
+        self._weights = torch.zeros((0, self.size_y, self.size_x), dtype=torch.float32, device=self.device)
+        self._pending = []
+
+    def _set_patch_shape(self, patch_shape: tuple[int, int, int]) -> None:
+        self.patch_shape = patch_shape
+        self.window = blending_window(patch_shape, self.blending, device=self.device)
+
+        # offsets of the patch voxels in the flattened buffer, independent of the buffer depth
+        k_z, k_y, k_x = patch_shape
+        plane = self.size_y * self.size_x
+        max_index = self.out_channels * 2 * k_z * plane
+        index_dtype = torch.int64 if max_index > torch.iinfo(torch.int32).max else torch.int32
+        grid_z, grid_y, grid_x = torch.meshgrid(
+            torch.arange(k_z, device=self.device),
+            torch.arange(k_y, device=self.device),
+            torch.arange(k_x, device=self.device),
+            indexing='ij',
+        )
+        self._offsets = (grid_z * plane + grid_y * self.size_x + grid_x).flatten().to(index_dtype)
+
+    def add(self, predictions: torch.Tensor, indices) -> None:
+        """Accumulate a batch of patch predictions.
+
+        Args:
+            predictions (torch.Tensor): Batch of predictions of shape (B, C, Z, Y, X) without halo.
+            indices (list): The (z, y, x) slices of each patch in the prediction maps.
+        """
+        origins = torch.tensor([[index[i].start for i in range(3)] for index in indices], dtype=torch.int64)
+        if self.patch_shape is None:
+            self._set_patch_shape(tuple(predictions.shape[2:]))
+        if tuple(predictions.shape[2:]) != self.patch_shape:
+            raise ValueError(f'Expected patches of shape {self.patch_shape}, got {tuple(predictions.shape[2:])}')
+        if origins[0, 0] < self.z0 or bool((origins[1:, 0] < origins[:-1, 0]).any()):
+            raise RuntimeError('Patches must be ordered along the z-axis.')
+
+        # a batch can span several rows of patches, finish the previous rows before adding the next
+        z_starts, counts = torch.unique_consecutive(origins[:, 0], return_counts=True)
+        start = 0
+        for z_start, count in zip(z_starts.tolist(), counts.tolist()):
+            self._flush(z_start)
+            self._add_row(predictions[start : start + count], origins[start : start + count])
+            start += count
+        self._write_pending(block=False)
+
+    def close(self) -> None:
+        """Flush the remaining slabs and wait until all of them are written into the sink."""
+        self._flush(self.size_z)
+        self._write_pending(block=True)
+
+    def finished_z(self) -> int:
+        """The z up to which the predictions in the sink are final."""
+        self._write_pending(block=False)
+        return self._pending[0][2] if self._pending else self.z0
+
+    def _add_row(self, predictions: torch.Tensor, origins: torch.Tensor) -> None:
+        self._ensure_depth(int(origins[:, 0].max()) + self.patch_shape[0])
+
+        origins = origins.to(self.device)
+        base = (origins[:, 0] - self.z0) * self.size_y * self.size_x + origins[:, 1] * self.size_x + origins[:, 2]
+        index = (base.to(self._offsets.dtype)[:, None] + self._offsets[None, :]).flatten()
+        channel_stride = self._weights.numel()
+        channel_index = torch.arange(self.out_channels, device=self.device, dtype=index.dtype) * channel_stride
+        channel_index = (channel_index[:, None] + index[None, :]).flatten()
+
+        # scatter-add along a single flat dimension, which is much faster than along an inner one
+        batch_size = predictions.shape[0]
+        weighted = predictions.to(device=self.device, dtype=torch.float32) * self.window
+        weighted = weighted.transpose(0, 1).flatten()
+        self._prediction.view(-1).index_add_(0, channel_index, weighted)
+        self._weights.view(-1).index_add_(0, index, self.window.flatten().repeat(batch_size))
+
+    def _ensure_depth(self, z_stop: int) -> None:
+        missing = z_stop - self.z0 - self._weights.shape[0]
+        if missing > 0:
+            zeros = torch.zeros((missing, self.size_y, self.size_x), dtype=torch.float32, device=self.device)
+            self._weights = torch.cat([self._weights, zeros])
+            self._prediction = torch.cat([self._prediction, zeros.expand(self.out_channels, -1, -1, -1)], dim=1)
+
+    def _flush(self, z_stop: int) -> None:
+        z_stop = min(z_stop, self.size_z)
+        depth = min(z_stop - self.z0, self._weights.shape[0])
+        if depth > 0:
+            weights = self._weights[:depth]
+            slab = self._prediction[:, :depth] / weights.clamp_min(1e-12)
+            slab = torch.where(weights > 0, slab, torch.full_like(slab, self.fill_value))
+            if self.device.type == 'cuda':
+                host = torch.empty(slab.shape, dtype=slab.dtype, pin_memory=True)
+                host.copy_(slab, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+                self._pending.append((event, host, self.z0))
+            else:
+                self._pending.append((None, slab.cpu(), self.z0))
+
+        if depth == self._weights.shape[0]:
+            # the whole buffer is finished, skip to `z_stop` filling the slices not covered by any patch
+            self._fill(self.z0 + depth, z_stop)
+            self._prediction = self._prediction[:, :0]
+            self._weights = self._weights[:0]
+            self.z0 = max(self.z0, z_stop)
+        elif depth > 0:
+            # shift the buffer by the finished slab
+            self._prediction = torch.roll(self._prediction, -depth, dims=1)
+            self._prediction[:, -depth:] = 0
+            self._weights = torch.roll(self._weights, -depth, dims=0)
+            self._weights[-depth:] = 0
+            self.z0 += depth
+
+    def _fill(self, z_start: int, z_stop: int) -> None:
+        # the slabs are written in z order, as required by sinks receiving them in order (e.g. `RescaledSink`)
+        if z_start < z_stop:
+            self._write_pending(block=True)
+        step = self.patch_shape[0] if self.patch_shape is not None else 1
+        for z in range(z_start, z_stop, step):
+            z_end = min(z + step, z_stop)
+            shape = (self.out_channels, z_end - z, self.size_y, self.size_x)
+            self.sink[:, z:z_end] = to_compact_dtype(np.full(shape, self.fill_value, dtype='float32'), self.sink.dtype)
+
+    def _write_pending(self, block: bool) -> None:
+        while self._pending:
+            event, host, z_start = self._pending[0]
+            if event is not None:
+                if not block and not event.query():
+                    return
+                event.synchronize()
+            slab = host.numpy()
+            self.sink[:, z_start : z_start + slab.shape[1]] = to_compact_dtype(slab, self.sink.dtype)
+            self._pending.pop(0)
@@ -0,0 +1,52 @@
+"""Affinities of the embeddings predicted by the `is_embedding` models."""
+
+import torch
+
+
+def _offset_indices(shape: tuple, offset: tuple, device) -> list:
+    """Indices along each spatial axis of the voxels at `offset`, clamped to the borders (i.e. replication padding)."""
+    indices = []
+    for axis, (size, off) in enumerate(zip(shape, offset)):
+        if off != 0:
+            index = torch.clamp(torch.arange(size, device=device) + off, 0, size - 1)
+            indices.append((axis, index))
+    return indices
+
+
+@torch.no_grad()
+def embeddings_to_affinities(embeddings: torch.Tensor, offsets: list, delta: float) -> torch.Tensor:
+    """Transform the predicted embeddings to affinities, for inference only.
+
+    The affinity of a voxel for an offset is computed from the euclidean distance between its embedding and the
+    embedding of the voxel at the offset, the voxels outside the volume being replaced by the closest border voxel.
+    The distances are accumulated one offset and one embedding channel at a time into the output, so apart from the
+    affinities only a few single-channel temporaries are allocated, instead of a shifted copy of the embeddings per
+    offset. The temporaries are modified in place, so no gradients are computed, see
+    `plantseg.training.embeddings.embeddings_to_affinities` for the differentiable version.
+
+    Args:
+        embeddings (torch.Tensor): Embeddings of shape (B, C, Y, X) or (B, C, Z, Y, X).
+        offsets (list): The 2D or 3D offsets of the affinities.
+        delta (float): The distance at which the affinity drops to 0 is `2 * delta`.
+
+    Returns:
+        torch.Tensor: The affinities of shape (B, len(offsets), Y, X) or (B, len(offsets), Z, Y, X), in [0, 1].
+    """
+    spatial_shape = tuple(embeddings.shape[2:])
+    affs = embeddings.new_empty((embeddings.shape[0], len(offsets)) + spatial_shape)
+    for k, offset in enumerate(offsets):
+        assert len(offset) == len(spatial_shape)
+        indices = _offset_indices(spatial_shape, offset, embeddings.device)
+        distance = affs[:, k]
+        distance.zero_()
+        for c in range(embeddings.shape[1]):
+            channel = embeddings[:, c]
+            shifted = channel
+            for axis, index in indices:
+                # the batch axis comes first
+                shifted = shifted.index_select(axis + 1, index)
+            diff = channel - shifted
+            distance.add_(diff.square_())
+        # transform the distance to affinities based on the delta distance
+        distance.sqrt_().neg_().add_(2 * delta).div_(2 * delta).clamp_(min=0).square_()
+    return affs
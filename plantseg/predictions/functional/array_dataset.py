@@ -58,6 +58,35 @@ def mirror_pad(image: np.ndarray, padding_shape: tuple[int, int, int], multichan
     return np.pad(image, pad_width, mode='reflect')
 
 
+def read_padded_patch(raw, raw_idx: tuple[slice, ...], halo_shape: tuple[int, ...]) -> np.ndarray:
+    """
+    Read a patch and its halo from `raw` without padding the whole volume.
+
+    Only the part of the halo which lies inside the volume is read from `raw`, the part that falls
+    outside is synthesized by mirror padding the patch, which gives the same result as reading the
+    patch from `mirror_pad(raw, halo_shape)`. This works with any array-like supporting numpy
+    slicing, e.g. `h5py.Dataset` or `zarr.Array`.
+
+    Args:
+        raw: The input volume of shape (Z, Y, X) or (C, Z, Y, X).
+        raw_idx (tuple of slice): The position of the patch in `raw`, without halo.
+        halo_shape (tuple of int): The halo for each dimension of `raw_idx` (0 for the channel dimension).
+
+    Returns:
+        np.ndarray: The patch including its halo.
+    """
+    read_idx, pad_width = [], []
+    for index, halo, size in zip(raw_idx, halo_shape, raw.shape):
+        start, stop = index.start - halo, index.stop + halo
+        read_idx.append(slice(max(start, 0), min(stop, size)))
+        pad_width.append((max(-start, 0), max(stop - size, 0)))
+
+    patch = raw[tuple(read_idx)]
+    if any(p != (0, 0) for p in pad_width):
+        patch = np.pad(patch, pad_width, mode='reflect')
+    return patch
+
+
 def remove_padding(m, padding_shape):
     """
     Removes padding from the margins of a multi-dimensional array.
@@ -93,13 +122,18 @@ class ArrayDataset(Dataset):
         halo_shape: Optional[Tuple[int, int, int]] = None,
         multichannel: bool = False,
         verbose_logging: bool = True,
+        streaming: bool = True,
     ):
         """
         Args:
-            raw (np.ndarray): raw data
+            raw (np.ndarray): raw data, either in memory (np.ndarray, np.memmap) or on disk (h5py.Dataset, zarr.Array)
             slice_builder (SliceBuilder): slice builder
             augs (Callable): data augmentation pipeline
             verbose_logging (bool): if True, log info messages
+            streaming (bool): if True, each patch and its halo are read directly from `raw` and the mirror padding
+                is synthesized only for the patches touching the volume border. If False, the whole `raw` is
+                mirror padded up front, which requires a second full-size copy of the input. On-disk arrays
+                are always streamed.
         """
         self.raw = raw
         self.augs = augs
@@ -108,7 +142,11 @@ class ArrayDataset(Dataset):
         if halo_shape is None:
             halo_shape = (0, 0, 0)
         self.halo_shape = halo_shape
-        self.raw_padded = mirror_pad(self.raw, self.halo_shape, multichannel)
+        # on-disk arrays are never loaded as a whole, patches and their halo are read lazily
+        if streaming or not isinstance(raw, np.ndarray):
+            self.raw_padded = None
+        else:
+            self.raw_padded = mirror_pad(self.raw, self.halo_shape, multichannel)
 
         if verbose_logging:
             gui_logger.info(f'Number of patches: {len(self.raw_slices)}')
@@ -126,10 +164,13 @@ class ArrayDataset(Dataset):
             halo_shape
         ), f"raw_idx {len(raw_idx)} and halo_shape {len(halo_shape)} must have the same length."
 
-        raw_idx_padded = tuple(
-            slice(index.start, index.stop + 2 * halo, None) for index, halo in zip(raw_idx, halo_shape)
-        )
-        raw_patch = self.raw_padded[raw_idx_padded]
+        if self.raw_padded is None:
+            raw_patch = read_padded_patch(self.raw, raw_idx, halo_shape)
+        else:
+            raw_idx_padded = tuple(
+                slice(index.start, index.stop + 2 * halo, None) for index, halo in zip(raw_idx, halo_shape)
+            )
+            raw_patch = self.raw_padded[raw_idx_padded]
         raw_patch_transformed = self.augs(raw_patch)
 
         # discard the channel dimension in the slices: predictor requires only the spatial dimensions of the volume
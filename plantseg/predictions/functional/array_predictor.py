@@ -1,21 +1,45 @@
+from typing import Optional
+
 import numpy as np
 import torch
 import tqdm
 from torch import nn
 from torch.utils.data import DataLoader, Dataset
 
-from plantseg.training.embeddings import embeddings_to_affinities
 from plantseg.training.model import UNet2D
 from plantseg.pipeline import gui_logger
+from plantseg.predictions.functional.accumulator import PatchAccumulator
+from plantseg.predictions.functional.affinities import embeddings_to_affinities
 from plantseg.predictions.functional.array_dataset import ArrayDataset, default_prediction_collate, remove_padding
+from plantseg.predictions.functional.compiled_model import CompiledModel
+from plantseg.predictions.functional.memory_model import available_memory, get_memory_model, max_batch_size
+from plantseg.predictions.functional.patch_cache import PatchCache, model_digest
+from plantseg.predictions.functional.slice_loader import SliceLoader, is_slice_dataset
+
+
+SUPPORTED_PRECISIONS = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}
+SUPPORTED_OUTPUT_DTYPES = ['float32', 'float16', 'uint16', 'uint8']
+PRECISION_TOLERANCE = 0.05  # maximum absolute error of the reduced precision predictions on the calibration patch
 
 
 def _is_2d_model(model: nn.Module) -> bool:
     if isinstance(model, nn.DataParallel):
         model = model.module
+    if isinstance(model, CompiledModel):
+        model = model.module
     return isinstance(model, UNet2D)
 
 
+def model_input_shape(
+    model: nn.Module, patch_shape: tuple[int, int, int], patch_halo: tuple[int, int, int]
+) -> tuple[int, ...]:
+    """Spatial shape of the model input: the patch with its halo, without the z-axis for 2D models."""
+    actual_patch_shape = tuple(patch_shape[i] + 2 * patch_halo[i] for i in range(3))
+    if _is_2d_model(model):
+        return actual_patch_shape[1:]
+    return actual_patch_shape
+
+
 def find_batch_size(
     model: nn.Module,
     in_channels: int,
@@ -23,7 +47,11 @@ def find_batch_size(
     patch_halo: tuple[int, int, int],
     device: str,
 ) -> int:
-    """Determine the maximum feasible batch size for a given model based on available GPU memory.
+    """Determine the maximum feasible batch size for a given model based on available device memory.
+
+    The memory used by the model is measured once per architecture, input shape, dtype and device, and cached in
+    `~/.plantseg_models` (see `plantseg.predictions.functional.memory_model`), the batch size is then computed
+    from the currently available GPU memory, or host memory for `device='cpu'`.
 
     Args:
         model (nn.Module): The model to be used for predictions.
@@ -35,36 +63,15 @@ def find_batch_size(
     Returns:
         int: The largest batch size that can be used without causing memory overflow.
     """
-    if device == 'cpu':
-        return 1
-
-    actual_patch_shape = tuple(patch_shape[i] + 2 * patch_halo[i] for i in range(3))
-    if isinstance(model, UNet2D):
-        actual_patch_shape = actual_patch_shape[1:]
-
-    model = model.to(device)
-    model.eval()
-    with torch.no_grad():
-        for batch_size in [1, 2, 4, 8, 16, 32, 64, 128]:
-            try:
-                x = torch.randn((batch_size, in_channels) + actual_patch_shape).to(device)
-                _ = model(x)
-            except RuntimeError as e:
-                if 'out of memory' in str(e):
-                    batch_size //= 2
-                    break
-                else:
-                    raise
-            finally:
-                del x
-                torch.cuda.empty_cache()
+    memory_model = get_memory_model(model, in_channels, model_input_shape(model, patch_shape, patch_halo), device)
+    batch_size = max_batch_size(memory_model, available_memory(device))
+    if batch_size == 0 and device == 'cpu':
+        batch_size = 1  # the host memory model is an upper bound, a single sample is always attempted
     if batch_size == 0:
         raise RuntimeError(
             f'Could not determine a feasible batch size for patch size {patch_shape} and halo {patch_halo}. '
             'Please reduce the patch size.'
         )
-    del model
-    torch.cuda.empty_cache()
     return batch_size
 
 
@@ -78,6 +85,8 @@ def will_CUDA_OOM(
 ) -> bool:
     """Determine if a given batch size will cause an out-of-memory (OOM) error on the specified device.
 
+    Uses the cached memory model of `find_batch_size` instead of a trial forward pass.
+
     Args:
         model (nn.Module): The model to be used for predictions.
         in_channels (int): Number of input channels to the model.
@@ -92,34 +101,31 @@ def will_CUDA_OOM(
     if device == 'cpu':
         return False  # CPU does not have CUDA OOM errors
 
-    # Calculate the actual patch shape including the halo
-    actual_patch_shape = tuple(patch_shape[i] + 2 * patch_halo[i] for i in range(3))
+    memory_model = get_memory_model(model, in_channels, model_input_shape(model, patch_shape, patch_halo), device)
+    OOM_error = max_batch_size(memory_model, available_memory(device)) < batch_size
+    if OOM_error:
+        print(f'Using patch shape {patch_shape}, halo {patch_halo}, and batch size {batch_size} will cause OOM.')
+    return OOM_error
 
-    # If the model is a 2D UNet, adjust the patch shape to 2D
-    if isinstance(model, UNet2D):
-        actual_patch_shape = actual_patch_shape[1:]
 
-    model = model.to(device)
-    model.eval()
+def tta_transforms(square: bool) -> list[tuple[int, bool]]:
+    """Test-time augmentation variants as (number of 90 degrees rotations in the YX plane, flip along X).
 
-    OOM_error = False
-    x = None
-    try:
-        with torch.no_grad():
-            x = torch.randn((batch_size, in_channels) + actual_patch_shape).to(device)
-            _ = model(x)
-    except RuntimeError as e:
-        if 'out of memory' in str(e):
-            OOM_error = True
-            print(f'Using patch shape {patch_shape}, halo {patch_halo}, and batch size {batch_size} will cause OOM.')
-        else:
-            raise  # Re-raise if it's not an OOM error
-    finally:
-        del x
-        del model
-        torch.cuda.empty_cache()
+    All the 8 symmetries of the square are used if the patches are square in YX, otherwise only the 4 flips
+    along Y and X (i.e. rotations by 0 and 180 degrees, with and without flip), which keep the patch shape.
+    """
+    rotations = (0, 1, 2, 3) if square else (0, 2)
+    return [(k, flip) for k in rotations for flip in (False, True)]
 
-    return OOM_error
+
+def _apply_tta(x: torch.Tensor, k: int, flip: bool) -> torch.Tensor:
+    x = torch.rot90(x, k, dims=(-2, -1))
+    return torch.flip(x, dims=(-1,)) if flip else x
+
+
+def _invert_tta(x: torch.Tensor, k: int, flip: bool) -> torch.Tensor:
+    x = torch.flip(x, dims=(-1,)) if flip else x
+    return torch.rot90(x, -k, dims=(-2, -1))
 
 
 class ArrayPredictor:
@@ -128,7 +134,7 @@ class ArrayPredictor:
     This predictor applies a given model on a dataset and accumulates the results into numpy arrays.
     The predictions are computed in batches and memory utilization is carefully managed to fit
     within available system RAM. For large datasets that do not fit in memory, consider using
-    `LazyPredictor` instead.
+    `LazyPredictor` (see `plantseg.predictions.functional.lazy_predictor`) instead.
 
     Based on pytorch-3dunet StandardPredictor:
     https://github.com/wolny/pytorch-3dunet/blob/master/pytorch3dunet/unet3d/predictor.py
@@ -145,6 +151,26 @@ class ArrayPredictor:
         is_embedding (bool, optional): If True, convert model output to embeddings. Defaults to False.
         verbose_logging (bool, optional): If True, enable verbose logging. Defaults to False.
         disable_tqdm (bool, optional): If True, disable tqdm progress bars. Defaults to False.
+        blending (str, optional): How overlapping patches are combined, either 'gaussian' (patches weighted by
+            a gaussian window, down-weighting the patch borders) or 'average'. Defaults to 'gaussian'.
+        tta (bool, optional): If True, average the predictions of the flipped/rotated variants of every patch
+            (test-time augmentation). The variants are predicted in the same batches as extra samples, so the
+            number of patches per batch is divided by the number of variants. Defaults to False.
+        precision (str, optional): 'float32', or 'bfloat16'/'float16' to run the model under autocast with
+            channels-last memory format (e.g. bfloat16 for CPU inference). The reduced precision predictions of
+            the first patch are compared with float32, if the error exceeds `PRECISION_TOLERANCE` the predictor
+            falls back to float32. Defaults to 'float32'.
+        fill_value (float, optional): Value of the voxels not covered by any patch, e.g. of the patches skipped by a
+            `ForegroundSliceBuilder`. Defaults to 0.
+        patch_cache (PatchCache, optional): Disk cache of the patch predictions, patches predicted before with the
+            same model and settings are loaded instead of predicted. Defaults to None (no cache).
+        output_dtype (str, optional): dtype of the prediction maps, 'float32', or 'float16'/'uint16'/'uint8' for
+            compact prediction maps taking 2x-4x less memory. The patches are still blended in float32, integer maps
+            store the predictions (between 0 and 1) quantized over the full range of the dtype, see
+            `to_compact_dtype`. Defaults to 'float32'.
+
+    The patches of a single z-slice without z-halo, as used by 2D models, are batched by a `SliceLoader`, which reads
+    and normalizes every z-slice once instead of every patch.
 
     Attributes:
         batch_size (int): Calculated batch size based on device capabilities and model requirements.
@@ -155,6 +181,12 @@ class ArrayPredictor:
         verbose_logging (bool): Flag to enable detailed logging.
         disable_tqdm (bool): Flag to disable tqdm progress bars during prediction.
         is_embedding (bool): Flag to determine if the output should be treated as embeddings.
+        blending (str): Blending mode of overlapping patches, see `PatchAccumulator`.
+        tta_transforms (list): The test-time augmentation variants, see `tta_transforms`, empty if disabled.
+        precision (str): Precision used for the forward passes.
+        fill_value (float): Value of the voxels not covered by any patch.
+        patch_cache (PatchCache): Disk cache of the patch predictions, None if disabled.
+        output_dtype (str): dtype of the prediction maps.
     """
 
     def __init__(
@@ -170,7 +202,17 @@ class ArrayPredictor:
         is_embedding: bool = False,
         verbose_logging: bool = False,
         disable_tqdm: bool = False,
+        blending: str = 'gaussian',
+        tta: bool = False,
+        precision: str = 'float32',
+        fill_value: float = 0.0,
+        patch_cache: Optional[PatchCache] = None,
+        output_dtype: str = 'float32',
     ):
+        if precision not in SUPPORTED_PRECISIONS:
+            raise ValueError(f'Unsupported precision {precision}, must be one of {list(SUPPORTED_PRECISIONS)}')
+        if output_dtype not in SUPPORTED_OUTPUT_DTYPES:
+            raise ValueError(f'Unsupported output dtype {output_dtype}, must be one of {SUPPORTED_OUTPUT_DTYPES}')
         self.device = device
 
         if single_batch_mode:  # then check if OOM happens at batch size 1
@@ -200,97 +242,186 @@ class ArrayPredictor:
         self.verbose_logging = verbose_logging
         self.disable_tqdm = disable_tqdm
         self.is_embedding = is_embedding
+        self.blending = blending
+        self.fill_value = fill_value
+        self.patch_cache = patch_cache
+        self.output_dtype = output_dtype
+        padded_patch = [p + 2 * h for p, h in zip(patch, patch_halo)]
+        self.tta_transforms = tta_transforms(padded_patch[1] == padded_patch[2]) if tta else []
+        if tta:
+            gui_logger.info(f'Using test-time augmentation with {len(self.tta_transforms)} variants per patch')
+
+        self.precision = precision
+        self._calibrated = precision == 'float32'
+        if precision != 'float32':
+            gui_logger.info(f'Using {precision} precision for prediction')
 
     def __call__(self, test_dataset: Dataset) -> np.ndarray:
-        assert isinstance(test_dataset, ArrayDataset), 'Dataset must be an instance of ArrayDataset'
-        assert (
-            self.patch_halo == test_dataset.halo_shape
-        ), f'Predictor halo shape {self.patch_halo} does not match dataset halo shape {test_dataset.halo_shape}'
-
-        test_loader = DataLoader(
-            test_dataset,
-            batch_size=self.batch_size,
-            pin_memory=True,
-            collate_fn=default_prediction_collate,
-        )
+        test_loader = self.data_loader(test_dataset)
 
         if self.verbose_logging:
             gui_logger.info(f'Running prediction on {len(test_loader)} batches')
 
         # dimensionality of the output predictions
-        volume_shape = self.volume_shape(test_dataset)
-        is_2d_model = _is_2d_model(self.model)
-        if self.is_embedding:
-            if is_2d_model:
-                # outputs 1-affinities in XY
-                out_channels = 2
-            else:
-                # outputs 1-affinities in XYZ
-                out_channels = 3
-        else:
-            out_channels = self.out_channels
-
-        prediction_maps_shape = (out_channels,) + volume_shape
+        out_channels = self.output_channels()
+        prediction_maps_shape = (out_channels,) + self.volume_shape(test_dataset)
 
         if self.verbose_logging:
             gui_logger.info(f'The shape of the output prediction maps (CDHW): {prediction_maps_shape}')
             gui_logger.info(f'Using patch_halo: {self.patch_halo}')
-            # allocate prediction and normalization arrays
-            gui_logger.info('Allocating prediction and normalization arrays...')
+            gui_logger.info('Allocating prediction array...')
+
+        # initialize the output prediction array, overlapping patches are blended on the device
+        prediction_map = np.zeros(prediction_maps_shape, dtype=self.output_dtype)
+        accumulator = PatchAccumulator(prediction_map, self.device, blending=self.blending, fill_value=self.fill_value)
+        self.accumulate(test_loader, accumulator)
 
-        # initialize the output prediction arrays
-        prediction_map = np.zeros(prediction_maps_shape, dtype='float32')
-        # initialize normalization mask in order to average out probabilities of overlapping patches
-        normalization_mask = np.zeros(prediction_maps_shape, dtype='uint8')
+        if self.verbose_logging:
+            gui_logger.info('Prediction finished')
 
-        # run prediction
+        return prediction_map
+
+    def accumulate(self, test_loader: DataLoader, accumulator: PatchAccumulator) -> None:
+        """Run the model on all the batches of `test_loader` and blend the predictions with `accumulator`."""
         # Sets the module in evaluation mode explicitly
         # It is necessary for batchnorm/dropout layers if present as well as final Sigmoid/Softmax to be applied
         self.model.eval()
-        # Run predictions on the entire input dataset
-
         with torch.no_grad():
             for input_, indices in tqdm.tqdm(test_loader, disable=self.disable_tqdm):
-                input_ = input_.to(self.device)  # input is padded with halo in dataset __getitem__
-                # forward pass
-                if is_2d_model:
-                    # remove the singleton z-dimension from the input
-                    input_ = torch.squeeze(input_, dim=-3)
-                    prediction = self.model(input_)
-                    # add the singleton z-dimension to the output
-                    prediction = torch.unsqueeze(prediction, dim=-3)
-                else:
-                    prediction = self.model(input_)
-
-                if self.is_embedding:
-                    if is_2d_model:
-                        offsets = [[-1, 0], [0, -1]]
-                    else:
-                        offsets = [[-1, 0, 0], [0, -1, 0], [0, 0, -1]]
-                    # convert embeddings to affinities
-                    prediction = embeddings_to_affinities(prediction, offsets, delta=0.5)
-                    # average across channels and invert (i.e. 1-affinities)
-                    prediction = 1 - prediction.mean(dim=1)
-                # removing halo from the prediction
-                prediction = remove_padding(prediction, self.patch_halo)
-                # convert to numpy array
-                prediction = prediction.cpu().numpy()
-
-                channel_slice = slice(0, out_channels)
-                # for each batch sample
-                for pred, index in zip(prediction, indices):
-                    # add channel dimension to the index
-                    index = (channel_slice,) + tuple(index)
-                    # accumulate probabilities into the output prediction array
-                    prediction_map[index] += pred
-                    # count voxel visits for normalization
-                    normalization_mask[index] += 1
+                accumulator.add(self.predict_batch(input_), indices)
+        accumulator.close()
+        if self.patch_cache is not None:
+            self.patch_cache.log_statistics()
 
-        if self.verbose_logging:
-            gui_logger.info('Prediction finished')
+    def data_loader(self, test_dataset: Dataset) -> DataLoader:
+        """The batches of the patches of `test_dataset`, to be predicted with `accumulate`."""
+        assert isinstance(test_dataset, ArrayDataset), 'Dataset must be an instance of ArrayDataset'
+        assert (
+            self.patch_halo == test_dataset.halo_shape
+        ), f'Predictor halo shape {self.patch_halo} does not match dataset halo shape {test_dataset.halo_shape}'
+
+        if is_slice_dataset(test_dataset):
+            # 2D tiling, the tiles of every z-slice are cut from the slice read and normalized once
+            return SliceLoader(test_dataset, self._loader_batch_size(), pin_memory=True)
+        return DataLoader(
+            test_dataset,
+            batch_size=self._loader_batch_size(),
+            pin_memory=True,
+            collate_fn=default_prediction_collate,
+        )
+
+    def _loader_batch_size(self) -> int:
+        # with test-time augmentation every patch is predicted once per variant in the same batch
+        return max(self.batch_size // max(len(self.tta_transforms), 1), 1)
 
-        # normalize results and return
-        return prediction_map / normalization_mask
+    def output_channels(self) -> int:
+        """Number of channels of the prediction maps returned by the predictor."""
+        if self.is_embedding:
+            # outputs 1-affinities in XY for 2D models and in XYZ for 3D models
+            return 2 if _is_2d_model(self.model) else 3
+        return self.out_channels
+
+    def predict_batch(self, input_: torch.Tensor) -> torch.Tensor:
+        """Run the model on a batch of halo-padded patches and return the predictions with the halo removed.
+
+        Args:
+            input_ (torch.Tensor): Batch of patches of shape (B, C, Z, Y, X), padded with `patch_halo`.
+
+        Returns:
+            torch.Tensor: Predictions of shape (B, C_out, Z, Y, X) on `self.device`, without the halo.
+        """
+        if self.patch_cache is not None:
+            return self._predict_cached(input_)
+        return self._predict_batch(input_)
+
+    def _predict_batch(self, input_: torch.Tensor) -> torch.Tensor:
+        input_ = input_.to(self.device)  # input is padded with halo in dataset __getitem__
+        if not self._calibrated:
+            self._calibrate(input_[:1])
+        if self.tta_transforms:
+            prediction = self._predict_tta(input_)
+        else:
+            prediction = self._predict(input_)
+        # removing halo from the prediction
+        return remove_padding(prediction, self.patch_halo)
+
+    def _predict_cached(self, input_: torch.Tensor) -> torch.Tensor:
+        """`predict_batch` loading the patches cached in `patch_cache` and predicting only the others."""
+        if not self._calibrated:  # the precision used for the predictions is part of the cache key
+            self._calibrate(input_[:1].to(self.device))
+        settings = (model_digest(self.model), self.precision, self.tta_transforms, self.is_embedding, self.patch_halo)
+        keys = [self.patch_cache.key(str(settings), patch) for patch in input_]
+        cached = [self.patch_cache.get(key) for key in keys]
+
+        missing = [i for i, prediction in enumerate(cached) if prediction is None]
+        if missing:
+            predictions = self._predict_batch(input_[missing]).cpu()
+            for i, prediction in zip(missing, predictions):
+                cached[i] = prediction.numpy()
+                self.patch_cache.put(keys[i], cached[i])
+        return torch.from_numpy(np.stack(cached)).to(self.device)
+
+    def _memory_format(self) -> torch.memory_format:
+        return torch.channels_last if _is_2d_model(self.model) else torch.channels_last_3d
+
+    def _forward(self, input_: torch.Tensor) -> torch.Tensor:
+        if self.precision == 'float32':
+            return self.model(input_)
+        # channels-last is the layout of the fast reduced precision convolution kernels, which a channels-last input
+        # selects without converting the weights of the model, possibly shared with other predictors
+        input_ = input_.contiguous(memory_format=self._memory_format())
+        device_type = torch.device(self.device).type
+        with torch.autocast(device_type=device_type, dtype=SUPPORTED_PRECISIONS[self.precision]):
+            prediction = self.model(input_)
+        return prediction.float().contiguous()
+
+    def _calibrate(self, input_: torch.Tensor) -> None:
+        """Compare the reduced precision predictions of a patch with float32, fall back to float32 if inaccurate."""
+        precision = self.precision
+        prediction = self._predict(input_)
+        self.precision = 'float32'
+        error = (prediction - self._predict(input_)).abs().max().item()
+        self._calibrated = True
+        if error > PRECISION_TOLERANCE:
+            gui_logger.warning(
+                f'Predictions in {precision} differ from float32 by up to {error:.3g} on the calibration patch, '
+                'falling back to float32 precision'
+            )
+            return
+        gui_logger.info(f'Predictions in {precision} differ from float32 by up to {error:.3g}')
+        self.precision = precision
+
+    def _predict(self, input_: torch.Tensor) -> torch.Tensor:
+        # forward pass
+        if _is_2d_model(self.model):
+            # remove the singleton z-dimension from the input
+            input_ = torch.squeeze(input_, dim=-3)
+            prediction = self._forward(input_)
+            # add the singleton z-dimension to the output
+            prediction = torch.unsqueeze(prediction, dim=-3)
+        else:
+            prediction = self._forward(input_)
+
+        if self.is_embedding:
+            if _is_2d_model(self.model):
+                offsets = [[-1, 0], [0, -1]]
+            else:
+                offsets = [[-1, 0, 0], [0, -1, 0], [0, 0, -1]]
+            # convert embeddings to affinities
+            prediction = embeddings_to_affinities(prediction, offsets, delta=0.5)
+            # average across channels and invert (i.e. 1-affinities), repeated for every output channel
+            prediction = 1 - prediction.mean(dim=1, keepdim=True)
+            prediction = prediction.expand(-1, self.output_channels(), -1, -1, -1)
+        return prediction
+
+    def _predict_tta(self, input_: torch.Tensor) -> torch.Tensor:
+        """Predict all the test-time augmentation variants of the batch, in chunks of `batch_size` samples."""
+        variants = torch.cat([_apply_tta(input_, k, flip) for k, flip in self.tta_transforms])
+        predictions = torch.cat([self._predict(chunk) for chunk in torch.split(variants, self.batch_size)])
+
+        predictions = torch.split(predictions, input_.shape[0])
+        inverted = [_invert_tta(p, k, flip) for p, (k, flip) in zip(predictions, self.tta_transforms)]
+        return torch.stack(inverted).mean(dim=0)
 
     @staticmethod
     def volume_shape(dataset: Dataset) -> tuple[int, int, int]:
@@ -0,0 +1,202 @@
+"""Benchmark of the prediction throughput for a grid of patch shapes, batch sizes and strides."""
+
+import math
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+
+from plantseg.augment.transforms import get_test_augmentations
+from plantseg.dataprocessing.functional.dataprocessing import fix_input_shape_to_CZYX, fix_input_shape_to_ZYX
+from plantseg.models.zoo import model_zoo
+from plantseg.pipeline import gui_logger
+from plantseg.predictions.functional.array_dataset import read_padded_patch
+from plantseg.predictions.functional.array_predictor import ArrayPredictor, model_input_shape
+from plantseg.predictions.functional.memory_model import BATCH_SIZES, available_memory, get_memory_model
+from plantseg.predictions.functional.slice_builder import SliceBuilder
+from plantseg.predictions.functional.utils import get_patch_halo, get_stride_shape, small_overlap_axes
+
+PATCH_SIZES = (64, 96, 128, 160, 192, 256)
+STRIDE_RATIOS = (0.5, 0.625, 0.75)
+MIN_SPEEDUP = 1.05  # larger batch sizes are only tried while they increase the throughput by at least 5%
+
+
+def candidate_patch_shapes(volume_shape: tuple[int, int, int], is_2d: bool) -> list[tuple[int, int, int]]:
+    """Patch shapes of the benchmark grid fitting in `volume_shape`: square in YX, half as deep along z for 3D."""
+    _, size_y, size_x = volume_shape
+    shapes = []
+    for size in PATCH_SIZES:
+        depth = 1 if is_2d else min(size // 2, volume_shape[0])
+        shape = (depth, min(size, size_y), min(size, size_x))
+        if shape not in shapes:
+            shapes.append(shape)
+    return shapes
+
+
+def count_patches(volume_shape: tuple[int, int, int], patch: tuple[int, int, int], stride: tuple[int, int, int]) -> int:
+    """Number of patches of the `SliceBuilder` tiling of `volume_shape`."""
+    return math.prod(len(list(SliceBuilder._gen_indices(i, k, s))) for i, k, s in zip(volume_shape, patch, stride))
+
+
+def _time_batch(predictor: ArrayPredictor, batch: torch.Tensor, repeats: int) -> float:
+    """Median time of a forward pass of `batch`, after a warm-up pass."""
+    timings = []
+    with torch.no_grad():
+        for i in range(repeats + 1):
+            start = time.perf_counter()
+            predictor.predict_batch(batch)
+            if torch.device(predictor.device).type == 'cuda':
+                torch.cuda.synchronize(predictor.device)
+            if i > 0:
+                timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def autotune(
+    raw: np.ndarray,
+    model_name: Optional[str],
+    model_id: Optional[str] = None,
+    device: str = 'cuda',
+    patch_shapes: Optional[list[tuple[int, int, int]]] = None,
+    stride_ratios: tuple[float, ...] = STRIDE_RATIOS,
+    memory_cap: Optional[int] = None,
+    volume_shape: Optional[tuple[int, int, int]] = None,
+    repeats: int = 3,
+    model_update: bool = False,
+    config_path: Optional[Path] = None,
+    model_weights_path: Optional[Path] = None,
+    precision: str = 'float32',
+    **kwargs,
+) -> list[dict]:
+    """Benchmark the prediction throughput of a model for a grid of patch shapes, batch sizes and stride ratios.
+
+    Every patch shape is timed on a patch of the center of `raw` for the batch sizes fitting in `memory_cap`
+    according to the memory model of the model (see `plantseg.predictions.functional.memory_model`), doubling the
+    batch size while the throughput improves. The throughput of a configuration is the number of voxels of the
+    volume divided by the time to predict all its patches, so a smaller stride, i.e. more overlap, costs more forward
+    passes. Strides leaving too little overlap between the patches (see `check_patch_and_stride`) are not considered.
+    Only the center crop of `raw` holding the largest patch with its halo is read, so `raw` can be a lazily loaded
+    dataset (h5py.Dataset, zarr.Array).
+
+    Args:
+        raw (np.ndarray): Sample of the data to predict, (Z, Y, X) or (C, Z, Y, X) for multi-channel models.
+        model_name (str): The name of the model to use.
+        model_id (str, optional): BioImage.IO model id, see `unet_predictions`.
+        device (str, optional): The computation device ('cpu', 'cuda', etc.). Defaults to 'cuda'.
+        patch_shapes (list, optional): Patch shapes to benchmark. Defaults to `candidate_patch_shapes`.
+        stride_ratios (tuple[float, ...], optional): Stride ratios to benchmark. Defaults to (0.5, 0.625, 0.75).
+        memory_cap (int, optional): Memory available for the forward passes in bytes. Defaults to the memory
+            currently available on `device`.
+        volume_shape (tuple[int, int, int], optional): Shape of the volumes to predict, e.g. after rescaling.
+            Defaults to the shape of `raw`.
+        repeats (int, optional): Number of timed forward passes per configuration. Defaults to 3.
+        precision (str, optional): Precision of the forward passes, see `ArrayPredictor`. Defaults to 'float32'.
+
+    Returns:
+        list[dict]: The configurations sorted by decreasing throughput, with keys `patch`, `stride_ratio`,
+            `batch_size`, `seconds_per_batch` and `voxels_per_second`.
+    """
+    model, model_config, _ = model_zoo.load_model(
+        model_name=model_name,
+        model_id=model_id,
+        config_path=config_path,
+        model_weights_path=model_weights_path,
+        model_update=model_update,
+        device=device,
+    )
+    in_channels = int(model_config['in_channels'])
+    is_2d = model_config['name'] == 'UNet2D'
+    multichannel = in_channels > 1
+    raw = fix_input_shape_to_CZYX(raw) if multichannel else fix_input_shape_to_ZYX(raw)
+    spatial_shape = tuple(raw.shape[-3:])
+    volume_shape = tuple(spatial_shape if volume_shape is None else volume_shape)
+
+    patch_halo = tuple(kwargs['patch_halo'] if kwargs.get('patch_halo') is not None else get_patch_halo(model_name))
+    if memory_cap is None:
+        memory_cap = available_memory(device)
+    if patch_shapes is None:
+        patch_shapes = candidate_patch_shapes(spatial_shape, is_2d)
+    # only the center crop holding the largest patch with its halo is read and converted to float32
+    crop_shape = [
+        min(max(patch[axis] for patch in patch_shapes) + 2 * patch_halo[axis], size)
+        for axis, size in enumerate(spatial_shape)
+    ]
+    crop = tuple(slice((s - c) // 2, (s - c) // 2 + c) for s, c in zip(spatial_shape, crop_shape))
+    raw = np.asarray(raw[(slice(None),) * (raw.ndim - 3) + crop], dtype='float32')
+    augs = get_test_augmentations(None)  # the throughput does not depend on the normalization statistics
+
+    results = []
+    for patch in patch_shapes:
+        patch = tuple(patch)
+        if any(p > s for p, s in zip(patch, spatial_shape)):
+            gui_logger.warning(f'Patch {patch} is larger than the sample {spatial_shape}, skipping it')
+            continue
+
+        # strides with enough overlap, the axes covered by a single patch have no seams
+        strides = {}
+        for stride_ratio in stride_ratios:
+            stride = get_stride_shape(patch, stride_ratio)
+            tiled_axes = [axis for axis in range(3) if patch[axis] < volume_shape[axis]]
+            if not set(small_overlap_axes(patch, stride)) & set(tiled_axes):
+                strides[stride_ratio] = count_patches(volume_shape, patch, stride)
+        if not strides:
+            continue
+
+        memory_model = get_memory_model(model, in_channels, model_input_shape(model, patch, patch_halo), device)
+        if memory_model is None:
+            gui_logger.info(f'Patch {patch} with halo {patch_halo} does not fit on {device}')
+            continue
+
+        predictor = ArrayPredictor(
+            model=model,
+            in_channels=in_channels,
+            out_channels=model_config['out_channels'],
+            device=device,
+            patch=patch,
+            patch_halo=patch_halo,
+            single_batch_mode=True,
+            headless=False,
+            disable_tqdm=True,
+            precision=precision,
+        )
+        predictor.model.eval()
+        index = tuple(slice((s - p) // 2, (s - p) // 2 + p) for s, p in zip(crop_shape, patch))
+        channel = (slice(0, raw.shape[0]),) if multichannel else ()
+        sample = augs(read_padded_patch(raw, channel + index, (0,) * len(channel) + patch_halo))
+
+        best_throughput = 0.0
+        for batch_size in BATCH_SIZES:
+            if batch_size > 1:  # a single sample is always attempted, as by `find_batch_size`
+                if memory_cap is None or batch_size > max(strides.values()):
+                    break
+                if memory_model['fixed_bytes'] + batch_size * memory_model['per_sample_bytes'] > memory_cap:
+                    break
+            seconds = _time_batch(predictor, sample.expand(batch_size, *sample.shape).contiguous(), repeats)
+            throughput = batch_size * math.prod(patch) / seconds
+            for stride_ratio, num_patches in strides.items():
+                results.append(
+                    {
+                        'patch': patch,
+                        'stride_ratio': stride_ratio,
+                        'batch_size': batch_size,
+                        'seconds_per_batch': seconds,
+                        'voxels_per_second': math.prod(volume_shape) / (math.ceil(num_patches / batch_size) * seconds),
+                    }
+                )
+            if throughput < MIN_SPEEDUP * best_throughput:
+                break
+            best_throughput = max(best_throughput, throughput)
+
+    if not results:
+        raise RuntimeError(f'No feasible setting found for the patch shapes {patch_shapes} on {device}.')
+
+    results.sort(key=lambda result: (result['voxels_per_second'], result['stride_ratio']), reverse=True)
+    gui_logger.info(f'Autotuning results for {model_name} on {device} (halo {patch_halo}):')
+    for result in results:
+        gui_logger.info(
+            f"  patch {result['patch']}, stride ratio {result['stride_ratio']}, batch size {result['batch_size']}: "
+            f"{result['voxels_per_second'] / 1e6:.2f} Mvoxels/s"
+        )
+    return results
@@ -0,0 +1,120 @@
+"""TorchScript compiled models, cached next to the model weights."""
+
+from pathlib import Path
+
+import torch
+from torch import nn
+
+from plantseg.models import zoo_logger
+
+COMPILED_TOLERANCE = {'float32': 1e-3, 'bfloat16': 0.05, 'float16': 0.05}
+REDUCED_PRECISIONS = {'bfloat16': torch.bfloat16, 'float16': torch.float16}
+
+_compiled_models = {}
+
+
+class CompiledModel(nn.Module):
+    """Model running the forward passes with a TorchScript trace of `module`.
+
+    The eager `module` is kept to identify the architecture (e.g. 2D or 3D U-Net) and its configuration.
+    """
+
+    def __init__(self, module: nn.Module, traced: torch.jit.ScriptModule):
+        super().__init__()
+        self.module = module
+        self.traced = traced
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.traced(x)
+
+
+def compiled_model_path(model_path: Path, input_shape: tuple[int, ...], precision: str, device: str) -> Path:
+    """Path of the compiled model, next to the weights in `model_path`."""
+    model_path = Path(model_path)
+    shape = 'x'.join(str(s) for s in input_shape)
+    return model_path.with_name(f'{model_path.stem}_traced_{shape}_{precision}_{torch.device(device).type}.pt')
+
+
+def _run(model: nn.Module, x: torch.Tensor, precision: str) -> torch.Tensor:
+    with torch.no_grad():
+        if precision in REDUCED_PRECISIONS:
+            with torch.autocast(device_type=x.device.type, dtype=REDUCED_PRECISIONS[precision]):
+                return model(x).float()
+        return model(x)
+
+
+def _trace(model: nn.Module, example: torch.Tensor, precision: str) -> torch.jit.ScriptModule:
+    with torch.no_grad():
+        if precision in REDUCED_PRECISIONS:
+            # the casts of autocast are recorded in the trace
+            with torch.autocast(device_type=example.device.type, dtype=REDUCED_PRECISIONS[precision]):
+                return torch.jit.trace(model, example, check_trace=False)
+        return torch.jit.trace(model, example)
+
+
+def _load_or_trace(model: nn.Module, model_path: Path, example: torch.Tensor, precision: str, device: str):
+    traced_path = compiled_model_path(model_path, tuple(example.shape[2:]), precision, device)
+    # the compiled model is outdated if the weights changed, e.g. after a model update
+    model_path = Path(model_path)
+    weights_mtime = model_path.stat().st_mtime if model_path.exists() else 0
+    key = (str(traced_path), weights_mtime)
+    if key in _compiled_models:
+        return _compiled_models[key]
+
+    traced = None
+    if traced_path.exists() and traced_path.stat().st_mtime >= weights_mtime:
+        try:
+            traced = torch.jit.load(str(traced_path), map_location=device)
+            zoo_logger.info(f'Loaded compiled model {traced_path}')
+        except RuntimeError as e:  # e.g. saved by an incompatible version of PyTorch
+            zoo_logger.warning(f'Could not load the compiled model {traced_path}: {e}')
+
+    if traced is None:
+        zoo_logger.info(f'Compiling the model for input shape {tuple(example.shape[2:])} in {precision}')
+        traced = _trace(model, example, precision)
+        # the traced graph must reproduce the eager model, also for a different batch size
+        batch = torch.cat([example, torch.rand_like(example)])
+        error = (_run(traced, batch, precision) - _run(model, batch, precision)).abs().max().item()
+        if error > COMPILED_TOLERANCE[precision]:
+            raise RuntimeError(f'the compiled model differs from the eager model by {error:.3g}')
+        try:
+            torch.jit.save(traced, str(traced_path))
+        except (OSError, RuntimeError) as e:  # e.g. read-only model directory, keep the in-process model only
+            zoo_logger.warning(f'Could not save the compiled model to {traced_path}: {e}')
+
+    _compiled_models[key] = traced
+    return traced
+
+
+def compile_model(
+    model: nn.Module,
+    model_path: Path,
+    in_channels: int,
+    input_shape: tuple[int, ...],
+    device: str,
+    precision: str = 'float32',
+) -> nn.Module:
+    """Compile `model` with TorchScript tracing for a fixed input shape, falling back to the eager model on failure.
+
+    The traced model is saved next to the weights `model_path` (e.g. `best_checkpoint.pytorch` in
+    `~/.plantseg_models/<model_name>`), one per input shape, precision and device type, so that later runs load
+    it without tracing again.
+
+    Args:
+        model (nn.Module): The weight-loaded model, in eval mode on `device`.
+        model_path (Path): Path of the model weights.
+        in_channels (int): Number of input channels to the model.
+        input_shape (tuple[int, ...]): Spatial shape of the model input, i.e. the patch including the halo.
+        device (str): Device to perform the computation on.
+        precision (str): 'float32', or 'bfloat16'/'float16' to trace the model under autocast. Defaults to 'float32'.
+
+    Returns:
+        nn.Module: A `CompiledModel`, or `model` itself if the compilation failed.
+    """
+    example = torch.rand((1, in_channels) + tuple(input_shape), device=device)
+    try:
+        traced = _load_or_trace(model, model_path, example, precision, device)
+    except Exception as e:  # any tracing failure falls back to the eager model
+        zoo_logger.warning(f'Could not compile the model, running it in eager mode: {e}')
+        return model
+    return CompiledModel(model, traced)
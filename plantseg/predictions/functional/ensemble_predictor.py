@@ -0,0 +1,121 @@
+from typing import Optional
+
+import numpy as np
+import torch
+import tqdm
+from torch.utils.data import DataLoader, Dataset
+
+from plantseg.pipeline import gui_logger
+from plantseg.predictions.functional.accumulator import PatchAccumulator
+from plantseg.predictions.functional.array_dataset import ArrayDataset, default_prediction_collate
+from plantseg.predictions.functional.array_predictor import ArrayPredictor
+from plantseg.predictions.functional.slice_loader import SliceLoader, is_slice_dataset
+
+
+class EnsemblePredictor:
+    """Predictor applying several models to a dataset in a single pass over its patches.
+
+    Every patch is read, padded and normalized once by the dataset and then fed to the `ArrayPredictor` of each
+    model, whose predictions are blended into one prediction map per model. Compared to running the predictors
+    one after the other, the input is only read once, which dominates for large or on-disk volumes.
+
+    All the predictors must use the same patch halo, i.e. the halo of the dataset. The batch size is the smallest
+    batch size of the predictors, so every forward pass fits on its device.
+
+    Args:
+        predictors (list[ArrayPredictor]): The predictors of the models, in the order of the returned maps.
+        verbose_logging (bool, optional): If True, enable verbose logging. Defaults to False.
+        disable_tqdm (bool, optional): If True, disable tqdm progress bars. Defaults to False.
+        skip_failed (bool, optional): If True, a predictor raising an error is left out of the rest of the pass and
+            its error is kept in `failed`, instead of stopping the others. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        predictors: list[ArrayPredictor],
+        verbose_logging: bool = False,
+        disable_tqdm: bool = False,
+        skip_failed: bool = False,
+    ):
+        if not predictors:
+            raise ValueError('At least one predictor is required for an ensemble prediction.')
+        patch_halos = {tuple(predictor.patch_halo) for predictor in predictors}
+        if len(patch_halos) > 1:
+            raise ValueError(f'All the predictors of an ensemble must use the same patch halo, got {patch_halos}')
+
+        self.predictors = predictors
+        self.patch_halo = predictors[0].patch_halo
+        self.verbose_logging = verbose_logging
+        self.disable_tqdm = disable_tqdm
+        self.skip_failed = skip_failed
+        # the errors of the failed predictors by index, with `skip_failed`
+        self.failed = {}
+        # with test-time augmentation every patch is predicted once per variant in the same batch
+        self.batch_size = min(
+            max(predictor.batch_size // max(len(predictor.tta_transforms), 1), 1) for predictor in predictors
+        )
+
+    def __call__(self, test_dataset: Dataset) -> list[Optional[np.ndarray]]:
+        """Run all the models on `test_dataset`.
+
+        Returns:
+            list[Optional[np.ndarray]]: The prediction maps (C, Z, Y, X) of every predictor, None for the failed ones.
+        """
+        test_loader = self.data_loader(test_dataset)
+        volume_shape = ArrayPredictor.volume_shape(test_dataset)
+
+        if self.verbose_logging:
+            gui_logger.info(f'Running {len(self.predictors)} models on {len(test_loader)} batches')
+
+        prediction_maps = [
+            np.zeros((predictor.output_channels(),) + tuple(volume_shape), dtype=predictor.output_dtype)
+            for predictor in self.predictors
+        ]
+        accumulators = [
+            PatchAccumulator(
+                prediction_map, predictor.device, blending=predictor.blending, fill_value=predictor.fill_value
+            )
+            for prediction_map, predictor in zip(prediction_maps, self.predictors)
+        ]
+        self.accumulate(test_loader, accumulators)
+
+        if self.verbose_logging:
+            gui_logger.info('Prediction finished')
+
+        return [None if i in self.failed else prediction_map for i, prediction_map in enumerate(prediction_maps)]
+
+    def accumulate(self, test_loader: DataLoader, accumulators: list[PatchAccumulator]) -> None:
+        """Run every model on all the batches of `test_loader` and blend its predictions with its accumulator."""
+        for predictor in self.predictors:
+            predictor.model.eval()
+        with torch.no_grad():
+            for input_, indices in tqdm.tqdm(test_loader, disable=self.disable_tqdm):
+                for i, (predictor, accumulator) in enumerate(zip(self.predictors, accumulators)):
+                    if i in self.failed:
+                        continue
+                    try:
+                        accumulator.add(predictor.predict_batch(input_), indices)
+                    except Exception as e:
+                        if not self.skip_failed:
+                            raise
+                        self.failed[i] = e
+                if len(self.failed) == len(self.predictors):
+                    break
+        for i, accumulator in enumerate(accumulators):
+            if i not in self.failed:
+                accumulator.close()
+
+    def data_loader(self, test_dataset: Dataset) -> DataLoader:
+        assert isinstance(test_dataset, ArrayDataset), 'Dataset must be an instance of ArrayDataset'
+        assert (
+            self.patch_halo == test_dataset.halo_shape
+        ), f'Predictor halo shape {self.patch_halo} does not match dataset halo shape {test_dataset.halo_shape}'
+
+        if is_slice_dataset(test_dataset):
+            return SliceLoader(test_dataset, self.batch_size, pin_memory=True)
+        return DataLoader(
+            test_dataset,
+            batch_size=self.batch_size,
+            pin_memory=True,
+            collate_fn=default_prediction_collate,
+        )
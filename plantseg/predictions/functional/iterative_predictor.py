@@ -0,0 +1,155 @@
+import copy
+import math
+
+import numpy as np
+import torch
+import tqdm
+
+from plantseg.augment.transforms import get_test_augmentations
+from plantseg.dataprocessing.functional.dataprocessing import image_gaussian_smoothing
+from plantseg.pipeline import gui_logger
+from plantseg.predictions.functional.accumulator import PatchAccumulator
+from plantseg.predictions.functional.array_dataset import ArrayDataset, default_prediction_collate
+from plantseg.predictions.functional.array_predictor import ArrayPredictor
+
+
+class _PredictionStage:
+    """One iteration: predicts the patches of `dataset` as soon as their input slabs are final.
+
+    If the augmentations of `dataset` are None, the stage waits for the whole input and standardizes it with its
+    global statistics.
+    """
+
+    def __init__(self, predictor: ArrayPredictor, dataset: ArrayDataset, source, dtype: str = 'float32'):
+        self.predictor = predictor
+        self.dataset = dataset
+        self.source = source
+        self.size_z = ArrayPredictor.volume_shape(dataset)[0]
+        self.output = np.zeros((predictor.output_channels(), self.size_z) + dataset.raw.shape[-2:], dtype=dtype)
+        self.accumulator = PatchAccumulator(
+            self.output, predictor.device, blending=predictor.blending, fill_value=predictor.fill_value
+        )
+        self.next_patch = 0
+        self.ready = 0
+
+    def _input_stop(self, idx: int) -> int:
+        """End of the input slab read for the patch `idx` with its halo."""
+        return min(self.dataset.raw_slices[idx][-3].stop + self.dataset.halo_shape[0], self.size_z)
+
+    def advance(self) -> int:
+        """Predict the next batch of patches whose input is final, return the number of predicted patches."""
+        if self.ready == self.size_z:
+            return 0
+        source_ready = self.source.ready if self.source is not None else self.size_z
+        if self.dataset.augs is None:
+            if source_ready < self.size_z:
+                return 0
+            self.dataset.augs = get_test_augmentations(self.source.output)
+        stop = self.next_patch
+        while (
+            stop < len(self.dataset)
+            and stop - self.next_patch < self.predictor._loader_batch_size()
+            and self._input_stop(stop) <= source_ready
+        ):
+            stop += 1
+        if stop > self.next_patch:
+            input_, indices = default_prediction_collate([self.dataset[i] for i in range(self.next_patch, stop)])
+            self.accumulator.add(self.predictor.predict_batch(input_), indices)
+        if stop == len(self.dataset):
+            self.accumulator.close()
+            self.ready = self.size_z
+        else:
+            self.ready = self.accumulator.finished_z()
+        num_patches, self.next_patch = stop - self.next_patch, stop
+        return num_patches
+
+
+class _SmoothingStage:
+    """Gaussian smoothing of the first channel of the predictions of `source`, one slab at a time."""
+
+    def __init__(self, source: _PredictionStage, sigma: float):
+        self.source = source
+        shape = source.output.shape[1:]
+        # the same sigma as the smoothing of the whole volume, see `image_gaussian_smoothing`
+        self.sigma = np.minimum((np.array(shape) - 1) / 3, sigma)
+        # margin covering the gaussian kernel (truncated at 4 sigma by scipy, 3 sigma by vigra)
+        self.margin = math.ceil(4 * float(self.sigma[0])) + 1
+        self.output = np.zeros(shape, dtype='float32')
+        self.size_z = shape[0]
+        self.ready = 0
+
+    def advance(self) -> int:
+        """Smooth the slices whose neighbourhood is final, return the number of smoothed slices."""
+        source_ready = self.source.ready
+        stop = self.size_z if source_ready == self.size_z else max(source_ready - self.margin, 0)
+        # slabs thinner than the margin would be dominated by the margins
+        if stop - self.ready < self.margin and stop < self.size_z:
+            return 0
+        if stop <= self.ready:
+            return 0
+        start = self.ready
+        slab_start, slab_stop = max(start - self.margin, 0), min(stop + self.margin, self.size_z)
+        slab = image_gaussian_smoothing(self.source.output[0, slab_start:slab_stop], self.sigma)
+        self.output[start:stop] = slab[start - slab_start : stop - slab_start]
+        self.ready = stop
+        return stop - start
+
+
+class IterativePredictor:
+    """Predictor running a model iteratively on its own gaussian smoothed predictions, keeping the model loaded.
+
+    Each iteration predicts the patches of the same tiling: the first iteration reads the raw data, the next ones the
+    smoothed predictions of the previous iteration, which are blended and smoothed one slab at a time. The smoothing
+    of a slab reads the neighbouring slices within the gaussian kernel, so it is identical to smoothing the whole
+    volume.
+
+    The global statistics of the smoothed predictions are only known once they are finished, so by default every
+    iteration after the first waits for the whole smoothed volume and standardizes it with its global mean and std,
+    exactly as predicting the smoothed predictions again. With `streaming`, the iterations run interleaved instead,
+    each predicting the patches as soon as the slabs of its input are final, and standardize every patch with its
+    own mean and std, which changes the predictions and amplifies the noise of background patches.
+
+    Args:
+        predictor (ArrayPredictor): The predictor running the model.
+        num_iterations (int): Number of predictions, i.e. of runs of the model on every patch.
+        sigma (float): Standard deviation of the gaussian smoothing between the iterations.
+        streaming (bool): If True, the iterations run interleaved and standardize every patch on its own.
+            Defaults to False.
+    """
+
+    def __init__(self, predictor: ArrayPredictor, num_iterations: int, sigma: float, streaming: bool = False):
+        if num_iterations < 1:
+            raise ValueError(f'The number of iterations must be at least 1, got {num_iterations}')
+        self.predictor = predictor
+        self.num_iterations = num_iterations
+        self.sigma = sigma
+        self.streaming = streaming
+
+    def __call__(self, test_dataset: ArrayDataset) -> np.ndarray:
+        """Run the iterations on `test_dataset`.
+
+        Returns:
+            np.ndarray: The prediction maps (C, Z, Y, X) of the last iteration.
+        """
+        # the intermediate predictions are smoothed in float32, only the last ones are in the output dtype
+        dtypes = ['float32'] * (self.num_iterations - 1) + [self.predictor.output_dtype]
+        stages = [_PredictionStage(self.predictor, test_dataset, None, dtypes[0])]
+        for dtype in dtypes[1:]:
+            smoothing = _SmoothingStage(stages[-1], self.sigma)
+            # the same tiling, reading the smoothed predictions, standardized per patch if streaming, else globally
+            # once they are finished (see `_PredictionStage`)
+            augs = get_test_augmentations(None) if self.streaming else None
+            dataset = copy.copy(test_dataset)
+            dataset.raw, dataset.raw_padded, dataset.augs = smoothing.output, None, augs
+            stages += [smoothing, _PredictionStage(self.predictor, dataset, smoothing, dtype)]
+
+        gui_logger.info(f'Running {self.num_iterations} iterations on {len(test_dataset)} patches')
+        self.predictor.model.eval()
+        total = self.num_iterations * len(test_dataset)
+        with torch.no_grad(), tqdm.tqdm(total=total, disable=self.predictor.disable_tqdm) as progress:
+            while stages[-1].ready < stages[-1].size_z:
+                advanced = [stage.advance() for stage in stages]
+                if not any(advanced):
+                    raise RuntimeError('The iterative prediction cannot make progress, the input slabs are not final.')
+                progress.update(sum(n for stage, n in zip(stages, advanced) if isinstance(stage, _PredictionStage)))
+        return stages[-1].output
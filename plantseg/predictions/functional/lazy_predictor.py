@@ -0,0 +1,82 @@
+import h5py
+from torch.utils.data import Dataset
+
+from plantseg.pipeline import gui_logger
+from plantseg.predictions.functional.accumulator import PatchAccumulator
+from plantseg.predictions.functional.array_predictor import ArrayPredictor
+
+
+class LazyPredictor(ArrayPredictor):
+    """Predictor class for applying a model to a dataset and streaming the results into an on-disk dataset.
+
+    Unlike `ArrayPredictor`, the prediction maps are never allocated in memory as a whole. The patches are
+    blended in a `PatchAccumulator` buffer spanning only the z-range of the patches being processed, and every
+    finished z-slab is normalized and written into the output dataset (e.g. a chunked `h5py.Dataset` or `zarr.Array`).
+    Combined with an `ArrayDataset` built on an on-disk input, this keeps the memory usage bounded by the
+    patch size instead of the volume size.
+
+    Based on pytorch-3dunet LazyPredictor:
+    https://github.com/wolny/pytorch-3dunet/blob/master/pytorch3dunet/unet3d/predictor.py
+
+    Args:
+        See `ArrayPredictor`.
+    """
+
+    def __call__(self, test_dataset: Dataset, output_dataset):
+        """Run the predictions on `test_dataset` and write them into `output_dataset`.
+
+        Args:
+            test_dataset (ArrayDataset): The dataset to predict.
+            output_dataset: Array-like of shape (C, Z, Y, X) where the predictions are written,
+                see `create_prediction_dataset`.
+
+        Returns:
+            The `output_dataset`.
+        """
+        test_loader = self.data_loader(test_dataset)
+
+        prediction_maps_shape = (self.output_channels(),) + tuple(self.volume_shape(test_dataset))
+        if tuple(output_dataset.shape) != prediction_maps_shape:
+            raise ValueError(
+                f'Output dataset shape {tuple(output_dataset.shape)} does not match the shape of the '
+                f'prediction maps {prediction_maps_shape}'
+            )
+
+        if self.verbose_logging:
+            gui_logger.info(f'Running lazy prediction on {len(test_loader)} batches')
+            gui_logger.info(f'The shape of the output prediction maps (CDHW): {prediction_maps_shape}')
+
+        accumulator = PatchAccumulator(output_dataset, self.device, blending=self.blending, fill_value=self.fill_value)
+        self.accumulate(test_loader, accumulator)
+
+        if self.verbose_logging:
+            gui_logger.info('Prediction finished')
+
+        return output_dataset
+
+
+def create_prediction_dataset(
+    file,
+    key: str,
+    shape: tuple[int, int, int, int],
+    patch: tuple[int, int, int],
+    dtype: str = 'float32',
+):
+    """Create a chunked dataset for the output of a `LazyPredictor` in an open h5py.File or zarr.Group.
+
+    Args:
+        file (h5py.File | zarr.Group): The open file where the dataset is created.
+        key (str): The internal path of the dataset, replaced if it already exists.
+        shape (tuple[int, int, int, int]): Shape of the prediction maps (C, Z, Y, X).
+        patch (tuple[int, int, int]): Patch size used for prediction, used as chunk shape.
+        dtype (str): Data type of the dataset. Defaults to 'float32'.
+
+    Returns:
+        The created dataset.
+    """
+    if key in file:
+        del file[key]
+    chunks = (1,) + tuple(min(p, s) for p, s in zip(patch, shape[1:]))
+    if isinstance(file, h5py.Group):
+        return file.create_dataset(key, shape=shape, dtype=dtype, chunks=chunks, compression='gzip')
+    return file.create_dataset(key, shape=shape, dtype=dtype, chunks=chunks)
@@ -0,0 +1,185 @@
+"""Measured memory model of the prediction networks, used to choose the batch size without probing."""
+
+import os
+from pathlib import Path
+from typing import Optional
+
+import torch
+from torch import nn
+
+from plantseg import PATH_MEMORY_MODELS
+from plantseg.pipeline import gui_logger
+from plantseg.predictions.functional.compiled_model import CompiledModel
+from plantseg.utils import load_config, save_config
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64, 128]
+GPU_MEMORY_FRACTION = 0.9  # leave some room for the allocator fragmentation and the accumulation buffers
+HOST_MEMORY_FRACTION = 0.5  # the host memory is shared with the input volume and the prediction maps
+
+
+def memory_model_key(model: nn.Module, in_channels: int, input_shape: tuple[int, ...], device: str) -> str:
+    """Key identifying a memory model: architecture, feature maps, input channels and shape, dtype and device."""
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    if isinstance(model, CompiledModel):
+        model = model.module
+    parameter = next(model.parameters(), None)
+    dtype = str(parameter.dtype).replace('torch.', '') if parameter is not None else 'float32'
+    f_maps = getattr(model, 'f_maps', None)
+    if f_maps is None:  # models outside PlantSeg, e.g. from BioImage.IO, are identified by their size
+        f_maps = f'{sum(p.numel() for p in model.parameters())}params'
+    else:
+        f_maps = '-'.join(str(f) for f in f_maps)
+
+    device = torch.device(device)
+    if device.type == 'cuda':
+        device_name = f'cuda:{torch.cuda.get_device_name(device)}'
+    else:
+        device_name = device.type
+    shape = 'x'.join(str(s) for s in input_shape)
+    return f'{type(model).__name__}_f{f_maps}_c{in_channels}_{shape}_{dtype}_{device_name}'
+
+
+def _measure_peak_bytes(model: nn.Module, in_channels: int, input_shape: tuple[int, ...], batch_size: int, device):
+    """Memory used by a forward pass at `batch_size`, or None if it does not fit on the device.
+
+    On CUDA devices this is the peak allocated memory. On the CPU there is no allocator statistics, the sum of
+    the outputs of all the layers is used as an upper bound.
+    """
+    device = torch.device(device)
+    x = None
+    hooks = []
+    activations = [0]
+
+    def count_output(_module, _input, output):
+        if isinstance(output, torch.Tensor):
+            activations[0] += output.numel() * output.element_size()
+
+    try:
+        with torch.no_grad():
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+                torch.cuda.reset_peak_memory_stats(device)
+                baseline = torch.cuda.memory_allocated(device)
+                x = torch.randn((batch_size, in_channels) + tuple(input_shape), device=device)
+                _ = model(x)
+                torch.cuda.synchronize(device)
+                return torch.cuda.max_memory_allocated(device) - baseline
+
+            for module in model.modules():
+                if len(list(module.children())) == 0:
+                    hooks.append(module.register_forward_hook(count_output))
+            x = torch.randn((batch_size, in_channels) + tuple(input_shape), device=device)
+            _ = model(x)
+            return x.numel() * x.element_size() + activations[0]
+    except RuntimeError as e:
+        if 'out of memory' in str(e):
+            return None
+        raise
+    finally:
+        for hook in hooks:
+            hook.remove()
+        del x
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+def measure_memory_model(
+    model: nn.Module, in_channels: int, input_shape: tuple[int, ...], device: str
+) -> Optional[dict[str, int]]:
+    """Fit the memory used by a forward pass as `fixed_bytes + batch_size * per_sample_bytes`.
+
+    Returns:
+        dict: The memory model, or None if a single sample does not fit in the device memory.
+    """
+    if isinstance(model, CompiledModel) and torch.device(device).type != 'cuda':
+        model = model.module  # the layer outputs are only observable in the eager model
+    model = model.to(device)
+    model.eval()
+    peak_1 = _measure_peak_bytes(model, in_channels, input_shape, 1, device)
+    if peak_1 is None:
+        return None
+    if torch.device(device).type != 'cuda':  # the estimate of the activations is linear in the batch size
+        return {'fixed_bytes': 0, 'per_sample_bytes': int(peak_1)}
+    peak_2 = _measure_peak_bytes(model, in_channels, input_shape, 2, device)
+    if peak_2 is None:  # only a single sample fits
+        return {'fixed_bytes': 0, 'per_sample_bytes': int(peak_1)}
+    per_sample_bytes = max(int(peak_2 - peak_1), 1)
+    return {'fixed_bytes': max(int(peak_1) - per_sample_bytes, 0), 'per_sample_bytes': per_sample_bytes}
+
+
+def get_memory_model(
+    model: nn.Module,
+    in_channels: int,
+    input_shape: tuple[int, ...],
+    device: str,
+    path: Path = PATH_MEMORY_MODELS,
+) -> Optional[dict[str, int]]:
+    """Load the memory model from the cache in `path`, measuring and caching it if needed.
+
+    Args:
+        model (nn.Module): The model used for predictions.
+        in_channels (int): Number of input channels to the model.
+        input_shape (tuple[int, ...]): Spatial shape of the model input, i.e. the patch including the halo.
+        device (str): Device to perform the computation on.
+        path (Path): The YAML file caching the memory models. Defaults to `~/.plantseg_models/memory_models.yaml`.
+
+    Returns:
+        dict: The memory model with keys `fixed_bytes` and `per_sample_bytes`, None if a sample does not fit.
+    """
+    path = Path(path)
+    key = memory_model_key(model, in_channels, input_shape, device)
+    memory_models = load_config(path) if path.exists() else None
+    if memory_models and key in memory_models:
+        return memory_models[key]
+
+    gui_logger.info(f'Measuring the memory usage of the model for input shape {tuple(input_shape)} on {device}')
+    memory_model = measure_memory_model(model, in_channels, input_shape, device)
+    if memory_model is None:
+        return None
+
+    # reload the cache, another process may have added its models in the meantime
+    memory_models = (load_config(path) if path.exists() else None) or {}
+    memory_models[key] = memory_model
+    path.parent.mkdir(parents=True, exist_ok=True)
+    save_config(memory_models, path)
+    return memory_model
+
+
+def available_memory(device: str) -> Optional[int]:
+    """Memory available for the forward passes on `device`, None if it cannot be determined."""
+    device = torch.device(device)
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        # memory cached by the PyTorch allocator is available to the forward passes as well
+        cached = torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        return int((free + cached) * GPU_MEMORY_FRACTION)
+    if device.type != 'cpu':
+        return None
+
+    if psutil is not None:
+        available = psutil.virtual_memory().available
+    elif hasattr(os, 'sysconf') and 'SC_AVPHYS_PAGES' in os.sysconf_names:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    else:
+        return None
+    return int(available * HOST_MEMORY_FRACTION)
+
+
+def max_batch_size(memory_model: Optional[dict[str, int]], available: Optional[int]) -> int:
+    """Largest batch size in `BATCH_SIZES` fitting in the `available` memory, 0 if not even one sample fits."""
+    if memory_model is None:
+        return 0
+    if available is None:
+        return 1
+    batch_size = 0
+    for size in BATCH_SIZES:
+        if memory_model['fixed_bytes'] + size * memory_model['per_sample_bytes'] > available:
+            break
+        batch_size = size
+    return batch_size
@@ -0,0 +1,129 @@
+"""ONNX Runtime inference backend, running ONNX exports of the models cached next to the model weights."""
+
+import copy
+import inspect
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+from torch import nn
+
+from plantseg.models import zoo_logger
+from plantseg.predictions.functional.compiled_model import CompiledModel
+
+try:
+    import onnxruntime
+
+    onnxruntime_installed = True
+except ImportError:
+    onnxruntime_installed = False
+
+SUPPORTED_BACKENDS = ['torch', 'onnxruntime']
+ONNX_OPSET_VERSION = 17
+ONNX_TOLERANCE = 1e-3
+
+
+class OnnxModel(CompiledModel):
+    """Model running the forward passes of `module` with an onnxruntime session on the CPU.
+
+    The eager `module` is kept to identify the architecture (e.g. 2D or 3D U-Net) and its configuration.
+    """
+
+    def __init__(self, module: nn.Module, session):
+        super().__init__(module, traced=None)
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x_numpy = x.detach().to(device='cpu', dtype=torch.float32).contiguous().numpy()
+        output = self.session.run(None, {self.input_name: x_numpy})[0]
+        return torch.from_numpy(np.asarray(output)).to(x.device)
+
+
+def onnx_model_path(model_path: Path, input_shape: tuple[int, ...]) -> Path:
+    """Path of the ONNX export, next to the weights in `model_path`."""
+    model_path = Path(model_path)
+    shape = 'x'.join(str(s) for s in input_shape)
+    return model_path.with_name(f'{model_path.stem}_{shape}.onnx')
+
+
+def export_onnx(model: nn.Module, model_path: Path, in_channels: int, input_shape: tuple[int, ...]) -> Path:
+    """Export `model` in eval mode (i.e. including the final activation) to ONNX, unless an up-to-date export exists.
+
+    The spatial input shape is fixed, the batch size is dynamic. A copy of `model` is exported, leaving `model`, e.g.
+    shared by the model cache of the `ModelZoo`, on its device and in its mode.
+    """
+    model_path = Path(model_path)
+    onnx_path = onnx_model_path(model_path, input_shape)
+    weights_mtime = model_path.stat().st_mtime if model_path.exists() else 0
+    if onnx_path.exists() and onnx_path.stat().st_mtime >= weights_mtime:
+        return onnx_path
+
+    zoo_logger.info(f'Exporting the model to ONNX for input shape {tuple(input_shape)}')
+    example = torch.rand((1, in_channels) + tuple(input_shape))
+    # the TorchScript exporter, which torch >= 2.5 selects with `dynamo=False` and later versions no longer default to
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            copy.deepcopy(model).cpu().eval(),
+            example,
+            str(onnx_path),
+            input_names=['input'],
+            output_names=['output'],
+            dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+            opset_version=ONNX_OPSET_VERSION,
+            **kwargs,
+        )
+    return onnx_path
+
+
+def load_onnx_model(
+    model: nn.Module,
+    model_path: Path,
+    in_channels: int,
+    input_shape: tuple[int, ...],
+    num_threads: Optional[int] = None,
+) -> nn.Module:
+    """Run `model` with onnxruntime's CPU execution provider.
+
+    The ONNX export is cached next to the weights `model_path` (e.g. `best_checkpoint.pytorch` in
+    `~/.plantseg_models/<model_name>`), one per input shape, and checked against the torch model before use.
+
+    Args:
+        model (nn.Module): The weight-loaded model, in eval mode on the CPU.
+        model_path (Path): Path of the model weights.
+        in_channels (int): Number of input channels to the model.
+        input_shape (tuple[int, ...]): Spatial shape of the model input, i.e. the patch including the halo.
+        num_threads (int, optional): Number of threads of onnxruntime, defaults to the number of torch threads.
+
+    Returns:
+        nn.Module: An `OnnxModel` running the ONNX export of `model`.
+
+    Raises:
+        ValueError: If onnxruntime is not installed.
+        RuntimeError: If the model cannot be exported or run with onnxruntime, or its predictions differ from the
+            torch model.
+    """
+    if not onnxruntime_installed:
+        raise ValueError('please install onnxruntime to use the `onnxruntime` backend, or use the `torch` backend')
+
+    try:
+        onnx_path = export_onnx(model, model_path, in_channels, input_shape)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = onnxruntime.InferenceSession(str(onnx_path), options, providers=['CPUExecutionProvider'])
+        onnx_model = OnnxModel(model, session)
+
+        # the exported graph must reproduce the torch model, also for a different batch size
+        example = torch.rand((2, in_channels) + tuple(input_shape))
+        with torch.no_grad():
+            error = (onnx_model(example) - model(example)).abs().max().item()
+    except Exception as e:
+        raise RuntimeError(f'Could not run the model with onnxruntime, use the `torch` backend instead: {e}') from e
+    if error > ONNX_TOLERANCE:
+        raise RuntimeError(
+            f'The ONNX model differs from the torch model by {error:.3g}, use the `torch` backend instead'
+        )
+    return onnx_model
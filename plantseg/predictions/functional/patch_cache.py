@@ -0,0 +1,136 @@
+"""Content-addressed disk cache of the predictions of single patches."""
+
+import hashlib
+import os
+import weakref
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+from torch import nn
+
+from plantseg import PATH_PATCH_CACHE
+from plantseg.pipeline import gui_logger
+from plantseg.predictions.functional.compiled_model import CompiledModel
+
+DEFAULT_PATCH_CACHE_BYTES = 2 * 1024**3
+
+_model_digests = weakref.WeakKeyDictionary()
+
+
+def model_digest(model: nn.Module) -> str:
+    """Hash of the weights of `model`, computed once per model instance."""
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    runner = type(model).__name__  # e.g. eager, compiled or ONNX models predict slightly differently
+    if isinstance(model, CompiledModel):
+        model = model.module
+    if model not in _model_digests:
+        digest = hashlib.blake2b(digest_size=16)
+        for name, tensor in model.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        _model_digests[model] = digest.hexdigest()
+    return f'{runner}-{_model_digests[model]}'
+
+
+class PatchCache:
+    """Disk cache of the predictions of single patches, keyed by the hash of the model and of the patch.
+
+    The key covers the model weights, the prediction settings (e.g. precision and test-time augmentation) and the
+    pixels of the normalized patch including its halo, so a prediction is reused only for exactly the same network
+    input, e.g. for unchanged regions when re-running a prediction after a parameter change. The least recently
+    used patches are evicted once the cache exceeds `max_bytes`.
+
+    Args:
+        path (Path): Directory of the cache. Defaults to `~/.plantseg_models/patch_cache`.
+        max_bytes (int): Maximum size of the cache on disk. Defaults to 2 GiB.
+
+    Attributes:
+        hits (int): Number of patches found in the cache.
+        misses (int): Number of patches not found in the cache.
+    """
+
+    def __init__(self, path: Path = PATH_PATCH_CACHE, max_bytes: int = DEFAULT_PATCH_CACHE_BYTES):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = sum(file.stat().st_size for file in self.path.glob('*/*.npy'))
+
+    @staticmethod
+    def key(prefix: str, patch: torch.Tensor) -> str:
+        """Hash of the settings `prefix` and of the `patch` pixels."""
+        patch = patch.detach().cpu().contiguous()
+        digest = hashlib.blake2b(prefix.encode(), digest_size=20)
+        digest.update(str((tuple(patch.shape), str(patch.dtype))).encode())
+        digest.update(patch.numpy().tobytes())
+        return digest.hexdigest()
+
+    def _file(self, key: str) -> Path:
+        return self.path / key[:2] / f'{key}.npy'
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """The cached prediction of `key`, None if not cached."""
+        file = self._file(key)
+        try:
+            prediction = np.load(file)
+        except (OSError, ValueError):  # not cached, or evicted/truncated in the meantime
+            self.misses += 1
+            return None
+        try:
+            os.utime(file)  # the modification time orders the patches for the eviction
+        except OSError:  # evicted by another process in the meantime
+            pass
+        self.hits += 1
+        return prediction
+
+    def put(self, key: str, prediction: np.ndarray) -> None:
+        """Cache the `prediction` of `key` and evict the least recently used patches if the cache is full."""
+        file = self._file(key)
+        file.parent.mkdir(exist_ok=True)
+        # written to a temporary file first, so that concurrent readers never see a partial patch
+        tmp_file = file.with_name(f'{key}.{os.getpid()}.tmp')
+        with tmp_file.open('wb') as f:
+            np.save(f, prediction)
+        os.replace(tmp_file, file)
+        self._size += file.stat().st_size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        """Delete the least recently used patches until the cache is below 90% of `max_bytes`."""
+        files = []
+        for file in self.path.glob('*/*.npy'):
+            try:
+                stat = file.stat()
+            except OSError:  # deleted by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, file))
+        files.sort()
+
+        self._size = sum(size for _, size, _ in files)
+        target = int(0.9 * self.max_bytes)
+        for _, size, file in files:
+            if self._size <= target:
+                break
+            file.unlink(missing_ok=True)
+            self._size -= size
+
+    def clear(self) -> None:
+        """Delete all the cached patches."""
+        for file in self.path.glob('*/*.npy'):
+            file.unlink(missing_ok=True)
+        self._size = 0
+
+    def hit_rate(self) -> float:
+        """Fraction of the patches found in the cache."""
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def log_statistics(self) -> None:
+        gui_logger.info(
+            f'Patch cache: {self.hits} hits, {self.misses} misses ({100 * self.hit_rate():.1f}% hit rate), '
+            f'{self._size / 1024**2:.1f} MiB in {self.path}'
+        )
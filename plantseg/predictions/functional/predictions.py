@@ -1,19 +1,107 @@
-from typing import Tuple, Optional
+from functools import partial
+from typing import Tuple, Optional, Union
 from pathlib import Path
 
+import h5py
 import numpy as np
 import torch
+import zarr
+from scipy.ndimage import binary_dilation
 
 from plantseg.pipeline import gui_logger
 from plantseg.models.zoo import model_zoo
 from plantseg.viewer.logging import napari_formatted_logging
 from plantseg.augment.transforms import get_test_augmentations
-from plantseg.dataprocessing.functional.dataprocessing import fix_input_shape_to_ZYX, fix_input_shape_to_CZYX
-from plantseg.predictions.functional.array_dataset import ArrayDataset
-from plantseg.predictions.functional.array_predictor import ArrayPredictor
-from plantseg.predictions.functional.slice_builder import SliceBuilder
+from plantseg.dataprocessing.functional.dataprocessing import (
+    fix_input_shape_to_ZYX,
+    fix_input_shape_to_CZYX,
+    image_rescale,
+)
+from plantseg.predictions.functional.array_dataset import ArrayDataset, read_padded_patch
+from plantseg.predictions.functional.array_predictor import ArrayPredictor, model_input_shape
+from plantseg.predictions.functional.compiled_model import compile_model
+from plantseg.predictions.functional.ensemble_predictor import EnsemblePredictor
+from plantseg.predictions.functional.iterative_predictor import IterativePredictor
+from plantseg.predictions.functional.lazy_predictor import LazyPredictor, create_prediction_dataset
+from plantseg.predictions.functional.onnx_model import SUPPORTED_BACKENDS, load_onnx_model
+from plantseg.predictions.functional.patch_cache import PatchCache
+from plantseg.predictions.functional.rescaling import RescaledSink, RescaledVolume, predict_rescaled
+from plantseg.predictions.functional.sharded_predictor import ShardedPredictor
+from plantseg.predictions.functional.slice_builder import ForegroundSliceBuilder, SliceBuilder
+from plantseg.predictions.functional.time_series import TimeSeriesPredictor, time_point, time_point_key
 from plantseg.predictions.functional.utils import get_patch_halo, get_stride_shape
 
+SUPPORTED_TILINGS = ['overlap', 'halo']
+TILING_TOLERANCE = 0.05  # maximum absolute difference of the predictions of a voxel in two overlapping patches
+
+
+def _halo_tiling(
+    model, model_config, raw, augs, patch, patch_halo, device, multichannel
+) -> Optional[tuple[int, int, int]]:
+    """Halo of the non-overlapping tiling, None if the tiling changes the predictions.
+
+    The predictions of a patch and of the patch shifted by half its size are compared on their overlap: if the halo
+    covers the receptive field, the prediction of a voxel does not depend on the patch it is predicted in.
+    """
+    if patch_halo is None:
+        patch_halo = list(model_zoo.compute_3D_halo_for_pytorch3dunet(model))
+        if model_config['name'] == 'UNet2D':
+            patch_halo[0] = 0
+    patch_halo = tuple(patch_halo)
+
+    spatial_shape = raw.shape[-3:]
+    overlap_patches = len(SliceBuilder(raw, None, patch, get_stride_shape(patch)).raw_slices)
+    halo_patches = len(SliceBuilder(raw, None, patch, patch).raw_slices)
+    gui_logger.info(
+        f'Halo tiling with halo {patch_halo}: {halo_patches} patches instead of {overlap_patches} '
+        f'({100 * (1 - halo_patches / overlap_patches):.0f}% fewer forward passes)'
+    )
+
+    # shift along the last axis with room for it, with a single patch per axis there are no seams
+    axis = next((a for a in (2, 1, 0) if spatial_shape[a] >= patch[a] + patch[a] // 2 and patch[a] > 1), None)
+    if axis is None:
+        return patch_halo
+    shift = patch[axis] // 2
+    index = [slice(0, p) for p in patch]
+    shifted_index = list(index)
+    shifted_index[axis] = slice(shift, shift + patch[axis])
+
+    predictor = ArrayPredictor(
+        model=model,
+        in_channels=model_config['in_channels'],
+        out_channels=model_config['out_channels'],
+        device=device,
+        patch=patch,
+        patch_halo=patch_halo,
+        single_batch_mode=True,
+        headless=False,
+        disable_tqdm=True,
+    )
+    channel = (slice(0, raw.shape[0]),) if multichannel else ()
+    halo_shape = (0,) * len(channel) + patch_halo
+    batch = torch.stack([augs(read_padded_patch(raw, channel + tuple(i), halo_shape)) for i in (index, shifted_index)])
+    with torch.no_grad():
+        predictor.model.eval()
+        prediction, shifted_prediction = predictor.predict_batch(batch).cpu()
+    overlap = prediction.narrow(axis + 1, shift, patch[axis] - shift)
+    shifted_overlap = shifted_prediction.narrow(axis + 1, 0, patch[axis] - shift)
+    error = (overlap - shifted_overlap).abs().max().item()
+    if error > TILING_TOLERANCE:
+        gui_logger.warning(
+            f'Predictions of overlapping patches differ by up to {error:.3g} with halo {patch_halo}, '
+            'falling back to overlapping patches'
+        )
+        return None
+    gui_logger.info(f'Predictions of overlapping patches differ by up to {error:.3g} with halo {patch_halo}')
+    return patch_halo
+
+
+def _prediction_sinks(sinks: list, rescaled_shape: tuple[int, ...], rescale_factor) -> list:
+    """The sinks written by the predictor, resampling the rescaled predictions back into `sinks` if rescaled."""
+    if rescale_factor is None:
+        return sinks
+    return [RescaledSink(sink, rescaled_shape) for sink in sinks]
+
 
 def unet_predictions(
     raw: np.ndarray,
@@ -27,15 +115,43 @@ def unet_predictions(
     handle_multichannel: bool = False,
     config_path: Optional[Path] = None,
     model_weights_path: Optional[Path] = None,
+    predictor: str = 'ArrayPredictor',
+    output_path: Optional[Path] = None,
+    output_key: str = 'predictions',
+    tta: bool = False,
+    precision: str = 'float32',
+    compiled: bool = False,
+    backend: str = 'torch',
+    skip_background: bool = False,
+    foreground_mask: Optional[np.ndarray] = None,
+    fill_value: float = 0.0,
+    tiling: str = 'overlap',
+    patch_cache: Optional[PatchCache] = None,
+    num_workers: Optional[int] = None,
+    num_iterations: int = 1,
+    smoothing_sigma: float = 1.0,
+    stream_iterations: bool = False,
+    output_dtype: str = 'float32',
+    normalization_stats: str = 'exact',
+    time_series: bool = False,
+    rescale_factor: Optional[Tuple[float, float, float]] = None,
     **kwargs,
-) -> np.ndarray:
+) -> Union[np.ndarray, Path]:
     """Generate predictions from raw data using a specified 3D U-Net model.
 
     This function handles both single and multi-channel outputs from the model,
     returning appropriately shaped arrays based on the output channel configuration.
 
+    With `predictor='LazyPredictor'` the predictions are streamed block by block into a chunked dataset
+    at `output_path` (h5 or zarr) instead of being returned in memory. In this mode `raw` can also be an
+    on-disk array (e.g. `h5py.Dataset` or `zarr.Array`), which is then read patch by patch.
+    With `predictor='ShardedPredictor'` z-slabs of the volume are predicted in `num_workers` processes on the CPU.
+
+    With `time_series=True` the first axis of `raw` is the time, every time point is normalized with its own
+    statistics and all the time points are predicted in a single pass (see `TimeSeriesPredictor`).
+
     Args:
-        raw (np.ndarray): Raw input data as a 3D array of shape (Z, Y, X).
+        raw (np.ndarray): Raw input data as a 3D array of shape (Z, Y, X), or (T, Z, Y, X) with `time_series`.
         model_name (str): The name of the model to use.
         patch (Tuple[int, int, int], optional): Patch size for prediction. Defaults to (80, 160, 160).
         single_batch_mode (bool, optional): Whether to use a single batch for prediction. Defaults to True.
@@ -43,30 +159,147 @@ def unet_predictions(
         model_update (bool, optional): Whether to update the model to the latest version. Defaults to False.
         disable_tqdm (bool, optional): If True, disables the tqdm progress bar. Defaults to False.
         handle_multichannel (bool, optional): If True, handles multi-channel output properly. Defaults to False.
+        predictor (str, optional): 'ArrayPredictor' (in memory), 'LazyPredictor' (out-of-core) or 'ShardedPredictor'
+            (multi-process, requires `device='cpu'`). Defaults to 'ArrayPredictor'.
+        output_path (Path, optional): h5 or zarr file where the `LazyPredictor` writes the predictions.
+        output_key (str, optional): Dataset key of the `LazyPredictor` output. Defaults to 'predictions'.
+        tta (bool, optional): If True, average the predictions of the flipped/rotated variants of every patch,
+            computed in the same batches (test-time augmentation). Defaults to False.
+        precision (str, optional): 'float32', 'bfloat16' or 'float16', reduced precisions run the model under
+            autocast, e.g. 'bfloat16' speeds up CPU inference. Defaults to 'float32'.
+        compiled (bool, optional): If True, run a TorchScript trace of the model for the patch shape, cached next
+            to the model weights, or the eager model if the compilation fails. Defaults to False.
+        backend (str, optional): 'torch', or 'onnxruntime' to run an ONNX export of the model, cached next to the
+            model weights, with onnxruntime's CPU execution provider (requires `device='cpu'` and the onnxruntime
+            package, see `load_onnx_model`). Defaults to 'torch'.
+        skip_background (bool, optional): If True, skip the patches without foreground (see `ForegroundSliceBuilder`),
+            found with Otsu's threshold on the subsampled raw data. Defaults to False.
+        foreground_mask (np.ndarray, optional): Boolean (Z, Y, X) mask of the foreground, patches outside of it are
+            skipped. The mask can also be subsampled, e.g. a coarse prediction, its voxels are then mapped to `raw`
+            by nearest neighbour (see `ForegroundSliceBuilder`). Implies `skip_background`.
+        fill_value (float, optional): Prediction of the voxels in the skipped patches. Defaults to 0.
+        tiling (str, optional): 'overlap' for patches overlapping by 25%, or 'halo' for non-overlapping patches
+            with a halo covering the receptive field of the model (see `ModelZoo.compute_halo`), which needs fewer
+            forward passes. The halo tiling is checked on two overlapping patches first and falls back to
+            'overlap' if their predictions differ by more than `TILING_TOLERANCE`. Defaults to 'overlap'.
+        patch_cache (PatchCache, optional): Disk cache of the patch predictions, reused when predicting the same
+            patches again with the same model and settings. Defaults to None (no cache).
+        num_workers (int, optional): Number of processes of the `ShardedPredictor`, see `ShardedPredictor`.
+        num_iterations (int, optional): Number of iterations of the model, each iteration after the first predicts the
+            gaussian smoothed predictions of the previous one (see `IterativePredictor`). Requires the
+            `ArrayPredictor` and a single input channel. Defaults to 1.
+        smoothing_sigma (float, optional): Sigma of the gaussian smoothing between the iterations. Defaults to 1.
+        stream_iterations (bool, optional): If True, the iterations are streamed slab by slab, standardizing the
+            patches of the smoothed predictions on their own instead of with global statistics, which changes the
+            predictions (see `IterativePredictor`). Defaults to False.
+        output_dtype (str, optional): dtype of the prediction maps, 'float32', or 'float16'/'uint16'/'uint8' for
+            compact prediction maps, integer maps are quantized over the full range of the dtype (see
+            `ArrayPredictor`). Defaults to 'float32'.
+        normalization_stats (str, optional): How the global normalization statistics of `raw` are computed, 'exact',
+            'subsampled' or 'robust' (see `global_stats`). They are computed in the dtype of `raw`, which is never
+            converted to float as a whole. Defaults to 'exact'.
+        time_series (bool, optional): If True, `raw` is a time series (T, Z, Y, X), or (T, C, Z, Y, X) for
+            multi-channel models. The patches of consecutive time points are predicted in the same batches, with the
+            `ArrayPredictor` or the `LazyPredictor`, which writes every time point into its own dataset
+            (see `time_point_key`). A (Z, Y, X) `foreground_mask` is shared by all the time points, a (T, Z, Y, X)
+            one gives the mask of every time point. Defaults to False.
+        rescale_factor (Tuple[float, float, float], optional): Rescaling factor of `raw` to the resolution of the
+            model, see `image_rescale`. Every patch is resampled when it is read and the predictions are resampled
+            back to the shape of `raw` while they are blended (see `RescaledVolume` and `RescaledSink`), both with
+            linear interpolation, without rescaled copies of the whole volume. Not supported by the
+            `ShardedPredictor`, the iterative predictions and `foreground_mask`. Defaults to None (no rescaling).
 
     Returns:
         pmap (np.ndarray): The predicted boundaries as a 3D (Z, Y, X) or 4D (C, Z, Y, X) array, normalized between 0 and 1.
+            With the `LazyPredictor`, the path to the output file, whose `output_key` dataset is 4D (C, Z, Y, X).
+            With `time_series`, the time axis is prepended to the predictions, and the `LazyPredictor` writes the
+            time point `t` into the dataset `time_point_key(output_key, t)`.
     """
+    if backend not in SUPPORTED_BACKENDS:
+        raise ValueError(f'Unknown backend {backend}, must be one of {SUPPORTED_BACKENDS}.')
+    if backend == 'onnxruntime' and device != 'cpu':
+        raise ValueError('The `onnxruntime` backend runs on the CPU, use `device="cpu"`.')
+    if tiling not in SUPPORTED_TILINGS:
+        raise ValueError(f'Unknown tiling {tiling}, must be one of {SUPPORTED_TILINGS}.')
+    if predictor not in ('ArrayPredictor', 'LazyPredictor', 'ShardedPredictor'):
+        raise ValueError(
+            f'Unknown predictor {predictor}, must be one of `ArrayPredictor`, `LazyPredictor` or `ShardedPredictor`.'
+        )
+    if predictor == 'ShardedPredictor' and device != 'cpu':
+        raise ValueError('The `ShardedPredictor` runs on the CPU, use `device="cpu"`.')
+    if num_iterations > 1 and predictor != 'ArrayPredictor':
+        raise ValueError('Iterative predictions require the `ArrayPredictor`.')
+    if time_series and (predictor == 'ShardedPredictor' or num_iterations > 1):
+        raise ValueError('Time series require the `ArrayPredictor` or the `LazyPredictor`, in a single iteration.')
+    if rescale_factor is not None and np.array_equal(rescale_factor, [1.0, 1.0, 1.0]):
+        rescale_factor = None
+    if rescale_factor is not None and (
+        predictor == 'ShardedPredictor' or num_iterations > 1 or foreground_mask is not None
+    ):
+        raise ValueError(
+            '`rescale_factor` requires the `ArrayPredictor` or the `LazyPredictor`, in a single iteration and '
+            'without `foreground_mask`.'
+        )
+    if predictor == 'LazyPredictor' and output_path is None:
+        raise ValueError('`output_path` must be provided when using the `LazyPredictor`.')
+
     if config_path is not None:  # Safari mode for custom models outside zoos
         gui_logger.info('Safari prediction: Running model from custom config path.')
-        model, model_config, model_path = model_zoo.get_model_by_config_path(config_path, model_weights_path)
     elif model_id is not None:  # BioImage.IO zoo mode
         gui_logger.info('BioImage.IO prediction: Running model from BioImage.IO model zoo.')
-        model, model_config, model_path = model_zoo.get_model_by_id(model_id)
     elif model_name is not None:  # PlantSeg zoo mode
         gui_logger.info('Zoo prediction: Running model from PlantSeg official zoo.')
-        model, model_config, model_path = model_zoo.get_model_by_name(model_name, model_update=model_update)
+    # weight-loaded models are cached by the zoo, repeated predictions skip loading the model
+    model, model_config, model_path = model_zoo.load_model(
+        model_name=model_name,
+        model_id=model_id,
+        config_path=config_path,
+        model_weights_path=model_weights_path,
+        model_update=model_update,
+        device=device,
+    )
+
+    volumes = [time_point(raw, t) for t in range(raw.shape[0])] if time_series else [raw]
+    if int(model_config['in_channels']) > 1:  # if multi-channel input
+        volumes = [fix_input_shape_to_CZYX(volume) for volume in volumes]
+        multichannel_input = True
+        if num_iterations > 1:
+            raise ValueError('Iterative predictions require a model with a single input channel.')
     else:
-        raise ValueError('Either `model_name` or `model_id` or `model_path` must be provided.')
-    state = torch.load(model_path, map_location='cpu')
+        volumes = [fix_input_shape_to_ZYX(volume) for volume in volumes]
+        multichannel_input = False
+    # using full raw to compute global normalization mean and std, patches are converted to float in `augs`
+    volume_augs = [get_test_augmentations(volume, stats=normalization_stats) for volume in volumes]
+    spatial_shape = tuple(volumes[0].shape[-3:])
+    if rescale_factor is not None:
+        # the normalization statistics of the original volume, the patches are resampled when read
+        rescale_factor = tuple(1.0 if s == 1 else f for s, f in zip(spatial_shape, rescale_factor))
+        volumes = [RescaledVolume(volume, rescale_factor) for volume in volumes]
+        gui_logger.info(f'Resampling the patches by {rescale_factor}, from {spatial_shape} to {volumes[0].shape[-3:]}')
+    raw, augs = volumes[0], volume_augs[0]
 
-    if 'model_state_dict' in state:  # Model weights format may vary between versions
-        state = state['model_state_dict']
-    model.load_state_dict(state)
+    patch_halo = kwargs['patch_halo'] if 'patch_halo' in kwargs else None
+    if tiling == 'halo':
+        patch_halo = _halo_tiling(model, model_config, raw, augs, patch, patch_halo, device, multichannel_input)
+        if patch_halo is None:
+            tiling = 'overlap'
+    if patch_halo is None:
+        patch_halo = get_patch_halo(model_name)  # lazy else statement
 
-    patch_halo = kwargs['patch_halo'] if 'patch_halo' in kwargs else get_patch_halo(model_name)  # lazy else statement
+    input_shape = model_input_shape(model, patch, patch_halo)
+    if backend == 'onnxruntime':
+        model = load_onnx_model(model, model_path, model_config['in_channels'], input_shape)
+    elif compiled:
+        model = compile_model(model, model_path, model_config['in_channels'], input_shape, device, precision)
 
-    predictor = ArrayPredictor(
+    predictor_kwargs = {}
+    if predictor == 'LazyPredictor':
+        predictor_class = LazyPredictor
+    elif predictor == 'ShardedPredictor':
+        predictor_class, predictor_kwargs = ShardedPredictor, {'num_workers': num_workers}
+    else:
+        predictor_class = ArrayPredictor
+    predictor = predictor_class(
         model=model,
         in_channels=model_config['in_channels'],
         out_channels=model_config['out_channels'],
@@ -77,23 +310,93 @@ def unet_predictions(
         headless=False,
         verbose_logging=False,
         disable_tqdm=disable_tqdm,
+        tta=tta,
+        precision=precision,
+        fill_value=fill_value,
+        patch_cache=patch_cache,
+        output_dtype=output_dtype,
+        **predictor_kwargs,
     )
 
-    if int(model_config['in_channels']) > 1:  # if multi-channel input
-        raw = fix_input_shape_to_CZYX(raw)
-        multichannel_input = True
-    else:
-        raw = fix_input_shape_to_ZYX(raw)
-        multichannel_input = False
-    raw = raw.astype('float32')
-    augs = get_test_augmentations(raw)  # using full raw to compute global normalization mean and std
-    stride = get_stride_shape(patch)
-    slice_builder = SliceBuilder(raw, label_dataset=None, patch_shape=patch, stride_shape=stride)
-    test_dataset = ArrayDataset(
-        raw, slice_builder, augs, halo_shape=patch_halo, multichannel=multichannel_input, verbose_logging=False
-    )
+    # with halo tiling the patches do not overlap, the halo alone provides the context of the patch borders
+    stride = patch if tiling == 'halo' else get_stride_shape(patch)
+    test_datasets = []
+    for t, (volume, volume_aug) in enumerate(zip(volumes, volume_augs)):
+        mask = foreground_mask
+        if time_series and mask is not None and mask.ndim == 4:
+            mask = mask[t]
+        if skip_background and mask is None and isinstance(volume, RescaledVolume):
+            # the foreground of the original volume, reading the subsampled resampled volume would resample it whole
+            mask = ForegroundSliceBuilder.threshold_foreground(volume.raw)
+        if skip_background or mask is not None:
+            # the (fractional) subsampling of the mask, 1 for a mask with the shape of the volume
+            downsampling = None if mask is None else [s / m for s, m in zip(volume.shape[-3:], mask.shape)]
+            slice_builder = ForegroundSliceBuilder(
+                volume,
+                label_dataset=None,
+                patch_shape=patch,
+                stride_shape=stride,
+                foreground_mask=mask,
+                downsampling=downsampling,
+            )
+        else:
+            slice_builder = SliceBuilder(volume, label_dataset=None, patch_shape=patch, stride_shape=stride)
+        test_datasets.append(
+            ArrayDataset(
+                volume,
+                slice_builder,
+                volume_aug,
+                halo_shape=patch_halo,
+                multichannel=multichannel_input,
+                verbose_logging=False,
+            )
+        )
 
-    pmaps = predictor(test_dataset)  # pmaps either (C, Z, Y, X) or (C, Y, X)
+    # the predictions have the shape of the original volume, rescaled predictions are resampled back into it
+    shape = (predictor.output_channels(),) + spatial_shape
+    rescaled_shape = (predictor.output_channels(),) + tuple(predictor.volume_shape(test_datasets[0]))
+    if time_series:
+        time_series_predictor = TimeSeriesPredictor(predictor)
+        if isinstance(predictor, LazyPredictor):
+            output_path = Path(output_path)
+            keys = [time_point_key(output_key, t) for t in range(len(test_datasets))]
+            if output_path.suffix == '.zarr':
+                output_file = zarr.open_group(str(output_path), mode='a')
+                sinks = [create_prediction_dataset(output_file, key, shape, patch, output_dtype) for key in keys]
+                time_series_predictor(test_datasets, _prediction_sinks(sinks, rescaled_shape, rescale_factor))
+            else:
+                with h5py.File(output_path, 'a') as output_file:
+                    sinks = [create_prediction_dataset(output_file, key, shape, patch, output_dtype) for key in keys]
+                    time_series_predictor(test_datasets, _prediction_sinks(sinks, rescaled_shape, rescale_factor))
+            return output_path
+
+        pmaps = np.zeros((len(test_datasets),) + shape, dtype=output_dtype)
+        time_series_predictor(test_datasets, _prediction_sinks(list(pmaps), rescaled_shape, rescale_factor))
+        if int(model_config['out_channels']) > 1 and handle_multichannel:
+            return pmaps  # (T, C, Z, Y, X)
+        return pmaps[:, 0]  # (T, Z, Y, X)
+
+    test_dataset = test_datasets[0]
+    if isinstance(predictor, LazyPredictor):
+        output_path = Path(output_path)
+        lazy_predictor = predictor if rescale_factor is None else partial(predict_rescaled, predictor)
+        if output_path.suffix == '.zarr':
+            output_file = zarr.open_group(str(output_path), mode='a')
+            pmaps = create_prediction_dataset(output_file, output_key, shape, patch, output_dtype)
+            lazy_predictor(test_dataset, pmaps)
+        else:
+            with h5py.File(output_path, 'a') as output_file:
+                pmaps = create_prediction_dataset(output_file, output_key, shape, patch, output_dtype)
+                lazy_predictor(test_dataset, pmaps)
+        return output_path
+
+    if rescale_factor is not None:
+        pmaps = predict_rescaled(predictor, test_dataset, np.zeros(shape, dtype=output_dtype))
+    elif num_iterations > 1:
+        iterative_predictor = IterativePredictor(predictor, num_iterations, smoothing_sigma, stream_iterations)
+        pmaps = iterative_predictor(test_dataset)
+    else:
+        pmaps = predictor(test_dataset)  # pmaps either (C, Z, Y, X) or (C, Y, X)
 
     if (
         int(model_config['out_channels']) > 1 and handle_multichannel
@@ -108,3 +411,234 @@ def unet_predictions(
         pmaps = fix_input_shape_to_ZYX(pmaps[0])
 
     return pmaps
+
+
+def _coarse_factor(model_name: str, coarse_model_name: str) -> tuple[float, float, float]:
+    """Rescaling factor from the resolution of `model_name` to the coarser resolution of `coarse_model_name`."""
+    resolution = model_zoo.get_model_resolution(model_name)
+    coarse_resolution = model_zoo.get_model_resolution(coarse_model_name)
+    if resolution is None or coarse_resolution is None:
+        raise ValueError(
+            f'The resolution of {model_name} or {coarse_model_name} is unknown, `coarse_factor` must be provided.'
+        )
+    return tuple(r / c for r, c in zip(resolution, coarse_resolution))
+
+
+def unet_cascade_predictions(
+    raw: np.ndarray,
+    model_name: str,
+    coarse_model_name: Optional[str] = None,
+    coarse_factor: Optional[Tuple[float, float, float]] = None,
+    threshold: float = 0.1,
+    margin: int = 2,
+    patch: Tuple[int, int, int] = (80, 160, 160),
+    single_batch_mode: bool = True,
+    device: str = 'cuda',
+    disable_tqdm: bool = False,
+    fill_value: float = 0.0,
+    **kwargs,
+) -> np.ndarray:
+    """Generate predictions with a coarse-to-fine cascade, running `model_name` only where the tissue is.
+
+    A first pass predicts the boundaries of the raw data downscaled by `coarse_factor` with `coarse_model_name`.
+    The voxels where the coarse prediction exceeds `threshold`, dilated by `margin` coarse voxels, mark the
+    relevant region, and the full resolution pass with `model_name` only predicts the patches overlapping it
+    (see `ForegroundSliceBuilder`). The other voxels are set to `fill_value`, i.e. no boundaries.
+
+    Args:
+        raw (np.ndarray): Raw input data as a 3D array of shape (Z, Y, X).
+        model_name (str): The name of the model used at full resolution.
+        coarse_model_name (str, optional): The name of the model used at the coarse resolution, e.g. a zoo model
+            trained on downsampled data (`..._ds2x`, `..._ds3x`). Defaults to `model_name`.
+        coarse_factor (Tuple[float, float, float], optional): Rescaling factor of the coarse pass, defaults to the
+            ratio of the zoo resolutions of the two models, or (1, 0.5, 0.5) if the same model is used.
+        threshold (float, optional): Coarse prediction above which a voxel is relevant. Defaults to 0.1.
+        margin (int, optional): Dilation of the relevant region in coarse voxels. Defaults to 2.
+        patch (Tuple[int, int, int], optional): Patch size for prediction. Defaults to (80, 160, 160).
+        single_batch_mode (bool, optional): Whether to use a single batch for prediction. Defaults to True.
+        device (str, optional): The computation device ('cpu', 'cuda', etc.). Defaults to 'cuda'.
+        disable_tqdm (bool, optional): If True, disables the tqdm progress bar. Defaults to False.
+        fill_value (float, optional): Prediction of the voxels outside the relevant region. Defaults to 0.
+        kwargs: Further arguments of the full resolution `unet_predictions`, e.g. `patch_halo` or `precision`.
+
+    Returns:
+        pmap (np.ndarray): The predicted boundaries, as returned by `unet_predictions`.
+    """
+    if coarse_model_name is None:
+        coarse_model_name = model_name
+    if coarse_factor is None and coarse_model_name == model_name:
+        coarse_factor = (1.0, 0.5, 0.5)
+    elif coarse_factor is None:
+        coarse_factor = _coarse_factor(model_name, coarse_model_name)
+
+    spatial_shape = raw.shape[-3:] if raw.ndim > 2 else (1,) + raw.shape
+    coarse_factor = tuple(1.0 if s == 1 else f for s, f in zip(spatial_shape, coarse_factor))
+    coarse_raw = image_rescale(raw, ((1.0,) if raw.ndim == 4 else ()) + coarse_factor, order=1)
+    coarse_shape = coarse_raw.shape[-3:] if coarse_raw.ndim > 2 else (1,) + coarse_raw.shape
+    if min(coarse_shape[1:]) < 64:  # too small for a single patch, a cascade would not save anything
+        gui_logger.info(f'The downscaled image {coarse_shape} is too small for a cascade, predicting the whole image')
+        return unet_predictions(
+            raw, model_name, None, patch, single_batch_mode, device, disable_tqdm=disable_tqdm, **kwargs
+        )
+
+    gui_logger.info(f'Coarse prediction with {coarse_model_name} on the image downscaled by {coarse_factor}')
+    _, coarse_model_config, _ = model_zoo.load_model(model_name=coarse_model_name, device=device)
+    if coarse_model_config['name'] == 'UNet2D':
+        coarse_patch = (1,) + tuple(min(p, s) for p, s in zip(patch[1:], coarse_shape[1:]))
+    else:
+        coarse_patch = tuple(min(p, s) for p, s in zip(patch, coarse_shape))
+    coarse_pmap = unet_predictions(
+        coarse_raw,
+        coarse_model_name,
+        None,
+        coarse_patch,
+        single_batch_mode,
+        device,
+        disable_tqdm=disable_tqdm,
+    )
+
+    relevant = coarse_pmap > threshold
+    if margin > 0:
+        relevant = binary_dilation(relevant, iterations=margin)
+    # the coarse relevant region is mapped to the full resolution patches by nearest neighbour
+    foreground_mask = relevant
+
+    return unet_predictions(
+        raw,
+        model_name,
+        None,
+        patch,
+        single_batch_mode,
+        device,
+        disable_tqdm=disable_tqdm,
+        foreground_mask=foreground_mask,
+        fill_value=fill_value,
+        **kwargs,
+    )
+
+
+ENSEMBLE_KEY = 'ensemble'
+
+
+def unet_ensemble_predictions(
+    raw: np.ndarray,
+    model_names: list[str],
+    patch: Tuple[int, int, int] = (80, 160, 160),
+    single_batch_mode: bool = True,
+    device: str = 'cuda',
+    disable_tqdm: bool = False,
+    handle_multichannel: bool = False,
+    average: bool = False,
+    skip_failed_models: bool = False,
+    tta: bool = False,
+    precision: str = 'float32',
+    **kwargs,
+) -> dict[str, np.ndarray]:
+    """Generate predictions from raw data with several PlantSeg zoo models, reading every patch only once.
+
+    The raw data is normalized once, and every patch is extracted and padded once and fed to all the models
+    (see `EnsemblePredictor`). Models with a different number of input channels, dimensionality (2D or 3D) or
+    patch halo need differently shaped patches and are run in separate passes, one per group of compatible models,
+    so every model predicts the same patches as with `unet_predictions`. 2D models predict patches of a single
+    z-slice. With `skip_failed_models`, a failing model is left out without affecting the others of its group.
+
+    Args:
+        raw (np.ndarray): Raw input data as a 3D array of shape (Z, Y, X).
+        model_names (list[str]): The names of the models to use.
+        patch (Tuple[int, int, int], optional): Patch size for prediction. Defaults to (80, 160, 160).
+        single_batch_mode (bool, optional): Whether to use a single batch for prediction. Defaults to True.
+        device (str, optional): The computation device ('cpu', 'cuda', etc.). Defaults to 'cuda'.
+        disable_tqdm (bool, optional): If True, disables the tqdm progress bar. Defaults to False.
+        handle_multichannel (bool, optional): If True, handles multi-channel output properly. Defaults to False.
+        average (bool, optional): If True, also return the average of the predictions of all the models under
+            the key `ENSEMBLE_KEY`, the predictions must have the same shape. Defaults to False.
+        skip_failed_models (bool, optional): If True, models failing to load or predict are logged and left out
+            of the results instead of raising an error. Defaults to False.
+        tta (bool, optional): If True, use test-time augmentation, see `unet_predictions`. Defaults to False.
+        precision (str, optional): 'float32', 'bfloat16' or 'float16', see `unet_predictions`. Defaults to 'float32'.
+
+    Returns:
+        dict[str, np.ndarray]: The predictions of every model by model name, each as in `unet_predictions`.
+    """
+    # models sharing the input channels, dimensionality and halo are predicted from the same patches, each model
+    # keeps its own halo since the predictions of models with group normalization depend on the extent of the input
+    groups = {}
+    for model_name in model_names:
+        try:
+            model, model_config, _ = model_zoo.load_model(model_name=model_name, device=device)
+            patch_halo = list(kwargs['patch_halo']) if 'patch_halo' in kwargs else list(get_patch_halo(model_name))
+        except Exception as e:
+            if not skip_failed_models:
+                raise
+            gui_logger.warning(f'Could not load model {model_name}, skipping it: {e}')
+            continue
+        is_2d = model_config['name'] == 'UNet2D'
+        if is_2d:
+            patch_halo[0] = 0
+        key = (int(model_config['in_channels']), is_2d, tuple(patch_halo))
+        groups.setdefault(key, []).append((model_name, model, model_config))
+
+    pmaps, augs = {}, {}
+    for (in_channels, is_2d, patch_halo), members in groups.items():
+        group_patch = (1,) + tuple(patch[1:]) if is_2d else tuple(patch)
+        names, predictors = [], []
+        for model_name, model, model_config in members:
+            try:
+                predictor = ArrayPredictor(
+                    model=model,
+                    in_channels=in_channels,
+                    out_channels=model_config['out_channels'],
+                    device=device,
+                    patch=group_patch,
+                    patch_halo=list(patch_halo),
+                    single_batch_mode=single_batch_mode,
+                    headless=False,
+                    verbose_logging=False,
+                    disable_tqdm=disable_tqdm,
+                    tta=tta,
+                    precision=precision,
+                )
+            except Exception as e:
+                if not skip_failed_models:
+                    raise
+                gui_logger.warning(f'Could not predict with {model_name}, skipping it: {e}')
+                continue
+            names.append((model_name, model_config))
+            predictors.append(predictor)
+        if not predictors:
+            continue
+
+        multichannel_input = in_channels > 1
+        group_raw = fix_input_shape_to_CZYX(raw) if multichannel_input else fix_input_shape_to_ZYX(raw)
+        if multichannel_input not in augs:  # the global normalization statistics are computed once
+            augs[multichannel_input] = get_test_augmentations(group_raw)
+        stride = get_stride_shape(group_patch)
+        slice_builder = SliceBuilder(group_raw, label_dataset=None, patch_shape=group_patch, stride_shape=stride)
+        test_dataset = ArrayDataset(
+            group_raw,
+            slice_builder,
+            augs[multichannel_input],
+            halo_shape=list(patch_halo),
+            multichannel=multichannel_input,
+            verbose_logging=False,
+        )
+
+        gui_logger.info(f'Running {len(names)} models in a single pass: {", ".join(name for name, _ in names)}')
+        ensemble = EnsemblePredictor(predictors, disable_tqdm=disable_tqdm, skip_failed=skip_failed_models)
+        group_pmaps = ensemble(test_dataset)
+
+        for i, ((model_name, model_config), group_pmap) in enumerate(zip(names, group_pmaps)):
+            if i in ensemble.failed:
+                gui_logger.warning(f'Could not predict with {model_name}, skipping it: {ensemble.failed[i]}')
+                continue
+            if int(model_config['out_channels']) > 1 and handle_multichannel:
+                pmaps[model_name] = fix_input_shape_to_CZYX(group_pmap)
+            else:
+                pmaps[model_name] = fix_input_shape_to_ZYX(group_pmap[0])
+
+    if average and pmaps:
+        shapes = {pmap.shape for pmap in pmaps.values()}
+        if len(shapes) > 1:
+            raise ValueError(f'Cannot average predictions of different shapes {shapes}')
+        pmaps[ENSEMBLE_KEY] = np.mean(list(pmaps.values()), axis=0)
+    return pmaps
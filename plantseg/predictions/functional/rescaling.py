@@ -0,0 +1,158 @@
+import math
+
+import numpy as np
+
+from plantseg.dataprocessing.functional.dataprocessing import to_compact_dtype
+from plantseg.predictions.functional.accumulator import PatchAccumulator
+from plantseg.predictions.functional.array_dataset import ArrayDataset
+from plantseg.predictions.functional.array_predictor import ArrayPredictor
+
+
+def rescaled_shape(shape: tuple[int, ...], factor: tuple[float, ...]) -> tuple[int, ...]:
+    """Shape of an array of `shape` rescaled by `factor`, as `scipy.ndimage.zoom`."""
+    return tuple(int(round(s * f)) for s, f in zip(shape, factor))
+
+
+def _zoom_coordinates(in_size: int, out_size: int, index: np.ndarray) -> np.ndarray:
+    """Coordinates in the input axis of the voxels `index` of the axis zoomed from `in_size` to `out_size`."""
+    # aligned corners, as `scipy.ndimage.zoom` without `grid_mode`
+    ratio = (in_size - 1) / (out_size - 1) if out_size > 1 else 1.0
+    return index * ratio
+
+
+def _interpolate(data: np.ndarray, axis: int, coords: np.ndarray) -> np.ndarray:
+    """Linear interpolation of `data` at the `coords` along `axis`, the coordinates must lie inside `data`."""
+    lower = np.clip(np.floor(coords).astype(np.int64), 0, data.shape[axis] - 1)
+    upper = np.minimum(lower + 1, data.shape[axis] - 1)
+    shape = [1] * data.ndim
+    shape[axis] = len(coords)
+    weights = (coords - lower).astype('float32').reshape(shape)
+    below = np.take(data, lower, axis=axis)
+    return below + (np.take(data, upper, axis=axis) - below) * weights
+
+
+class RescaledVolume:
+    """Read-only view of `raw` rescaled by `factor` along its spatial (last three) axes, resampled when read.
+
+    Every read only reads the voxels of `raw` around the requested region and interpolates them linearly, with the
+    coordinates of `scipy.ndimage.zoom`. It gives the same patches as reading them from
+    `zoom(raw, factor, order=1, mode='nearest')`, without the rescaled copy of the whole volume. `raw` can be in
+    memory or on disk (h5py.Dataset, zarr.Array).
+
+    Args:
+        raw: The (Z, Y, X) or (C, Z, Y, X) volume.
+        factor (tuple[float, float, float]): The rescaling factor of the spatial axes, see `image_rescale`.
+    """
+
+    def __init__(self, raw, factor: tuple[float, float, float]):
+        self.raw = raw
+        self.factor = (1.0,) * (raw.ndim - 3) + tuple(float(f) for f in factor)
+        self.shape = rescaled_shape(raw.shape, self.factor)
+        self.ndim = raw.ndim
+        self.dtype = np.dtype('float32')
+
+    def _normalize_index(self, index) -> list:
+        index = list(index) if isinstance(index, tuple) else [index]
+        if any(i is Ellipsis for i in index):
+            position = index.index(Ellipsis)
+            index[position : position + 1] = [slice(None)] * (self.ndim - len(index) + 1)
+        return index + [slice(None)] * (self.ndim - len(index))
+
+    def __getitem__(self, index) -> np.ndarray:
+        read_index, coords, squeeze = [], [], []
+        for axis, (i, in_size, out_size) in enumerate(zip(self._normalize_index(index), self.raw.shape, self.shape)):
+            if not isinstance(i, slice):
+                squeeze.append(axis)
+                i = slice(int(i) % out_size, int(i) % out_size + 1)
+            out_index = np.arange(out_size)[i]
+            if self.factor[axis] == 1.0 or len(out_index) == 0:
+                read_index.append(i)
+                coords.append(None)
+                continue
+            axis_coords = _zoom_coordinates(in_size, out_size, out_index)
+            start = int(np.floor(axis_coords.min()))
+            stop = min(int(np.floor(axis_coords.max())) + 2, in_size)
+            read_index.append(slice(start, stop))
+            coords.append(axis_coords - start)
+
+        data = np.asarray(self.raw[tuple(read_index)], dtype='float32')
+        for axis, axis_coords in enumerate(coords):
+            if axis_coords is not None:
+                data = _interpolate(data, axis, axis_coords)
+        return data.squeeze(axis=tuple(squeeze)) if squeeze else data
+
+
+class RescaledSink:
+    """Sink of a `PatchAccumulator` blending the predictions of a `RescaledVolume`, resampled back into `sink`.
+
+    The accumulator writes the finished z-slabs of the rescaled prediction maps of `shape` in z order, every slice of
+    `sink` is linearly interpolated as soon as the two rescaled slices around it are received, so only these few
+    slices of the rescaled prediction maps are kept in memory.
+
+    Args:
+        sink: Array-like of shape (C, Z, Y, X) supporting numpy slicing assignment (np.ndarray, h5py.Dataset,
+            zarr.Array) where the prediction maps are written at the original resolution.
+        shape (tuple[int, int, int, int]): Shape (C, Z', Y', X') of the rescaled prediction maps.
+    """
+
+    def __init__(self, sink, shape: tuple[int, int, int, int]):
+        if shape[0] != sink.shape[0]:
+            raise ValueError(f'The sink has {sink.shape[0]} channels, expected {shape[0]}')
+        self.sink = sink
+        self.shape = tuple(shape)
+        self.dtype = np.dtype('float32')
+        self._coords = [
+            _zoom_coordinates(in_size, out_size, np.arange(out_size))
+            for in_size, out_size in zip(self.shape[1:], sink.shape[1:])
+        ]
+        # the rescaled slices [slab_start, received) still needed by the next slices of the sink
+        self._slab = np.zeros((self.shape[0], 0) + self.shape[2:], dtype='float32')
+        self._slab_start = 0
+        self._received = 0
+        self._written = 0
+
+    def __setitem__(self, index, value):
+        _, z_index = index
+        if z_index.start != self._received:
+            raise RuntimeError(f'Expected the slab starting at z = {self._received}, got z = {z_index.start}')
+        self._slab = np.concatenate([self._slab, np.asarray(value, dtype='float32')], axis=1)
+        self._received += value.shape[1]
+        self._write()
+
+    def _write(self) -> None:
+        z_coords = self._coords[0]
+        stop = self._written
+        # a slice needs the rescaled slices floor(z) and floor(z) + 1, if any
+        while stop < len(z_coords) and min(math.floor(z_coords[stop]) + 1, self.shape[1] - 1) < self._received:
+            stop += 1
+        if stop == self._written:
+            return
+
+        slab = _interpolate(self._slab, 1, z_coords[self._written : stop] - self._slab_start)
+        slab = _interpolate(slab, 2, self._coords[1])
+        slab = _interpolate(slab, 3, self._coords[2])
+        self.sink[:, self._written : stop] = to_compact_dtype(slab, self.sink.dtype)
+        self._written = stop
+
+        keep = min(math.floor(z_coords[stop]), self._received) if stop < len(z_coords) else self._received
+        self._slab = self._slab[:, keep - self._slab_start :]
+        self._slab_start = keep
+
+
+def predict_rescaled(predictor: ArrayPredictor, test_dataset: ArrayDataset, sink):
+    """Predict a dataset of a `RescaledVolume` and write the predictions resampled back to its original shape.
+
+    Args:
+        predictor (ArrayPredictor): The predictor running the model.
+        test_dataset (ArrayDataset): The dataset of the `RescaledVolume`.
+        sink: Array-like of shape (C, Z, Y, X) of the original volume where the predictions are written.
+
+    Returns:
+        The `sink`.
+    """
+    shape = (predictor.output_channels(),) + tuple(predictor.volume_shape(test_dataset))
+    accumulator = PatchAccumulator(
+        RescaledSink(sink, shape), predictor.device, blending=predictor.blending, fill_value=predictor.fill_value
+    )
+    predictor.accumulate(predictor.data_loader(test_dataset), accumulator)
+    return sink
@@ -0,0 +1,197 @@
+import copy
+import math
+import multiprocessing
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import Dataset
+
+from plantseg.dataprocessing.functional.dataprocessing import to_compact_dtype
+from plantseg.pipeline import gui_logger
+from plantseg.predictions.functional.accumulator import PatchAccumulator
+from plantseg.predictions.functional.array_predictor import ArrayPredictor
+from plantseg.predictions.functional.compiled_model import CompiledModel
+
+THREADS_PER_WORKER = 8  # the intra-op parallelism of the forward passes scales poorly beyond a few threads
+
+
+class _SlabSink:
+    """Sink of a `PatchAccumulator` whose z-axis starts at `z_offset` of `sink`, writing only into [z_start, z_stop)."""
+
+    def __init__(self, sink: np.ndarray, z_offset: int, depth: int, z_start: int, z_stop: int):
+        self.sink = sink
+        self.z_offset = z_offset
+        self.z_start = z_start
+        self.z_stop = z_stop
+        self.shape = (sink.shape[0], depth) + tuple(sink.shape[2:])
+        self.dtype = sink.dtype
+
+    def __setitem__(self, index, value):
+        _, z_index = index
+        start = max(z_index.start + self.z_offset, self.z_start)
+        stop = min(z_index.start + self.z_offset + value.shape[1], self.z_stop)
+        if start < stop:
+            offset = start - z_index.start - self.z_offset
+            self.sink[:, start:stop] = value[:, offset : offset + stop - start]
+
+
+def _shift_indices(test_loader, z_offset: int):
+    """The batches of `test_loader` with the z-position of the patches shifted by `-z_offset`."""
+    for input_, indices in test_loader:
+        shifted = [
+            (slice(index[0].start - z_offset, index[0].stop - z_offset),) + tuple(index[1:]) for index in indices
+        ]
+        yield input_, shifted
+
+
+def _predict_shard(predictor: ArrayPredictor, dataset: Dataset, shard: dict, raw_file: dict, output_file: dict):
+    """Predict the patches of a shard in a worker process, writing its z-range into the output memmap."""
+    torch.set_num_threads(shard['num_threads'])
+    dataset.raw = np.memmap(mode='r', **raw_file)
+    output = np.memmap(mode='r+', **output_file)
+
+    sink = _SlabSink(output, shard['z_offset'], shard['depth'], shard['z_start'], shard['z_stop'])
+    accumulator = PatchAccumulator(sink, predictor.device, blending=predictor.blending, fill_value=predictor.fill_value)
+    predictor.accumulate(_shift_indices(predictor.data_loader(dataset), shard['z_offset']), accumulator)
+    output.flush()
+
+
+class ShardedPredictor(ArrayPredictor):
+    """Predictor splitting the volume into z-slabs predicted in parallel by several CPU processes.
+
+    On many-core machines a single process scales poorly with the number of intra-op threads of the forward passes.
+    The `ShardedPredictor` splits the volume into `num_workers` z-slabs along the rows of patches and predicts each
+    slab in its own process, with its own copy of the model and `threads_per_worker` threads. A slab is predicted
+    with all the patches overlapping it, so the patches crossing the slab borders are predicted by both neighbouring
+    workers. The input and the prediction maps are shared with the workers through memory-mapped temporary files.
+
+    Every worker predicts its patches in the same batches as a single process and blends them in the same order, so
+    the prediction maps are bitwise identical to the `ArrayPredictor` predictions with the same batch size and number
+    of threads (the results of the forward passes depend on both). The batch size found for a single process is
+    divided by the number of workers to keep the memory usage bounded.
+
+    Workers are started with the 'spawn' method, scripts using the `ShardedPredictor` must be guarded by
+    `if __name__ == '__main__':`.
+
+    Args:
+        See `ArrayPredictor`, in addition:
+        num_workers (int, optional): Number of worker processes. Defaults to one process per `THREADS_PER_WORKER`
+            threads of the current process.
+        threads_per_worker (int, optional): Number of threads of each worker. Defaults to the threads of the current
+            process divided by `num_workers`.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        *args,
+        num_workers: Optional[int] = None,
+        threads_per_worker: Optional[int] = None,
+        **kwargs,
+    ):
+        if isinstance(model, CompiledModel):
+            raise ValueError(
+                'The ShardedPredictor runs the eager model in each worker, compiled models are not supported.'
+            )
+        super().__init__(model, *args, **kwargs)
+        if torch.device(self.device).type != 'cpu':
+            raise ValueError(f'The ShardedPredictor runs on the CPU, got device {self.device}.')
+
+        self.num_workers = num_workers or max(torch.get_num_threads() // THREADS_PER_WORKER, 1)
+        self.threads_per_worker = threads_per_worker or max(torch.get_num_threads() // self.num_workers, 1)
+        self.batch_size = max(self.batch_size // self.num_workers, 1)
+        gui_logger.info(
+            f'Using {self.num_workers} worker processes with {self.threads_per_worker} threads and batch size '
+            f'{self.batch_size} each'
+        )
+
+    def shards(self, test_dataset: Dataset) -> list[dict]:
+        """Split the volume into z-slabs starting at a row of patches, with about the same number of rows each.
+
+        Returns:
+            list[dict]: The shards with the z-range `z_start`, `z_stop` of the slab, the `first` and `last` patch
+                predicted for it (extended to whole batches), the z-range `z_offset`, `depth` of these patches and the
+                `num_threads` of the worker.
+        """
+        raw_slices = test_dataset.raw_slices
+        z_ranges = [(index[-3].start, index[-3].stop) for index in raw_slices]
+        rows = sorted({z_start for z_start, _ in z_ranges})
+        num_shards = min(self.num_workers, len(rows))
+        bounds = [0] + [rows[round(k * len(rows) / num_shards)] for k in range(1, num_shards)]
+        bounds.append(self.volume_shape(test_dataset)[0])
+        batch_size = self._loader_batch_size()
+
+        shards = []
+        for z_start, z_stop in zip(bounds[:-1], bounds[1:]):
+            members = [i for i, (start, stop) in enumerate(z_ranges) if start < z_stop and stop > z_start]
+            # whole batches as in a single process, the extra patches do not overlap the slab
+            first = members[0] // batch_size * batch_size
+            last = min(math.ceil((members[-1] + 1) / batch_size) * batch_size, len(raw_slices))
+            z_offset = min(start for start, _ in z_ranges[first:last])
+            depth = max(stop for _, stop in z_ranges[first:last]) - z_offset
+            shards.append(
+                {
+                    'z_start': z_start,
+                    'z_stop': z_stop,
+                    'first': first,
+                    'last': last,
+                    'z_offset': z_offset,
+                    'depth': depth,
+                    'num_threads': self.threads_per_worker,
+                }
+            )
+        return shards
+
+    def __call__(self, test_dataset: Dataset) -> np.ndarray:
+        if not isinstance(test_dataset.raw, np.ndarray):
+            raise ValueError(
+                'The ShardedPredictor requires an in-memory input, use the LazyPredictor for on-disk data.'
+            )
+        shards = self.shards(test_dataset) if len(test_dataset) > 0 else []
+        if len(shards) < 2:
+            return super().__call__(test_dataset)
+
+        num_patches = sum(shard['last'] - shard['first'] for shard in shards)
+        gui_logger.info(
+            f'Predicting {len(test_dataset)} patches in {len(shards)} z-slabs, '
+            f'{num_patches - len(test_dataset)} patches at the slab borders are predicted twice'
+        )
+
+        raw = test_dataset.raw
+        prediction_maps_shape = (self.output_channels(),) + tuple(self.volume_shape(test_dataset))
+        with tempfile.TemporaryDirectory(prefix='plantseg_shards_') as tmp_dir:
+            raw_file = {'filename': Path(tmp_dir) / 'raw.dat', 'dtype': raw.dtype, 'shape': raw.shape}
+            np.memmap(mode='w+', **raw_file)[...] = raw
+            output_file = {
+                'filename': Path(tmp_dir) / 'predictions.dat',
+                'dtype': self.output_dtype,
+                'shape': prediction_maps_shape,
+            }
+            output = np.memmap(mode='w+', **output_file)
+            if self.fill_value != 0:
+                # the slabs not covered by any patch
+                output[...] = to_compact_dtype(np.float32(self.fill_value), self.output_dtype)
+
+            # the workers attach the input memmap instead of receiving a copy of it
+            dataset = copy.copy(test_dataset)
+            dataset.raw, dataset.raw_padded = None, None
+            tasks = []
+            for shard in shards:
+                shard_dataset = copy.copy(dataset)
+                shard_dataset.raw_slices = test_dataset.raw_slices[shard['first'] : shard['last']]
+                tasks.append((self, shard_dataset, shard, raw_file, output_file))
+
+            pool = multiprocessing.get_context('spawn').Pool(len(tasks))
+            try:
+                pool.starmap(_predict_shard, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+            prediction_map = np.array(output)
+            del output
+        return prediction_map
@@ -1,4 +1,77 @@
+from collections.abc import Sequence
+
 import numpy as np
+from skimage.filters import threshold_otsu
+
+from plantseg.pipeline import gui_logger
+
+
+class PatchIndex(Sequence):
+    """
+    Read-only sequence of the patch positions of a `SliceBuilder`, backed by an (N, 3) array of patch origins.
+    The tuples of slices are built when indexed: (slice, slice, slice), or (slice, slice, slice, slice) with the
+    channel slice first if `channels` is given.
+
+    Args:
+        origins (ndarray): the (z, y, x) origins of the patches, of shape (N, 3)
+        patch_shape (tuple): the shape of the patch DxHxW
+        channels (int, optional): number of channels of the dataset, None if it has no channel dimension
+    """
+
+    def __init__(self, origins, patch_shape, channels=None):
+        self.origins = np.asarray(origins, dtype=np.int64).reshape(-1, 3)
+        self.patch_shape = tuple(patch_shape)
+        self.channels = channels
+
+    def __len__(self):
+        return len(self.origins)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.select(idx)
+        z, y, x = self.origins[idx].tolist()
+        k_z, k_y, k_x = self.patch_shape
+        slice_idx = (slice(z, z + k_z), slice(y, y + k_y), slice(x, x + k_x))
+        if self.channels is not None:
+            slice_idx = (slice(0, self.channels),) + slice_idx
+        return slice_idx
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __contains__(self, slice_idx):
+        origin = [getattr(index, 'start', None) for index in tuple(slice_idx)[-3:]]
+        if len(origin) != 3 or not all(isinstance(start, int) for start in origin):
+            return False
+        candidates = np.flatnonzero((self.origins == origin).all(axis=1))
+        return any(self[idx] == tuple(slice_idx) for idx in candidates)
+
+    def select(self, keep):
+        """The patches selected by `keep`, either a slice, a boolean mask or an array of indices."""
+        return PatchIndex(self.origins[keep], self.patch_shape, self.channels)
+
+
+def _box_counts(volume, starts, stops):
+    """
+    Sum of a (Z, Y, X) boolean or integer `volume` in the boxes [starts, stops) given as (N, 3) arrays. The boxes
+    with the same z-range, i.e. a row of patches, are counted at once from the summed-area table of the volume summed
+    over their z-range, so that only a (Y, X) table is allocated whatever the size of the volume.
+    """
+    counts = np.zeros(len(starts), dtype=np.int64)
+    z_ranges, rows = np.unique(np.stack([starts[:, 0], stops[:, 0]], axis=1), axis=0, return_inverse=True)
+    rows = rows.reshape(-1)
+    table = np.zeros((volume.shape[1] + 1, volume.shape[2] + 1), dtype=np.int64)
+    for row, (z_start, z_stop) in enumerate(z_ranges):
+        members = np.flatnonzero(rows == row)
+        np.sum(volume[z_start:z_stop], axis=0, dtype=np.int64, out=table[1:, 1:])
+        np.cumsum(table, axis=0, out=table)
+        np.cumsum(table, axis=1, out=table)
+        (y_start, x_start), (y_stop, x_stop) = starts[members, 1:].T, stops[members, 1:].T
+        counts[members] = (
+            table[y_stop, x_stop] - table[y_start, x_stop] - table[y_stop, x_start] + table[y_start, x_start]
+        )
+    return counts
 
 
 class SliceBuilder:
@@ -39,29 +112,17 @@ class SliceBuilder:
         and builds an array of slice positions.
 
         Returns:
-            list of slices, i.e.
-            [(slice, slice, slice, slice), ...] if len(shape) == 4
-            [(slice, slice, slice), ...] if len(shape) == 3
+            PatchIndex of the slices, in z, y, x order, i.e. a sequence of
+            (slice, slice, slice, slice) if len(shape) == 4
+            (slice, slice, slice) if len(shape) == 3
         """
-        slices = []
-        if dataset.ndim == 4:
-            in_channels, i_z, i_y, i_x = dataset.shape
-        else:
-            i_z, i_y, i_x = dataset.shape
-
-        k_z, k_y, k_x = patch_shape
-        s_z, s_y, s_x = stride_shape
-        z_steps = SliceBuilder._gen_indices(i_z, k_z, s_z)
-        for z in z_steps:
-            y_steps = SliceBuilder._gen_indices(i_y, k_y, s_y)
-            for y in y_steps:
-                x_steps = SliceBuilder._gen_indices(i_x, k_x, s_x)
-                for x in x_steps:
-                    slice_idx = (slice(z, z + k_z), slice(y, y + k_y), slice(x, x + k_x))
-                    if dataset.ndim == 4:
-                        slice_idx = (slice(0, in_channels),) + slice_idx
-                    slices.append(slice_idx)
-        return slices
+        steps = [
+            np.fromiter(SliceBuilder._gen_indices(i, k, s), dtype=np.int64)
+            for i, k, s in zip(dataset.shape[-3:], patch_shape, stride_shape)
+        ]
+        origins = np.stack(np.meshgrid(*steps, indexing='ij'), axis=-1).reshape(-1, 3)
+        in_channels = dataset.shape[0] if dataset.ndim == 4 else None
+        return PatchIndex(origins, patch_shape, in_channels)
 
     @staticmethod
     def _gen_indices(i, k, s):
@@ -98,19 +159,102 @@ class FilterSliceBuilder(SliceBuilder):
 
         rand_state = np.random.RandomState(47)
 
-        def ignore_predicate(raw_label_idx):
-            label_idx = raw_label_idx[1]
-            patch = np.copy(label_dataset[label_idx])
-            for ii in ignore_index:
-                patch[patch == ii] = 0
-            non_ignore_counts = np.count_nonzero(patch != 0)
-            non_ignore_counts = non_ignore_counts / patch.size
-            return non_ignore_counts > threshold or rand_state.rand() < slack_acceptance
-
-        zipped_slices = zip(self.raw_slices, self.label_slices)
-        # ignore slices containing too much ignore_index
-        filtered_slices = list(filter(ignore_predicate, zipped_slices))
-        # unzip and save slices
-        raw_slices, label_slices = zip(*filtered_slices)
-        self._raw_slices = list(raw_slices)
-        self._label_slices = list(label_slices)
+        # count the non-zero labels not in `ignore_index` of all the patches at once
+        label = np.asarray(label_dataset)
+        non_ignore = label != 0
+        for ii in ignore_index:
+            non_ignore &= label != ii
+        channels = 1
+        if non_ignore.ndim == 4:
+            channels = non_ignore.shape[0]
+            non_ignore = non_ignore.sum(axis=0)
+        origins = self.label_slices.origins
+        non_ignore_counts = _box_counts(non_ignore, origins, origins + np.array(patch_shape))
+        non_ignore_counts = non_ignore_counts / (channels * np.prod(patch_shape))
+
+        # ignore slices containing too much ignore_index, a few of them are accepted at random
+        keep = non_ignore_counts > threshold
+        rejected = np.flatnonzero(~keep)
+        keep[rejected] = rand_state.rand(len(rejected)) < slack_acceptance
+        self._raw_slices = self.raw_slices.select(keep)
+        self._label_slices = self.label_slices.select(keep)
+
+
+class ForegroundSliceBuilder(SliceBuilder):
+    """
+    Skip the patches without foreground, e.g. the empty background around the imaged organ.
+
+    The foreground is either given as a boolean `foreground_mask` of the raw data subsampled by `downsampling`
+    (1 by default, i.e. with the spatial shape (Z, Y, X) of the raw data), or computed by thresholding the raw data
+    subsampled by `downsampling` along every axis (4 by default), with `threshold` or Otsu's threshold if not given.
+    The voxel `j` of a subsampled mask covers the voxels [j * downsampling, (j + 1) * downsampling) of the raw data.
+    The voxels of the skipped patches are left to the predictor (see the `fill_value` of `ArrayPredictor`).
+
+    Args:
+        raw_dataset (ndarray): raw data
+        label_dataset (ndarray): ground truth labels
+        patch_shape (tuple): the shape of the patch DxHxW
+        stride_shape (tuple): the shape of the stride DxHxW
+        foreground_mask (ndarray, optional): boolean foreground mask of shape DxHxW, or of the raw data subsampled
+            by `downsampling`, e.g. a coarse prediction
+        threshold (float, optional): intensity threshold of the foreground, Otsu's threshold if None
+        downsampling (int or tuple, optional): subsampling factor of the foreground mask. A given `foreground_mask`
+            can have a (possibly fractional) factor per axis, defaults to 1. The computed mask subsamples the raw data
+            by an integer factor, defaults to 4
+
+    Attributes:
+        skipped_fraction (float): fraction of the patches without foreground, i.e. of the compute saved
+    """
+
+    def __init__(
+        self,
+        raw_dataset,
+        label_dataset,
+        patch_shape,
+        stride_shape,
+        foreground_mask=None,
+        threshold=None,
+        downsampling=None,
+    ):
+        super().__init__(raw_dataset, label_dataset, patch_shape, stride_shape)
+        if foreground_mask is None:
+            downsampling = 4 if downsampling is None else downsampling
+            foreground_mask = self.threshold_foreground(raw_dataset, threshold, downsampling)
+        else:
+            foreground_mask = np.asarray(foreground_mask, dtype=bool)
+            downsampling = 1 if downsampling is None else downsampling
+        assert foreground_mask.ndim == 3, 'The foreground mask must be 3D'
+        # every axis of the mask spans the corresponding axis of the raw data
+        mask_shape, spatial_shape = np.array(foreground_mask.shape), np.array(raw_dataset.shape[-3:])
+        downsampling = np.broadcast_to(np.asarray(downsampling, dtype='float64'), (3,))
+        assert np.all(
+            np.abs(mask_shape * downsampling - spatial_shape) < downsampling
+        ), f'Mask shape must match the raw shape {tuple(spatial_shape)} subsampled by {tuple(downsampling)}'
+
+        # the mask voxels of the patches, rounded outwards, the border patches cover at least the last mask voxel
+        origins = self.raw_slices.origins
+        starts = np.minimum(np.floor(origins / downsampling).astype(np.int64), mask_shape - 1)
+        stops = np.floor((origins + np.array(patch_shape) - 1) / downsampling).astype(np.int64) + 1
+        stops = np.clip(stops, starts + 1, mask_shape)
+        keep = _box_counts(foreground_mask, starts, stops) > 0
+
+        num_patches, num_kept = len(keep), int(keep.sum())
+        self.skipped_fraction = 1 - num_kept / max(num_patches, 1)
+        gui_logger.info(
+            f'Skipping {num_patches - num_kept} of {num_patches} patches without foreground, '
+            f'saving {100 * self.skipped_fraction:.1f}% of the predictions'
+        )
+
+        self._raw_slices = self.raw_slices.select(keep)
+        if self.label_slices is not None:
+            self._label_slices = self.label_slices.select(keep)
+
+    @staticmethod
+    def threshold_foreground(raw_dataset, threshold=None, downsampling=4):
+        """Threshold the raw data subsampled by `downsampling`, averaged over the channels if any."""
+        raw = np.asarray(raw_dataset[..., ::downsampling, ::downsampling, ::downsampling], dtype='float32')
+        if raw.ndim == 4:
+            raw = raw.mean(axis=0)
+        if threshold is None:
+            threshold = threshold_otsu(raw) if raw.min() < raw.max() else raw.max()
+        return raw > threshold
@@ -0,0 +1,78 @@
+import math
+
+import numpy as np
+import torch
+
+from plantseg.augment.transforms import Compose, Standardize, ToTensor
+from plantseg.predictions.functional.array_dataset import ArrayDataset
+
+
+def _is_pointwise(augs) -> bool:
+    """True if `augs` transforms every voxel independently, i.e. standardizes with global statistics."""
+    transforms = augs.transforms if isinstance(augs, Compose) else [augs]
+    return all(isinstance(t, ToTensor) or (isinstance(t, Standardize) and t.mean is not None) for t in transforms)
+
+
+def is_slice_dataset(dataset: ArrayDataset) -> bool:
+    """True if the patches of `dataset` are single z-slices without z-halo, as for 2D models."""
+    return dataset.halo_shape[0] == 0 and all(index[-3].stop - index[-3].start == 1 for index in dataset.raw_slices[:1])
+
+
+class SliceLoader:
+    """Batches of the patches of a dataset of single z-slices, as the `DataLoader` of an `ArrayDataset`.
+
+    A 2D model predicts the tiles of every z-slice with a halo only in YX. Instead of reading, mirror padding and
+    normalizing every patch on its own, every z-slice of a batch is read once as a whole, mirror padded in YX and,
+    with global statistics, standardized at once, and its tiles are cut from it as views. The batches hold the same
+    patches in the same order as the `DataLoader` with the same batch size, so the predictions are identical.
+
+    Args:
+        dataset (ArrayDataset): The dataset of single z-slice patches, see `is_slice_dataset`.
+        batch_size (int): Number of patches per batch.
+        pin_memory (bool): If True, the batches are copied into pinned memory for faster transfers to the GPU.
+    """
+
+    def __init__(self, dataset: ArrayDataset, batch_size: int, pin_memory: bool = False):
+        if not is_slice_dataset(dataset):
+            raise ValueError('The SliceLoader requires patches of a single z-slice without z-halo')
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.pointwise = _is_pointwise(dataset.augs)
+        # the last padded slice, shared by consecutive batches
+        self._slice = None
+
+    def __len__(self) -> int:
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def _padded_slice(self, channels: tuple, z: int):
+        """The slice `z` mirror padded by the YX halo, normalized if the normalization is pointwise."""
+        key = (channels, z)
+        if self._slice is None or self._slice[0] != key:
+            _, halo_y, halo_x = self.dataset.halo_shape
+            data = np.asarray(self.dataset.raw[channels + (slice(z, z + 1),)])
+            pad_width = [(0, 0)] * (data.ndim - 2) + [(halo_y, halo_y), (halo_x, halo_x)]
+            if halo_y or halo_x:
+                data = np.pad(data, pad_width, mode='reflect')
+            if self.pointwise:
+                data = self.dataset.augs(data)
+            self._slice = (key, data)
+        return self._slice[1]
+
+    def _batch(self, raw_slices: list) -> tuple[torch.Tensor, list]:
+        _, halo_y, halo_x = self.dataset.halo_shape
+        patches, indices = [], []
+        for raw_idx in raw_slices:
+            channels, (z_index, y_index, x_index) = tuple(raw_idx[:-3]), raw_idx[-3:]
+            data = self._padded_slice(channels, z_index.start)
+            tile = data[..., y_index.start : y_index.stop + 2 * halo_y, x_index.start : x_index.stop + 2 * halo_x]
+            patches.append(tile if self.pointwise else self.dataset.augs(tile))
+            indices.append((z_index, y_index, x_index))
+        batch = torch.stack(patches)
+        return (batch.pin_memory() if self.pin_memory else batch), indices
+
+    def __iter__(self):
+        raw_slices = self.dataset.raw_slices
+        for start in range(0, len(raw_slices), self.batch_size):
+            yield self._batch(raw_slices[start : start + self.batch_size])
+        self._slice = None
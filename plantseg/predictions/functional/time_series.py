@@ -0,0 +1,138 @@
+import bisect
+
+import numpy as np
+import torch
+import tqdm
+from torch.utils.data import DataLoader, Dataset
+
+from plantseg.pipeline import gui_logger
+from plantseg.predictions.functional.accumulator import PatchAccumulator
+from plantseg.predictions.functional.array_dataset import ArrayDataset, default_prediction_collate
+from plantseg.predictions.functional.array_predictor import ArrayPredictor
+
+
+class TimePoint:
+    """Read-only view of the time point `t` of an on-disk (T, ...) array (e.g. h5py.Dataset or zarr.Array).
+
+    The view supports numpy slicing, every read only reads the requested part of the time point.
+    """
+
+    def __init__(self, raw, t: int):
+        self.raw = raw
+        self.t = t
+        self.shape = tuple(raw.shape[1:])
+        self.ndim = len(self.shape)
+        self.dtype = raw.dtype
+
+    def __getitem__(self, index):
+        index = index if isinstance(index, tuple) else (index,)
+        return self.raw[(self.t,) + index]
+
+
+def time_point(raw, t: int):
+    """The time point `t` of a (T, ...) time series, a numpy view for in-memory arrays, a `TimePoint` otherwise."""
+    if isinstance(raw, np.ndarray):
+        return raw[t]
+    return TimePoint(raw, t)
+
+
+def time_point_key(key: str, t: int) -> str:
+    """Name of the dataset of the predictions of the time point `t`, e.g. 'predictions_t0003'."""
+    return f'{key}_t{t:04d}'
+
+
+class TimeSeriesDataset(Dataset):
+    """The patches of a sequence of `ArrayDataset`, one per time point, in time order.
+
+    The slices of every patch are prefixed with the slice `t:t+1` of its time point, so that the patches of
+    consecutive time points can be collated into the same batches.
+    """
+
+    def __init__(self, datasets: list[ArrayDataset]):
+        self.datasets = datasets
+        self.offsets = np.cumsum([0] + [len(dataset) for dataset in datasets]).tolist()
+        self.halo_shape = datasets[0].halo_shape
+
+    def __getitem__(self, idx):
+        if idx >= len(self):
+            raise StopIteration
+        t = bisect.bisect_right(self.offsets, idx) - 1
+        patch, raw_idx = self.datasets[t][idx - self.offsets[t]]
+        return patch, (slice(t, t + 1),) + tuple(raw_idx)
+
+    def __len__(self):
+        return self.offsets[-1]
+
+
+class TimeSeriesPredictor:
+    """Predictor running a model on all the time points of a time series in a single pass.
+
+    The patches of all the time points are predicted in the same stream of batches, so a batch is never left
+    partially filled at the end of a time point, and the model is loaded and its batch size determined only once.
+    Every time point is blended by its own `PatchAccumulator` and streamed into its own sink, which is finished
+    as soon as the patches of the next time point are predicted.
+
+    Args:
+        predictor (ArrayPredictor): The predictor running the model.
+    """
+
+    def __init__(self, predictor: ArrayPredictor):
+        self.predictor = predictor
+
+    def __call__(self, test_datasets: list[ArrayDataset], sinks: list) -> list:
+        """Predict the time points `test_datasets` into `sinks`.
+
+        Args:
+            test_datasets (list[ArrayDataset]): The dataset of every time point.
+            sinks (list): For every time point, an array-like of shape (C, Z, Y, X) where its predictions are
+                written (np.ndarray, h5py.Dataset, zarr.Array).
+
+        Returns:
+            The `sinks`.
+        """
+        if len(test_datasets) != len(sinks):
+            raise ValueError(f'Expected a sink per time point, got {len(sinks)} for {len(test_datasets)} time points')
+        for dataset in test_datasets:
+            assert self.predictor.patch_halo == dataset.halo_shape, (
+                f'Predictor halo shape {self.predictor.patch_halo} '
+                f'does not match dataset halo shape {dataset.halo_shape}'
+            )
+
+        test_dataset = TimeSeriesDataset(test_datasets)
+        test_loader = DataLoader(
+            test_dataset,
+            batch_size=self.predictor._loader_batch_size(),
+            pin_memory=True,
+            collate_fn=default_prediction_collate,
+        )
+        accumulators = [
+            PatchAccumulator(
+                sink, self.predictor.device, blending=self.predictor.blending, fill_value=self.predictor.fill_value
+            )
+            for sink in sinks
+        ]
+
+        gui_logger.info(f'Predicting {len(test_datasets)} time points, {len(test_dataset)} patches in total')
+        finished = 0
+        self.predictor.model.eval()
+        with torch.no_grad():
+            for input_, indices in tqdm.tqdm(test_loader, disable=self.predictor.disable_tqdm):
+                predictions = self.predictor.predict_batch(input_)
+                time_points = [index[0].start for index in indices]
+                # the patches come in time order, a batch holds a contiguous run of patches of each time point
+                start = 0
+                for t in sorted(set(time_points)):
+                    stop = start + time_points.count(t)
+                    accumulators[t].add(predictions[start:stop], [index[1:] for index in indices[start:stop]])
+                    start = stop
+                # the time points before the last one of the batch are finished
+                while finished < time_points[-1]:
+                    accumulators[finished].close()
+                    finished += 1
+        while finished < len(accumulators):
+            accumulators[finished].close()
+            finished += 1
+
+        if self.predictor.patch_cache is not None:
+            self.predictor.patch_cache.log_statistics()
+        return sinks
@@ -2,7 +2,8 @@ from plantseg import PATH_PREDICT_TEMPLATE
 from plantseg.augment.transforms import get_test_augmentations
 from plantseg.pipeline import gui_logger
 from plantseg.predictions.functional.array_dataset import ArrayDataset
-from plantseg.predictions.functional.slice_builder import SliceBuilder
+from plantseg.predictions.functional.rescaling import RescaledVolume
+from plantseg.predictions.functional.slice_builder import ForegroundSliceBuilder, SliceBuilder
 from plantseg.models.zoo import model_zoo
 from plantseg.utils import load_config
 
@@ -12,7 +13,18 @@ def get_predict_template():
     return predict_template
 
 
-def get_array_dataset(raw, model_name, patch, stride_ratio, halo_shape, multichannel, global_normalization=True):
+def get_array_dataset(
+    raw,
+    model_name,
+    patch,
+    stride_ratio,
+    halo_shape,
+    multichannel,
+    global_normalization=True,
+    skip_background=False,
+    normalization_stats='exact',
+    rescale_factor=None,
+):
     if model_name == 'UNet2D':
         if patch[0] != 1:
             gui_logger.warning(
@@ -22,13 +34,20 @@ def get_array_dataset(raw, model_name, patch, stride_ratio, halo_shape, multicha
             patch = (1, patch[1], patch[2])
 
     if global_normalization:
-        augs = get_test_augmentations(raw)
+        augs = get_test_augmentations(raw, stats=normalization_stats)
     else:
         # normalize with per patch statistics
         augs = get_test_augmentations(None)
 
+    if rescale_factor is not None:
+        # the patches are resampled to the model resolution when read, normalized with the statistics of `raw`
+        raw = RescaledVolume(raw, rescale_factor)
+
     stride = get_stride_shape(patch, stride_ratio)
-    slice_builder = SliceBuilder(raw, label_dataset=None, patch_shape=patch, stride_shape=stride)
+    if skip_background:
+        slice_builder = ForegroundSliceBuilder(raw, label_dataset=None, patch_shape=patch, stride_shape=stride)
+    else:
+        slice_builder = SliceBuilder(raw, label_dataset=None, patch_shape=patch, stride_shape=stride)
     return ArrayDataset(
         raw, slice_builder, augs, halo_shape=halo_shape, multichannel=multichannel, verbose_logging=False
     )
@@ -48,3 +67,13 @@ def get_patch_halo(model_name):
 def get_stride_shape(patch_shape, stride_ratio=0.75):
     # striding MUST be >=1
     return [max(int(p * stride_ratio), 1) for p in patch_shape]
+
+
+def small_overlap_axes(patch_shape, stride_shape):
+    """Axes along which the overlap of neighbouring patches is too small, which can leave seams in the predictions."""
+    axes = []
+    for axis, (patch, stride) in enumerate(zip(patch_shape, stride_shape)):
+        overlap = patch - stride
+        if (axis == 0 and 1 < overlap <= 8) or (axis > 0 and overlap <= 16):
+            axes.append(axis)
+    return axes
@@ -1,21 +1,45 @@
+import contextlib
+import os
+
+import h5py
 import numpy as np
-import torch
 
-from plantseg.io.io import load_shape
+from plantseg.dataprocessing.functional.dataprocessing import to_compact_dtype
+from plantseg.io.h5 import H5_EXTENSIONS
+from plantseg.io.io import load_shape, open_lazy, smart_load
+from plantseg.io.zarr import ZARR_EXTENSIONS
 from plantseg.models.zoo import model_zoo
 from plantseg.pipeline import gui_logger
-from plantseg.pipeline.steps import GenericPipelineStep
-from plantseg.predictions.functional.array_predictor import ArrayPredictor
+from plantseg.pipeline.steps import COMPACT_PMAPS_ATTR, GenericPipelineStep
+from plantseg.predictions.functional.array_predictor import ArrayPredictor, model_input_shape
+from plantseg.predictions.functional.compiled_model import compile_model
+from plantseg.predictions.functional.lazy_predictor import LazyPredictor, create_prediction_dataset
+from plantseg.predictions.functional.onnx_model import SUPPORTED_BACKENDS, load_onnx_model
+from plantseg.predictions.functional.patch_cache import PatchCache
+from plantseg.predictions.functional.rescaling import RescaledSink, predict_rescaled, rescaled_shape
+from plantseg.predictions.functional.sharded_predictor import ShardedPredictor
+from plantseg.predictions.functional.time_series import TimeSeriesPredictor, time_point
 from plantseg.predictions.functional.utils import get_array_dataset, get_patch_halo
 
+SUPPORTED_PREDICTORS = {
+    'ArrayPredictor': ArrayPredictor,
+    'LazyPredictor': LazyPredictor,
+    'ShardedPredictor': ShardedPredictor,
+}
+
 
-def _check_patch_size(paths, patch_size):
+def _check_patch_size(paths, patch_size, time_series=False, rescale_factor=None):
     axis = ['z', 'x', 'y']
     valid_paths = []
 
     for path in paths:
         incorrect_axis = []
         raw_size = load_shape(path, key='raw')
+        if time_series:
+            raw_size = raw_size[1:]
+        if rescale_factor is not None:
+            # the patches are extracted from the rescaled stack
+            raw_size = rescaled_shape(raw_size[-3:], rescale_factor)
 
         for _ax, _patch_size, _raw_size in zip(axis, patch_size, raw_size):
             if _patch_size > _raw_size:
@@ -55,13 +79,47 @@ class UnetPredictions(GenericPipelineStep):
         out_ext=".h5",
         state=True,
         patch_halo=None,
+        predictor='ArrayPredictor',
+        tta=False,
+        precision='float32',
+        compiled=False,
+        backend='torch',
+        skip_background=False,
+        patch_cache=False,
+        num_workers=None,
+        output_dtype='float32',
+        normalization_stats='exact',
+        prefetch=1,
+        time_series=False,
+        rescale_factor=None,
     ):
+        assert predictor in SUPPORTED_PREDICTORS, f'Unsupported predictor {predictor}'
+        assert backend in SUPPORTED_BACKENDS, f'Unsupported backend {backend}'
+        if backend == 'onnxruntime' and device != 'cpu':
+            raise ValueError('The `onnxruntime` backend runs on the CPU, use `device: "cpu"`.')
+        if predictor == 'ShardedPredictor' and device != 'cpu':
+            gui_logger.warning('The ShardedPredictor runs on the CPU, using device "cpu"')
+            device = 'cpu'
+        if rescale_factor is not None and np.array_equal(rescale_factor, [1.0, 1.0, 1.0]):
+            rescale_factor = None
+        if rescale_factor is not None and predictor == 'ShardedPredictor':
+            gui_logger.warning('Rescaled stacks are predicted in a single process, using the "ArrayPredictor"')
+            predictor = 'ArrayPredictor'
+        if time_series and predictor == 'ShardedPredictor':
+            gui_logger.warning('Time series are predicted in a single process, using the "ArrayPredictor"')
+            predictor = 'ArrayPredictor'
         self.patch = patch
         self.model_name = model_name
         self.stride_ratio = stride_ratio
+        self.skip_background = skip_background
+        self.normalization_stats = normalization_stats
+        self.time_series = time_series
+        self.rescale_factor = rescale_factor
 
         h5_output_key = "predictions"
-        valid_paths = _check_patch_size(input_paths, patch_size=patch) if state else input_paths
+        valid_paths = input_paths
+        if state:
+            valid_paths = _check_patch_size(input_paths, patch, time_series=time_series, rescale_factor=rescale_factor)
 
         super().__init__(
             valid_paths,
@@ -74,23 +132,26 @@ class UnetPredictions(GenericPipelineStep):
             state=state,
             file_suffix='_predictions',
             h5_output_key=h5_output_key,
+            # the LazyPredictor and the time series stream each stack from and to disk themselves
+            prefetch=0 if predictor == 'LazyPredictor' or time_series else prefetch,
         )
 
-        model, model_config, model_path = model_zoo.get_model_by_name(model_name, model_update=model_update)
-        state = torch.load(model_path, map_location='cpu')
-
-        # ensure compatibility with models trained with pytorch-3dunet
-        if 'model_state_dict' in state:
-            state = state['model_state_dict']
-
-        model.load_state_dict(state)
+        model, model_config, model_path = model_zoo.load_model(
+            model_name=model_name, model_update=model_update, device=device
+        )
 
         if patch_halo is None:
             patch_halo = get_patch_halo(model_name)
         self.halo_shape = patch_halo
+        input_shape = model_input_shape(model, self.patch, patch_halo)
+        if backend == 'onnxruntime':
+            model = load_onnx_model(model, model_path, model_config['in_channels'], input_shape)
+        elif compiled:
+            model = compile_model(model, model_path, model_config['in_channels'], input_shape, device, precision)
         is_embedding = not model_config.get('is_segmentation', True)
+        predictor_kwargs = {'num_workers': num_workers} if predictor == 'ShardedPredictor' else {}
         self.multichannel_input = int(model_config['in_channels']) > 1
-        self.predictor = ArrayPredictor(
+        self.predictor = SUPPORTED_PREDICTORS[predictor](
             model=model,
             in_channels=model_config['in_channels'],
             out_channels=model_config['out_channels'],
@@ -100,6 +161,11 @@ class UnetPredictions(GenericPipelineStep):
             single_batch_mode=False,
             headless=True,
             is_embedding=is_embedding,
+            tta=tta,
+            precision=precision,
+            patch_cache=PatchCache() if patch_cache else None,
+            output_dtype=output_dtype,
+            **predictor_kwargs,
         )
 
     def process(self, raw: np.ndarray) -> np.ndarray:
@@ -110,6 +176,185 @@ class UnetPredictions(GenericPipelineStep):
             stride_ratio=self.stride_ratio,
             halo_shape=self.halo_shape,
             multichannel=self.multichannel_input,
+            skip_background=self.skip_background,
+            normalization_stats=self.normalization_stats,
+            rescale_factor=self._stack_rescale_factor(raw.shape),
         )
+        if self.rescale_factor is not None:
+            # the predictions are resampled back to the shape of the stack while they are blended
+            pmaps = np.zeros((self.predictor.output_channels(),) + raw.shape[-3:], dtype=self.predictor.output_dtype)
+            return predict_rescaled(self.predictor, dataset, pmaps)
         pmaps = self.predictor(dataset)
         return pmaps
+
+    def _stack_rescale_factor(self, shape):
+        """Rescaling factor of a stack of `shape`, without rescaling single slices along z, None if not rescaled."""
+        if self.rescale_factor is None:
+            return None
+        return tuple(1.0 if s == 1 else float(f) for s, f in zip(shape[-3:], self.rescale_factor))
+
+    def __call__(self):
+        output_paths = super().__call__()
+        if self.state and self.time_series:
+            # one output file per time point, processed by the next steps as separate stacks
+            return [path for time_point_paths in output_paths for path in time_point_paths]
+        return output_paths
+
+    def read_process_write(self, input_path):
+        if self.time_series:
+            return self._read_process_write_time_series(input_path)
+        if not isinstance(self.predictor, LazyPredictor):
+            return super().read_process_write(input_path)
+
+        with open_lazy(input_path, key=self.input_key) as (raw, (voxel_size, shape, key, _)):
+            if self.h5_output_key is None:
+                self.h5_output_key = key
+
+            # compact prediction maps are saved in their dtype whatever the output type
+            supported_output = self.output_type == 'data_float32' or self.predictor.output_dtype != 'float32'
+            if len(shape) != 3 or self.input_channel is not None or not supported_output:
+                gui_logger.warning(
+                    f'LazyPredictor supports only 3D single channel inputs with float32 or compact output, '
+                    f'loading {input_path} in memory'
+                )
+                return super().read_process_write(input_path)
+
+            # the input is standardized per patch, rescaling it to [0, 1] as in `load_stack` has no effect
+            gui_logger.info(f'Predicting stack lazily from {input_path}')
+            dataset = get_array_dataset(
+                raw,
+                self.model_name,
+                patch=self.patch,
+                stride_ratio=self.stride_ratio,
+                halo_shape=self.halo_shape,
+                multichannel=self.multichannel_input,
+                skip_background=self.skip_background,
+                normalization_stats=self.normalization_stats,
+                rescale_factor=self._stack_rescale_factor(shape),
+            )
+
+            output_path = self._create_output_path(input_path)
+            gui_logger.info(f'Saving results in {output_path}')
+            with h5py.File(output_path, 'w') as f:
+                prediction_shape = (self.predictor.output_channels(),) + tuple(shape)
+                pmaps = create_prediction_dataset(
+                    f, self.h5_output_key, prediction_shape, self.patch, dtype=self.predictor.output_dtype
+                )
+                if self.rescale_factor is not None:
+                    predict_rescaled(self.predictor, dataset, pmaps)
+                else:
+                    self.predictor(dataset, pmaps)
+                self._normalize_01_lazy(pmaps)
+                pmaps.attrs['element_size_um'] = voxel_size
+                self._mark_compact(pmaps)
+
+        self._log_params(output_path)
+        return output_path
+
+    def _read_process_write_time_series(self, input_path):
+        """Predict all the time points of a (T, Z, Y, X) stack in a single pass, see `TimeSeriesPredictor`.
+
+        Every time point is streamed into its own output file, named after `input_path` with the time point suffix
+        '_t0000', '_t0001', ...
+
+        Returns:
+            list[str]: The paths of the output files of the time points.
+        """
+        with contextlib.ExitStack() as stack:
+            base, ext = os.path.splitext(input_path)
+            if ext in H5_EXTENSIONS + ZARR_EXTENSIONS:
+                raw, (voxel_size, shape, key, _) = stack.enter_context(open_lazy(input_path, key=self.input_key))
+            else:
+                raw, (voxel_size, shape, key, _) = smart_load(input_path, key=self.input_key)
+            if self.h5_output_key is None:
+                self.h5_output_key = key
+
+            expected_ndim = 5 if self.multichannel_input else 4
+            if len(shape) != expected_ndim:
+                raise ValueError(
+                    f'Expected a {expected_ndim}D time series in {input_path}, got a stack of shape {tuple(shape)}'
+                )
+
+            gui_logger.info(f'Predicting {shape[0]} time points from {input_path}')
+            datasets = [
+                get_array_dataset(
+                    time_point(raw, t),
+                    self.model_name,
+                    patch=self.patch,
+                    stride_ratio=self.stride_ratio,
+                    halo_shape=self.halo_shape,
+                    multichannel=self.multichannel_input,
+                    skip_background=self.skip_background,
+                    normalization_stats=self.normalization_stats,
+                    rescale_factor=self._stack_rescale_factor(shape),
+                )
+                for t in range(shape[0])
+            ]
+
+            output_paths, sinks = [], []
+            prediction_shape = (self.predictor.output_channels(),) + tuple(shape[-3:])
+            for t in range(shape[0]):
+                output_paths.append(self._create_output_path(f'{base}_t{t:04d}{ext}'))
+                f = stack.enter_context(h5py.File(output_paths[-1], 'w'))
+                sinks.append(
+                    create_prediction_dataset(
+                        f, self.h5_output_key, prediction_shape, self.patch, dtype=self.predictor.output_dtype
+                    )
+                )
+            gui_logger.info(f'Saving results in {os.path.dirname(output_paths[0])}')
+            predictor_sinks = sinks
+            if self.rescale_factor is not None:
+                # the predictions are resampled back to the shape of the time points while they are blended
+                rescaled_shape = (self.predictor.output_channels(),) + tuple(self.predictor.volume_shape(datasets[0]))
+                predictor_sinks = [RescaledSink(sink, rescaled_shape) for sink in sinks]
+            TimeSeriesPredictor(self.predictor)(datasets, predictor_sinks)
+
+            for pmaps in sinks:
+                self._normalize_01_lazy(pmaps)
+                pmaps.attrs['element_size_um'] = tuple(voxel_size)[-3:]
+                self._mark_compact(pmaps)
+
+        for output_path in output_paths:
+            self._log_params(output_path)
+        return output_paths
+
+    def _adjust_input_type(self, data):
+        # the patches are standardized with the global statistics of the stack, computed in its dtype (see
+        # `global_stats`), rescaling it to [0, 1] has no effect and would need a float32 copy of the whole stack
+        return data
+
+    def _adjust_output_type(self, data):
+        if self.predictor.output_dtype == 'float32':
+            return super()._adjust_output_type(data)
+        # compact prediction maps are rescaled in place and saved in their dtype, whatever the output type
+        self._normalize_01_lazy(data)
+        return data
+
+    def save_output(self, data, output_path, voxel_size):
+        super().save_output(data, output_path, voxel_size)
+        if os.path.splitext(output_path)[1] in H5_EXTENSIONS:
+            with h5py.File(output_path, 'a') as f:
+                self._mark_compact(f[self.h5_output_key])
+
+    def _mark_compact(self, dataset):
+        """Mark compact prediction maps, which the segmentation steps load without rescaling them to float32"""
+        if self.predictor.output_dtype != 'float32':
+            dataset.attrs[COMPACT_PMAPS_ATTR] = True
+
+    @staticmethod
+    def _normalize_01_lazy(dataset):
+        """Rescale a dataset of shape (C, Z, Y, X) to [0, 1] slab by slab, as `_normalize_01`, keeping its dtype
+
+        The slabs are aligned with the chunks of the dataset, so every chunk is decompressed once per pass.
+        """
+        chunks = getattr(dataset, 'chunks', None)
+        step = chunks[1] if chunks else 1
+        slabs = [slice(z, min(z + step, dataset.shape[1])) for z in range(0, dataset.shape[1], step)]
+        min_value, max_value = np.inf, -np.inf
+        for slab in slabs:
+            data = dataset[:, slab]
+            min_value, max_value = min(min_value, np.min(data)), max(max_value, np.max(data))
+        min_value, max_value = np.float32(min_value), np.float32(max_value)
+        for slab in slabs:
+            data = (dataset[:, slab].astype('float32') - min_value) / (max_value - min_value + 1e-12)
+            dataset[:, slab] = to_compact_dtype(data, dataset.dtype)
@@ -15,6 +15,12 @@ def create_parser():
     arg_parser.add_argument('--headless', type=Path, help='Path to a .pkl workflow')
     arg_parser.add_argument('--version', action='store_true', help='Print PlantSeg version')
     arg_parser.add_argument('--clean', action='store_true', help='Remove all models from "~/.plantseg_models"')
+    arg_parser.add_argument(
+        '--autotune',
+        action='store_true',
+        help='Benchmark the patch shape, stride and batch size of the CNN prediction on the first input of CONFIG '
+        'and write the fastest setting into CONFIG (and into the custom model zoo record of the model)',
+    )
     return arg_parser.parse_args()
 
 
@@ -77,6 +83,63 @@ def process_config(path: Path):
         raw2seg(config)
 
 
+def autotune_config(path: Path):
+    """Autotune the CNN prediction settings of the YAML config file and write the fastest ones into it."""
+    import os
+    from contextlib import ExitStack
+
+    import numpy as np
+
+    from plantseg.io import H5_EXTENSIONS, ZARR_EXTENSIONS, open_lazy, smart_load
+    from plantseg.models.zoo import model_zoo
+    from plantseg.pipeline.utils import load_paths
+    from plantseg.predictions.functional.autotune import autotune
+    from plantseg.utils import save_config
+
+    config = load_config(path)
+    preprocessing, cnn_prediction = config['preprocessing'], config['cnn_prediction']
+    input_path, key = load_paths(config['path'])[0], preprocessing.get('key', None)
+    with ExitStack() as stack:
+        # h5 and zarr stacks are opened lazily, autotune only reads a crop of their center
+        if os.path.splitext(input_path)[1] in H5_EXTENSIONS + ZARR_EXTENSIONS:
+            raw, _ = stack.enter_context(open_lazy(input_path, key=key))
+        else:
+            raw, _ = smart_load(input_path, key=key)
+        if preprocessing.get('channel', None) is not None:
+            raw = raw[preprocessing['channel']]
+        if raw.ndim < 3:  # a single image, read as a whole
+            raw = raw[...]
+
+        # the network runs on the rescaled volumes, but the timings only depend on the patch shape
+        volume_shape = raw.shape[-3:]
+        if preprocessing.get('state', False):
+            factor = preprocessing.get('factor', [1, 1, 1])
+            volume_shape = tuple(int(np.round(s * f)) for s, f in zip(volume_shape, factor))
+
+        model_name = cnn_prediction['model_name']
+        results = autotune(
+            raw,
+            model_name,
+            device=cnn_prediction.get('device', 'cuda'),
+            volume_shape=volume_shape,
+            patch_halo=cnn_prediction.get('patch_halo', None),
+            precision=cnn_prediction.get('precision', 'float32'),
+        )
+    best = results[0]
+    print(
+        f"Fastest setting: patch {list(best['patch'])}, stride ratio {best['stride_ratio']}, "
+        f"batch size {best['batch_size']} ({best['voxels_per_second'] / 1e6:.2f} Mvoxels/s)"
+    )
+
+    cnn_prediction['patch'] = list(best['patch'])
+    # the pipeline uses the largest batch size fitting in memory, which is not part of the config
+    cnn_prediction['stride_ratio'] = best['stride_ratio']
+    save_config(config, path)
+    print(f'Updated {path}')
+    if model_zoo.set_model_patch_size(model_name, best['patch']):
+        print(f'Updated the recommended patch size of {model_name} in {model_zoo.path_zoo_custom}')
+
+
 def main():
     """Main function to parse arguments and call corresponding functionality."""
     args = create_parser()
@@ -92,6 +155,8 @@ def main():
         launch_napari()
     elif args.headless:
         run_headless_workflow(args.headless)
+    elif args.config and args.autotune:
+        autotune_config(args.config)
     elif args.config:
         process_config(args.config)
     else:
@@ -9,6 +9,7 @@ from elf.segmentation.multicut import multicut_kernighan_lin
 from elf.segmentation.watershed import distance_transform_watershed, apply_size_filter
 from vigra.filters import gaussianSmoothing
 
+from plantseg.dataprocessing.functional.dataprocessing import from_compact_dtype
 from plantseg.segmentation.functional.utils import shift_affinities, compute_mc_costs
 
 try:
@@ -19,6 +20,11 @@ except ImportError:
     sitk_installed = False
 
 
+def _compact_distance_transform_watershed(boundary_pmaps: np.ndarray, **kwargs):
+    """`distance_transform_watershed` of a single slice, converted to float32 only here."""
+    return distance_transform_watershed(from_compact_dtype(boundary_pmaps), **kwargs)
+
+
 def dt_watershed(
     boundary_pmaps: np.ndarray,
     threshold: float = 0.5,
@@ -35,7 +41,9 @@ def dt_watershed(
     """Performs watershed segmentation using distance transforms on boundary probability maps.
 
     Args:
-        boundary_pmaps (np.ndarray): Input height maps, typically boundary probability maps from a CNN.
+        boundary_pmaps (np.ndarray): Input height maps, typically boundary probability maps from a CNN. Compact
+            float16/uint8/uint16 maps (see `to_compact_dtype`) are converted to float32 one slice at a time if
+            `stacked`, otherwise once.
         threshold (float): Threshold applied to boundary maps before distance transform.
         sigma_seeds (float): Smoothing factor for the watershed seed map..
         stacked (bool): If True, performs watershed slice-by-slice (2D), otherwise in 3D.
@@ -52,7 +60,6 @@ def dt_watershed(
 
     """
     # Prepare the keyword arguments for the watershed function
-    boundary_pmaps = boundary_pmaps.astype('float32')
     ws_kwargs = {
         "threshold": threshold,
         "sigma_seeds": sigma_seeds,
@@ -66,11 +73,11 @@ def dt_watershed(
     if stacked:
         # Apply watershed in 2D, slice by slice
         segmentation, _ = stacked_watershed(
-            boundary_pmaps, ws_function=distance_transform_watershed, n_threads=n_threads, **ws_kwargs
+            boundary_pmaps, ws_function=_compact_distance_transform_watershed, n_threads=n_threads, **ws_kwargs
         )
     else:
         # Apply watershed in 3D
-        segmentation, _ = distance_transform_watershed(boundary_pmaps, **ws_kwargs)
+        segmentation, _ = distance_transform_watershed(from_compact_dtype(boundary_pmaps), **ws_kwargs)
 
     return segmentation
 
@@ -87,7 +94,8 @@ def gasp(
     Perform segmentation using the GASP algorithm with affinity maps.
 
     Args:
-        boundary_pmaps (np.ndarray): Cell boundary predictions.
+        boundary_pmaps (np.ndarray): Cell boundary predictions. Compact float16/uint8/uint16 maps (see
+            `to_compact_dtype`) are converted to the float32 affinities one slice at a time.
         superpixels (Optional[np.ndarray]): Superpixel segmentation. If None, GASP will be run from the pixels. Default is None.
         gasp_linkage_criteria (str): Linkage criteria for GASP. Default is 'average'.
         beta (float): Beta parameter for GASP. Small values steer towards under-segmentation, while high values bias towards over-segmentation. Default is 0.5.
@@ -110,16 +118,15 @@ def gasp(
     }
 
     # Interpret boundary_pmaps as affinities and prepare for GASP
-    boundary_pmaps = boundary_pmaps.astype('float32')
-    affinities = np.stack([boundary_pmaps] * 3, axis=0)
-
     offsets = [[0, 0, 1], [0, 1, 0], [1, 0, 0]]
+    # the inverted affinities are filled one slice at a time, without float32 copies of the whole boundary_pmaps
+    affinities = np.empty((len(offsets),) + boundary_pmaps.shape, dtype='float32')
+    for z in range(boundary_pmaps.shape[0]):
+        affinities[:, z] = 1 - from_compact_dtype(boundary_pmaps[z])
+
     # Shift is required to correct aligned affinities
     affinities = shift_affinities(affinities, offsets=offsets)
 
-    # invert affinities
-    affinities = 1 - affinities
-
     # Initialize and run GASP
     gasp_instance = GaspFromAffinities(
         offsets,
@@ -129,10 +136,13 @@ def gasp(
         beta_bias=beta,
     )
     segmentation, _ = gasp_instance(affinities)
+    del affinities
 
     # Apply size filtering if specified
     if post_minsize > 0:
-        segmentation, _ = apply_size_filter(segmentation.astype('uint32'), boundary_pmaps, post_minsize)
+        segmentation, _ = apply_size_filter(
+            segmentation.astype('uint32'), from_compact_dtype(boundary_pmaps), post_minsize
+        )
 
     return segmentation
 
@@ -190,7 +200,7 @@ def multicut(
     rag = compute_rag(superpixels)
 
     # Prob -> edge costs
-    boundary_pmaps = boundary_pmaps.astype('float32')
+    boundary_pmaps = from_compact_dtype(boundary_pmaps)
     costs = compute_mc_costs(boundary_pmaps, rag, beta=beta)
 
     # Creating graph
@@ -233,11 +243,11 @@ def lifted_multicut_from_nuclei_pmaps(
     rag = compute_rag(superpixels)
 
     # compute multi cut edges costs
-    boundary_pmaps = boundary_pmaps.astype('float32')
+    boundary_pmaps = from_compact_dtype(boundary_pmaps)
     costs = compute_mc_costs(boundary_pmaps, rag, beta)
 
     # assert nuclei pmaps are floats
-    nuclei_pmaps = nuclei_pmaps.astype('float32')
+    nuclei_pmaps = from_compact_dtype(nuclei_pmaps)
     input_maps = [nuclei_pmaps]
     assignment_threshold = 0.9
 
@@ -282,7 +292,7 @@ def lifted_multicut_from_nuclei_segmentation(
     rag = compute_rag(superpixels)
 
     # compute multi cut edges costs
-    boundary_pmaps = boundary_pmaps.astype('float32')
+    boundary_pmaps = from_compact_dtype(boundary_pmaps)
     costs = compute_mc_costs(boundary_pmaps, rag, beta)
     max_cost = np.abs(np.max(costs))
     lifted_uvs, lifted_costs = lifted_problem_from_segmentation(
@@ -326,6 +336,7 @@ def simple_itk_watershed(
     if not sitk_installed:
         raise ValueError('please install sitk before running this process')
 
+    boundary_pmaps = from_compact_dtype(boundary_pmaps)
     if sigma > 0:
         # fix ws sigma length
         # ws sigma cannot be shorter than pmaps dims
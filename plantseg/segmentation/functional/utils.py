@@ -4,6 +4,10 @@ from elf.segmentation.multicut import transform_probabilities_to_costs
 
 
 def shift_affinities(affinities, offsets):
+    if all(int(off / 2) == 0 for offset in offsets for off in offset):
+        # offsets of a single voxel are not shifted, avoid the padded copies of the affinities
+        return affinities
+
     rolled_affs = []
     for i, _ in enumerate(offsets):
         offset = offsets[i]
@@ -3,6 +3,7 @@ from functools import partial
 
 from elf.segmentation.watershed import apply_size_filter
 
+from plantseg.dataprocessing.functional.dataprocessing import from_compact_dtype
 from plantseg.pipeline import gui_logger
 from plantseg.pipeline.steps import AbstractSegmentationStep
 from plantseg.segmentation.functional.segmentation import dt_watershed, multicut
@@ -71,7 +72,7 @@ class MulticutFromPmaps(AbstractSegmentationStep):
         segmentation = multicut(pmaps, superpixels=ws, beta=self.beta, post_minsize=self.post_minsize)
 
         if self.post_minsize > self.ws_minsize:
-            segmentation, _ = apply_size_filter(segmentation, pmaps, self.post_minsize)
+            segmentation, _ = apply_size_filter(segmentation, from_compact_dtype(pmaps), self.post_minsize)
 
         # stop real world clock timer
         runtime = time.time() - runtime
@@ -457,6 +457,9 @@ class AbstractUNet(nn.Module):
         if 'g' in layer_order:
             assert num_groups is not None, "num_groups must be specified if GroupNorm is used"
 
+        # number of feature maps at each level, identifies the architecture (e.g. in the cached memory models)
+        self.f_maps = tuple(f_maps)
+
         # create encoder path
         self.encoders = create_encoders(
             in_channels, f_maps, conv_kernel_size, conv_padding, layer_order, num_groups, pool_kernel_size, is3d
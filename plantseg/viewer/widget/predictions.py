@@ -9,8 +9,8 @@ from napari.layers import Image
 from napari.qt.threading import thread_worker
 from napari.types import LayerDataTuple
 
-from plantseg.dataprocessing.functional import image_gaussian_smoothing
-from plantseg.predictions.functional import unet_predictions
+from plantseg.predictions.functional import unet_predictions, unet_ensemble_predictions
+from plantseg.predictions.functional.patch_cache import PatchCache
 from plantseg.viewer.logging import napari_formatted_logging
 from plantseg.viewer.widget.proofreading.proofreading import widget_split_and_merge_from_scribbles
 from plantseg.viewer.widget.segmentation import widget_agglomeration, widget_lifted_multicut, widget_dt_ws
@@ -290,32 +290,27 @@ def _on_model_id_changed():
 
 
 def _compute_multiple_predictions(image, patch_size, patch_halo, device, use_custom_models=True):
-    out_layers = []
     model_list = model_zoo.list_models(use_custom_models=use_custom_models)
-    for i, model_name in enumerate(model_list):
-        napari_formatted_logging(
-            f'Running UNet Predictions: {model_name} {i}/{len(model_list)}', thread='UNet Grid Predictions'
-        )
+    napari_formatted_logging(f'Running UNet Predictions of {len(model_list)} models', thread='UNet Grid Predictions')
+    # every patch is read once and predicted by all the models, models which fail are skipped
+    pmaps = unet_ensemble_predictions(
+        raw=image.data,
+        model_names=model_list,
+        patch=patch_size,
+        single_batch_mode=True,
+        device=device,
+        patch_halo=patch_halo,
+        skip_failed_models=True,
+    )
 
+    out_layers = []
+    for model_name, pmap in pmaps.items():
         out_name = create_layer_name(image.name, model_name)
         layer_kwargs = layer_properties(name=out_name, scale=image.scale, metadata=image.metadata)
         # this is used to warn the user that the layer is a pmap
         layer_kwargs['metadata']['pmap'] = True
         layer_type = 'image'
-        try:
-            pmap = unet_predictions(
-                raw=image.data,
-                model_name=model_name,
-                model_id=None,
-                patch=patch_size,
-                single_batch_mode=True,
-                device=device,
-                patch_halo=patch_halo,
-            )
-            out_layers.append((pmap, layer_kwargs, layer_type))
-
-        except Exception:
-            print(f'Error while processing: {model_name}')
+        out_layers.append((pmap, layer_kwargs, layer_type))
 
     return out_layers
 
@@ -368,20 +363,19 @@ def _on_widget_test_all_unet_predictions_image_change(image: Image):
 def _compute_iterative_predictions(
     pmap, model_name, num_iterations, sigma, patch_size, patch_halo, single_batch_mode, device
 ):
-    func = partial(
-        unet_predictions,
+    # the model stays loaded across the iterations, the patches of earlier runs are reused when re-running
+    return unet_predictions(
+        pmap,
         model_name=model_name,
+        model_id=None,
         patch=patch_size,
         patch_halo=patch_halo,
         single_batch_mode=single_batch_mode,
         device=device,
+        patch_cache=PatchCache(),
+        num_iterations=num_iterations,
+        smoothing_sigma=sigma,
     )
-    for i in range(num_iterations - 1):
-        pmap = func(pmap)
-        pmap = image_gaussian_smoothing(image=pmap, sigma=sigma)
-
-    pmap = func(pmap)
-    return pmap
 
 
 @magicgui(
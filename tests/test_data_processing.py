@@ -2,8 +2,15 @@ import os
 
 import h5py
 import numpy as np
+import pytest
+import yaml
 
 from plantseg.dataprocessing.dataprocessing import DataPostProcessing3D, DataPreProcessing3D
+from plantseg.dataprocessing.functional.dataprocessing import normalize_01
+from plantseg.pipeline.steps import COMPACT_PMAPS_ATTR
+from plantseg.segmentation.dtws import DistanceTransformWatershed
+from plantseg.segmentation.utils import configure_segmentation_step
+from tests.conftest import TEST_FILES
 
 
 class TestDataProcessing:
@@ -141,3 +148,77 @@ class TestDataProcessing:
             voxel_size = f['raw'].attrs['element_size_um']
 
         assert np.allclose(expected_voxel_size, voxel_size)
+
+    def test_pipelined_processing(self, tmpdir):
+        paths = []
+        for i in range(4):
+            paths.append(os.path.join(tmpdir, f'test_{i}.h5'))
+            with h5py.File(paths[-1], 'w') as f:
+                f.create_dataset('raw', data=np.random.rand(8, 64, 64))
+
+        expected = {}
+        for prefetch in [0, 1, 2]:
+            pre = DataPreProcessing3D(
+                paths,
+                save_directory=f"PreProcessing_{prefetch}",
+                filter_type="gaussian",
+                filter_param=1.0,
+            )
+            # load the next files and save the previous ones in background threads
+            pre.prefetch = prefetch
+            output_paths = pre()
+
+            assert output_paths == [
+                os.path.join(tmpdir, f"PreProcessing_{prefetch}", os.path.basename(p)) for p in paths
+            ]
+            for path in output_paths:
+                with h5py.File(path, 'r') as f:
+                    raw = f['raw'][...]
+                name = os.path.basename(path)
+                if name in expected:
+                    assert np.array_equal(raw, expected[name])
+                expected[name] = raw
+
+
+class TestSegmentationInput:
+    @pytest.fixture
+    def segmentation_inputs(self, monkeypatch):
+        inputs = []
+
+        def process(step, pmaps):
+            inputs.append(pmaps)
+            return np.zeros(pmaps.shape, dtype='uint16')
+
+        monkeypatch.setattr(DistanceTransformWatershed, 'process', process)
+        return inputs
+
+    @staticmethod
+    def _segment(path):
+        # the segmentation step of the pipeline, run on `path` as if the CNN prediction step were disabled
+        config = yaml.full_load((TEST_FILES / 'test_config.yaml').read_text())
+        config['segmentation'].update({'state': True, 'name': 'DtWatershed', 'save_directory': 'DtWatershed'})
+        return configure_segmentation_step([path], config['segmentation'])()
+
+    def test_uint16_raw_without_cnn(self, tmpdir, segmentation_inputs):
+        # a raw stack segmented directly, with intensities far below the uint16 maximum
+        path = os.path.join(tmpdir, 'raw.h5')
+        raw = np.random.RandomState(0).randint(100, 4000, size=(8, 64, 64)).astype('uint16')
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('raw', data=raw)
+
+        self._segment(path)
+        pmaps = segmentation_inputs[0]
+        assert pmaps.dtype == np.float32
+        np.testing.assert_allclose(pmaps, normalize_01(raw.astype('float32')), atol=1e-6)
+
+    def test_compact_pmaps(self, tmpdir, segmentation_inputs):
+        # prediction maps saved by `UnetPredictions` in a compact dtype are not rescaled
+        path = os.path.join(tmpdir, 'pmaps.h5')
+        pmaps = np.random.RandomState(0).randint(100, 4000, size=(8, 64, 64)).astype('uint16')
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('predictions', data=pmaps)
+            f['predictions'].attrs[COMPACT_PMAPS_ATTR] = True
+
+        self._segment(path)
+        assert segmentation_inputs[0].dtype == np.uint16
+        np.testing.assert_array_equal(segmentation_inputs[0], pmaps)
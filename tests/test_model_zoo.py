@@ -1,8 +1,11 @@
 import os
+from pathlib import Path
+
 import torch
 import pytest
+import yaml
 
-from plantseg.training.model import UNet2D
+from plantseg.training.model import UNet2D, UNet3D
 from plantseg.models.zoo import model_zoo
 
 IN_GITHUB_ACTIONS = os.getenv("GITHUB_ACTIONS") == "true"
@@ -31,3 +34,53 @@ class TestModelZoo:
             y = model(x)
             # assert output normalized
             assert torch.all(0 <= y) and torch.all(y <= 1)
+
+
+@pytest.fixture
+def custom_model_config(tmpdir):
+    """Save a small randomly initialised 3D U-Net with its training configuration."""
+    model_config = {'name': 'UNet3D', 'in_channels': 1, 'out_channels': 1, 'f_maps': 4, 'num_levels': 2}
+    model_config.update({'num_groups': 1, 'final_sigmoid': True})
+    torch.save(UNet3D(**model_config).state_dict(), Path(tmpdir) / 'best_checkpoint.pytorch')
+    config_path = Path(tmpdir) / 'config_train.yml'
+    config_path.write_text(yaml.dump({'model': model_config}))
+    return config_path
+
+
+class TestModelCache:
+    def test_load_model_cached(self, custom_model_config):
+        model_zoo.clear_model_cache()
+        model, model_config, _ = model_zoo.load_model(config_path=custom_model_config)
+        assert not model.training and model_config['name'] == 'UNet3D'
+        assert model_zoo.load_model(config_path=custom_model_config)[0] is model
+
+        model_zoo.clear_model_cache(custom_model_config)
+        assert model_zoo.load_model(config_path=custom_model_config)[0] is not model
+        model_zoo.clear_model_cache()
+
+    def test_lru_eviction(self, custom_model_config, tmpdir, monkeypatch):
+        model_zoo.clear_model_cache()
+        other_weights = Path(tmpdir) / 'other_checkpoint.pytorch'
+        other_weights.write_bytes((Path(tmpdir) / 'best_checkpoint.pytorch').read_bytes())
+
+        model, _, _ = model_zoo.load_model(config_path=custom_model_config)
+        # the cache can only hold a single model
+        monkeypatch.setattr(model_zoo, 'model_cache_max_bytes', 1)
+        model_zoo.load_model(config_path=custom_model_config, model_weights_path=other_weights)
+        assert model_zoo.load_model(config_path=custom_model_config)[0] is not model
+        model_zoo.clear_model_cache()
+
+
+class TestCustomModelRecord:
+    def test_set_model_patch_size(self, tmpdir, monkeypatch):
+        path_zoo_custom = Path(tmpdir) / 'custom_zoo.yaml'
+        record = {'path': str(tmpdir), 'resolution': [1.0, 1.0, 1.0], 'recommended_patch_size': [80, 160, 160]}
+        monkeypatch.setattr(model_zoo, '_zoo_custom_dict', {'custom_model': record})
+        monkeypatch.setattr(model_zoo, 'path_zoo_custom', path_zoo_custom)
+        monkeypatch.setattr(model_zoo, 'models', model_zoo.models)
+
+        assert model_zoo.set_model_patch_size('custom_model', (32, 192, 192))
+        assert model_zoo.models.loc['custom_model', 'recommended_patch_size'] == (32, 192, 192)
+        assert yaml.safe_load(path_zoo_custom.read_text())['custom_model']['recommended_patch_size'] == [32, 192, 192]
+        # the records of the PlantSeg zoo are not modified
+        assert not model_zoo.set_model_patch_size('generic_confocal_3D_unet', (32, 192, 192))
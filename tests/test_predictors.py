@@ -0,0 +1,789 @@
+"""
+Tests the patch based predictors in `plantseg.predictions.functional` with small, randomly initialised networks.
+"""
+
+# pylint: disable=missing-docstring,import-outside-toplevel
+
+import itertools
+import os
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pytest
+import torch
+from scipy.ndimage import zoom
+from torch.utils.data import DataLoader
+
+from plantseg.augment import transforms
+from plantseg.augment.transforms import get_test_augmentations
+from plantseg.dataprocessing.functional.dataprocessing import (
+    from_compact_dtype,
+    image_gaussian_smoothing,
+    normalize_01,
+)
+from plantseg.predictions.functional.accumulator import PatchAccumulator, blending_window
+from plantseg.predictions.functional.affinities import embeddings_to_affinities
+from plantseg.predictions.functional.array_dataset import ArrayDataset, default_prediction_collate
+from plantseg.predictions.functional.array_predictor import ArrayPredictor, _apply_tta, _invert_tta, tta_transforms
+from plantseg.predictions.functional.compiled_model import CompiledModel, compile_model, compiled_model_path
+from plantseg.predictions.functional.ensemble_predictor import EnsemblePredictor
+from plantseg.predictions.functional.iterative_predictor import IterativePredictor
+from plantseg.predictions.functional.lazy_predictor import LazyPredictor, create_prediction_dataset
+from plantseg.predictions.functional import array_predictor
+from plantseg.predictions.functional import autotune as autotune_module
+from plantseg.predictions.functional import compiled_model as compiled_model_module
+from plantseg.predictions.functional import memory_model as memory_model_module
+from plantseg.predictions.functional import onnx_model as onnx_model_module
+from plantseg.predictions.functional import predictions as predictions_module
+from plantseg.predictions.functional.memory_model import get_memory_model, max_batch_size
+from plantseg.predictions.functional.patch_cache import PatchCache
+from plantseg.predictions.functional.rescaling import RescaledVolume, predict_rescaled
+from plantseg.predictions.functional.sharded_predictor import ShardedPredictor
+from plantseg.predictions.functional.onnx_model import OnnxModel, load_onnx_model, onnx_model_path
+from plantseg.predictions.functional.slice_loader import SliceLoader
+from plantseg.predictions.functional.slice_builder import FilterSliceBuilder, ForegroundSliceBuilder, SliceBuilder
+from plantseg.predictions.functional.time_series import TimeSeriesPredictor, time_point, time_point_key
+from plantseg.predictions.functional.utils import get_stride_shape
+from plantseg.predictions.predict import UnetPredictions
+from plantseg.training import embeddings
+from plantseg.training.model import UNet2D, UNet3D
+
+PATCH = (16, 64, 64)
+HALO = (2, 4, 4)
+
+
+@pytest.fixture
+def unet3d():
+    torch.manual_seed(0)
+    model = UNet3D(in_channels=1, out_channels=1, f_maps=4, num_levels=2, num_groups=1)
+    return model.eval()
+
+
+@pytest.fixture
+def raw():
+    return np.random.RandomState(0).rand(40, 100, 90).astype('float32')
+
+
+def _predictor(predictor_class, model, patch=PATCH, patch_halo=HALO, out_channels=1, **kwargs):
+    return predictor_class(
+        model=model,
+        in_channels=1,
+        out_channels=out_channels,
+        device='cpu',
+        patch=patch,
+        patch_halo=patch_halo,
+        single_batch_mode=True,
+        headless=False,
+        disable_tqdm=True,
+        **kwargs,
+    )
+
+
+def _dataset(raw, patch=PATCH, halo=HALO, augs=None):
+    augs = get_test_augmentations(raw) if augs is None else augs
+    slice_builder = SliceBuilder(raw, label_dataset=None, patch_shape=patch, stride_shape=get_stride_shape(patch))
+    return ArrayDataset(raw, slice_builder, augs, halo_shape=halo, verbose_logging=False)
+
+
+class TestGlobalStats:
+    def test_chunked_stats(self, monkeypatch):
+        monkeypatch.setattr(transforms, 'STATS_CHUNK_VOXELS', 1000)
+        raw = np.random.RandomState(0).randint(0, 2**16, size=(2, 20, 50, 30)).astype('uint16')
+        mean, std = transforms.global_stats(raw)
+        np.testing.assert_allclose([mean, std], [raw.astype('float64').mean(), raw.astype('float64').std()], rtol=1e-10)
+        # float64 chunks of the input are not views, the input is left unchanged
+        raw_float = raw.astype('float64')
+        transforms.global_stats(raw_float)
+        np.testing.assert_array_equal(raw_float, raw)
+
+        monkeypatch.setattr(transforms, 'STATS_SAMPLES', 5000)
+        mean, std = transforms.global_stats(raw, 'subsampled')
+        np.testing.assert_allclose([mean, std], [raw.mean(), raw.std()], rtol=0.05)
+
+    def test_robust_stats(self):
+        raw = np.random.RandomState(0).normal(100, 10, size=(40, 100, 90))
+        raw[:, :10] = 1e6  # outliers
+        mean, std = transforms.global_stats(raw, 'robust')
+        assert abs(mean - 100) < 3 and abs(std - 10) < 3
+
+    def test_stats_cache(self, tmpdir, monkeypatch):
+        path = os.path.join(tmpdir, 'raw.h5')
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('raw', data=np.random.RandomState(0).rand(20, 64, 64).astype('float32'))
+        with h5py.File(path, 'r') as f:
+            expected = transforms.global_stats(f['raw'])
+
+        def fail(raw):
+            raise AssertionError('the statistics should be cached')
+
+        monkeypatch.setattr(transforms, '_exact_mean_std', fail)
+        with h5py.File(path, 'r') as f:
+            assert transforms.global_stats(f['raw']) == expected
+
+
+class TestArrayDataset:
+    @pytest.mark.parametrize(
+        'shape, halo', [((40, 100, 90), HALO), ((2, 20, 70, 64), (2, 8, 8)), ((1, 64, 64), (0, 4, 4))]
+    )
+    def test_streaming_matches_mirror_pad(self, shape, halo, tmpdir):
+        raw = np.random.RandomState(0).rand(*shape).astype('float32')
+        memmap = np.lib.format.open_memmap(Path(tmpdir) / 'raw.npy', mode='w+', dtype=raw.dtype, shape=raw.shape)
+        memmap[...] = raw
+
+        patch = (min(shape[-3], PATCH[0]),) + PATCH[1:]
+        slice_builder = SliceBuilder(raw, label_dataset=None, patch_shape=patch, stride_shape=get_stride_shape(patch))
+        kwargs = dict(halo_shape=halo, multichannel=raw.ndim == 4, verbose_logging=False)
+        padded = ArrayDataset(raw, slice_builder, lambda x: x, streaming=False, **kwargs)
+        streamed = ArrayDataset(memmap, slice_builder, lambda x: x, streaming=True, **kwargs)
+
+        assert padded.raw_padded is not None and streamed.raw_padded is None
+        for i in range(len(padded)):
+            expected, expected_idx = padded[i]
+            patch_, idx = streamed[i]
+            assert idx == expected_idx
+            np.testing.assert_array_equal(patch_, expected)
+
+
+class TestSliceBuilder:
+    def test_patch_index(self):
+        raw = np.zeros((2, 40, 100, 90), dtype='float32')
+        raw_slices = SliceBuilder(raw, None, PATCH, (8, 32, 32)).raw_slices
+        origins = itertools.product(range(0, 25, 8), [0, 32, 36], [0, 26])
+        expected = [(slice(0, 2),) + tuple(slice(o, o + k) for o, k in zip(origin, PATCH)) for origin in origins]
+        assert len(raw_slices) == len(expected) and list(raw_slices) == expected
+        assert raw_slices[-1] == expected[-1] and list(raw_slices[2:5]) == expected[2:5]
+        assert expected[7] in raw_slices and expected[7][1:] not in raw_slices
+
+    def test_filter_matches_predicate(self):
+        rs = np.random.RandomState(0)
+        label = rs.randint(0, 4, size=(40, 100, 90)) * (rs.rand(40, 100, 90) > 0.7)
+        all_slices = SliceBuilder(label, label, PATCH, (8, 32, 32)).label_slices
+        slice_builder = FilterSliceBuilder(
+            label, label, PATCH, (8, 32, 32), ignore_index=(0, 2), threshold=0.15, slack_acceptance=0.3
+        )
+
+        # the previous per-patch predicate, drawing the random acceptance of the rejected patches in order
+        rand_state = np.random.RandomState(47)
+
+        def ignore_predicate(label_idx):
+            patch = np.copy(label[label_idx])
+            patch[patch == 2] = 0
+            return np.count_nonzero(patch) / patch.size > 0.15 or rand_state.rand() < 0.3
+
+        expected = [label_idx for label_idx in all_slices if ignore_predicate(label_idx)]
+        assert 0 < len(expected) < len(all_slices)
+        assert list(slice_builder.label_slices) == expected and list(slice_builder.raw_slices) == expected
+
+
+class TestForegroundSliceBuilder:
+    def test_skip_background(self, unet3d):
+        raw = np.random.RandomState(0).rand(40, 128, 128).astype('float32') * 0.1
+        raw[4:12, 70:100, 80:110] += 1  # foreground only in a corner of the volume
+        stride = get_stride_shape(PATCH)
+        all_slices = SliceBuilder(raw, None, PATCH, stride).raw_slices
+        slice_builder = ForegroundSliceBuilder(raw, None, PATCH, stride)
+        assert 0 < len(slice_builder.raw_slices) < len(all_slices)
+        assert slice_builder.skipped_fraction == 1 - len(slice_builder.raw_slices) / len(all_slices)
+
+        augs = get_test_augmentations(raw)
+        expected = _predictor(ArrayPredictor, unet3d)(_dataset(raw, augs=augs))
+        dataset = ArrayDataset(raw, slice_builder, augs, halo_shape=HALO, verbose_logging=False)
+        result = _predictor(ArrayPredictor, unet3d, fill_value=-1)(dataset)
+
+        kept = np.zeros(raw.shape, dtype=bool)
+        for index in slice_builder.raw_slices:
+            kept[index] = True
+        skipped = np.zeros(raw.shape, dtype=bool)
+        for index in all_slices:
+            if index not in slice_builder.raw_slices:
+                skipped[index] = True
+        assert kept[4:12, 70:100, 80:110].all()
+        np.testing.assert_array_equal(result[0][~kept], -1)
+        # voxels covered only by kept patches have the same prediction as without skipping
+        np.testing.assert_allclose(result[0][kept & ~skipped], expected[0][kept & ~skipped], rtol=1e-5, atol=1e-6)
+
+    def test_foreground_mask(self, raw):
+        mask = np.zeros(raw.shape, dtype=bool)
+        mask[30, 90, 5] = True
+        slice_builder = ForegroundSliceBuilder(raw, None, PATCH, get_stride_shape(PATCH), foreground_mask=mask)
+        assert len(slice_builder.raw_slices) > 0
+        assert all(mask[index].any() for index in slice_builder.raw_slices)
+        with pytest.raises(AssertionError):
+            ForegroundSliceBuilder(raw, None, PATCH, get_stride_shape(PATCH), foreground_mask=mask[:-1])
+
+    @pytest.mark.parametrize('mask_shape', [(20, 50, 45), (13, 33, 31)])
+    def test_subsampled_mask(self, raw, mask_shape):
+        mask = np.zeros(mask_shape, dtype=bool)
+        mask[-1, -1, 0] = mask[5, 10, 12] = True
+        downsampling = [s / m for s, m in zip(raw.shape, mask_shape)]
+        stride = get_stride_shape(PATCH)
+        slice_builder = ForegroundSliceBuilder(
+            raw, None, PATCH, stride, foreground_mask=mask, downsampling=downsampling
+        )
+
+        # the same patches as with the mask upsampled to the raw shape by nearest neighbour
+        upsampled = mask[np.ix_(*[np.arange(s) * m // s for s, m in zip(raw.shape, mask_shape)])]
+        expected = ForegroundSliceBuilder(raw, None, PATCH, stride, foreground_mask=upsampled)
+        assert 0 < len(expected.raw_slices) < len(SliceBuilder(raw, None, PATCH, stride).raw_slices)
+        assert list(slice_builder.raw_slices) == list(expected.raw_slices)
+
+
+class TestPatchAccumulator:
+    def test_average_blending_many_overlaps(self):
+        # stride 1: up to 4 * 4 * 32 = 512 patches overlap, more than a uint8 visit counter can count
+        shape, patch = (2, 8, 8, 64), (4, 4, 32)
+        starts = itertools.product(*(range(s - p + 1) for s, p in zip(shape[1:], patch)))
+        indices = [tuple(slice(start, start + p) for start, p in zip(origin, patch)) for origin in starts]
+        predictions = torch.from_numpy(np.random.RandomState(0).rand(len(indices), 2, *patch).astype('float32'))
+
+        expected = np.zeros(shape, dtype='float64')
+        counts = np.zeros(shape, dtype='float64')
+        for prediction, index in zip(predictions.numpy(), indices):
+            expected[(slice(None),) + index] += prediction
+            counts[(slice(None),) + index] += 1
+
+        result = np.zeros(shape, dtype='float32')
+        accumulator = PatchAccumulator(result, 'cpu', blending='average')
+        for i in range(0, len(indices), 7):
+            accumulator.add(predictions[i : i + 7], indices[i : i + 7])
+        accumulator.close()
+        np.testing.assert_allclose(result, expected / counts, rtol=1e-5)
+
+    def test_unordered_patches(self):
+        accumulator = PatchAccumulator(np.zeros((1, 40, 64, 64), dtype='float32'), 'cpu')
+        accumulator.add(torch.ones(1, 1, 16, 64, 64), [(slice(16, 32), slice(0, 64), slice(0, 64))])
+        with pytest.raises(RuntimeError):
+            accumulator.add(torch.ones(1, 1, 16, 64, 64), [(slice(0, 16), slice(0, 64), slice(0, 64))])
+
+    def test_gaussian_window(self):
+        window = blending_window(PATCH, 'gaussian')
+        assert window.shape == PATCH
+        assert window.max() == 1 and window.min() > 0
+        # the patch center is weighted more than the patch borders
+        assert window[PATCH[0] // 2, PATCH[1] // 2, PATCH[2] // 2] > window[0, PATCH[1] // 2, PATCH[2] // 2]
+        assert torch.all(blending_window(PATCH, 'average') == 1)
+
+
+class TestEmbeddingsToAffinities:
+    def test_matches_training_affinities(self):
+        # the differentiable reference, stacking replication-padded shifted copies of the embeddings
+        x = torch.randn(2, 4, 9, 17, 15)
+        offsets = [[-1, 0, 0], [0, -3, 0], [0, 0, -1], [2, -1, 4]]
+        expected = embeddings.embeddings_to_affinities(x, offsets, delta=0.75)
+        affs = embeddings_to_affinities(x.requires_grad_(), offsets, delta=0.75)
+        assert affs.shape == (2, 4, 9, 17, 15) and not affs.requires_grad
+        assert torch.allclose(affs, expected, atol=1e-6)
+
+
+class TestTestTimeAugmentation:
+    @pytest.mark.parametrize('square', [True, False])
+    def test_inverse_transforms(self, square):
+        x = torch.rand(2, 1, 4, 6, 6 if square else 8)
+        transforms = tta_transforms(square)
+        assert len(transforms) == (8 if square else 4)
+        for k, flip in transforms:
+            assert _apply_tta(x, k, flip).shape == x.shape
+            assert torch.equal(_invert_tta(_apply_tta(x, k, flip), k, flip), x)
+
+    def test_tta_equivariant_model(self, raw):
+        # a pointwise model is equivariant to flips and rotations: the augmentation does not change the predictions
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Conv3d(1, 1, kernel_size=1), torch.nn.Sigmoid())
+        expected = _predictor(ArrayPredictor, model)(_dataset(raw))
+        result = _predictor(ArrayPredictor, model, tta=True)(_dataset(raw))
+        np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6)
+
+
+class TestPrecision:
+    @pytest.mark.parametrize('precision', ['bfloat16', 'float16'])
+    def test_reduced_precision(self, unet3d, raw, precision):
+        expected = _predictor(ArrayPredictor, unet3d)(_dataset(raw))
+        predictor = _predictor(ArrayPredictor, unet3d, precision=precision)
+        result = predictor(_dataset(raw))
+        assert predictor.precision == precision
+        np.testing.assert_allclose(result, expected, atol=0.1)
+        # the model, possibly shared with other predictors, keeps its layout
+        assert all(p.is_contiguous() for p in unet3d.parameters())
+
+    def test_accuracy_guard(self, unet3d, raw, monkeypatch):
+        monkeypatch.setattr(array_predictor, 'PRECISION_TOLERANCE', -1.0)
+        expected = _predictor(ArrayPredictor, unet3d)(_dataset(raw))
+        predictor = _predictor(ArrayPredictor, unet3d, precision='bfloat16')
+        result = predictor(_dataset(raw))
+        # the calibration patch fails the tolerance and the predictor falls back to float32
+        assert predictor.precision == 'float32'
+        np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6)
+
+
+class TestOutputDtype:
+    @pytest.mark.parametrize('output_dtype, atol', [('float16', 1e-3), ('uint16', 1 / 65535), ('uint8', 1 / 255)])
+    def test_compact_output(self, unet3d, raw, output_dtype, atol):
+        expected = _predictor(ArrayPredictor, unet3d)(_dataset(raw))
+        result = _predictor(ArrayPredictor, unet3d, output_dtype=output_dtype)(_dataset(raw))
+        # the patches are blended in float32, only the final maps are rounded to the compact dtype
+        assert result.dtype == np.dtype(output_dtype)
+        np.testing.assert_allclose(from_compact_dtype(result), expected, atol=atol)
+
+    def test_unsupported_output_dtype(self, unet3d):
+        with pytest.raises(ValueError):
+            _predictor(ArrayPredictor, unet3d, output_dtype='int32')
+
+
+class TestCompiledModel:
+    def test_compiled_model_cache(self, unet3d, raw, tmpdir, monkeypatch):
+        model_path = Path(tmpdir) / 'best_checkpoint.pytorch'
+        torch.save(unet3d.state_dict(), model_path)
+        input_shape = tuple(p + 2 * h for p, h in zip(PATCH, HALO))
+
+        compiled = compile_model(unet3d, model_path, 1, input_shape, 'cpu')
+        assert isinstance(compiled, CompiledModel)
+        assert compiled_model_path(model_path, input_shape, 'float32', 'cpu').exists()
+        expected = _predictor(ArrayPredictor, unet3d)(_dataset(raw))
+        result = _predictor(ArrayPredictor, compiled)(_dataset(raw))
+        np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6)
+
+        # a new process loads the saved trace instead of tracing again
+        monkeypatch.setattr(compiled_model_module, '_compiled_models', {})
+        monkeypatch.setattr(compiled_model_module, '_trace', None)
+        assert isinstance(compile_model(unet3d, model_path, 1, input_shape, 'cpu'), CompiledModel)
+
+    def test_eager_fallback(self, tmpdir):
+        model = UNet2D(in_channels=1, out_channels=1, f_maps=4, num_levels=2, num_groups=1).eval()
+        # the input shape does not match the number of input channels, tracing fails
+        compiled = compile_model(model, Path(tmpdir) / 'best_checkpoint.pytorch', 2, (64, 64), 'cpu')
+        assert compiled is model
+
+
+class TestOnnxBackend:
+    @pytest.mark.parametrize('model_class, patch', [(UNet3D, PATCH), (UNet2D, (1, 64, 64))])
+    def test_onnx_parity(self, model_class, patch, raw, tmpdir):
+        pytest.importorskip('onnxruntime')
+        torch.manual_seed(0)
+        model = model_class(in_channels=1, out_channels=1, f_maps=4, num_levels=2, num_groups=1).eval()
+        model_path = Path(tmpdir) / 'best_checkpoint.pytorch'
+        torch.save(model.state_dict(), model_path)
+        halo = HALO if model_class is UNet3D else (0,) + HALO[1:]
+        input_shape = tuple(p + 2 * h for p, h in zip(patch, halo))[-3 if model_class is UNet3D else -2 :]
+
+        onnx_model = load_onnx_model(model, model_path, 1, input_shape)
+        assert isinstance(onnx_model, OnnxModel)
+        assert onnx_model_path(model_path, input_shape).exists()
+
+        kwargs = dict(patch=patch, patch_halo=halo)
+        raw = raw[:1] if model_class is UNet2D else raw
+        expected = _predictor(ArrayPredictor, model, **kwargs)(_dataset(raw, patch, halo))
+        result = _predictor(ArrayPredictor, onnx_model, **kwargs)(_dataset(raw, patch, halo))
+        np.testing.assert_allclose(result, expected, atol=1e-4)
+
+    def test_missing_onnxruntime(self, unet3d, tmpdir, monkeypatch):
+        monkeypatch.setattr(onnx_model_module, 'onnxruntime_installed', False)
+        with pytest.raises(ValueError, match='onnxruntime'):
+            load_onnx_model(unet3d, Path(tmpdir) / 'best_checkpoint.pytorch', 1, (48, 48, 48))
+
+    def test_export_failure(self, tmpdir):
+        pytest.importorskip('onnxruntime')
+        model = UNet2D(in_channels=1, out_channels=1, f_maps=4, num_levels=2, num_groups=1).eval()
+        # the input shape does not match the number of input channels, the export fails
+        with pytest.raises(RuntimeError, match='torch` backend'):
+            load_onnx_model(model, Path(tmpdir) / 'best_checkpoint.pytorch', 2, (64, 64))
+
+    def test_gpu_device(self, raw):
+        with pytest.raises(ValueError, match='CPU'):
+            UnetPredictions([], 'model', device='cuda', backend='onnxruntime')
+        with pytest.raises(ValueError, match='CPU'):
+            predictions_module.unet_predictions(raw, 'model', None, device='cuda', backend='onnxruntime')
+
+
+class TestEnsemblePredictor:
+    def test_ensemble_matches_single_predictors(self, unet3d, raw):
+        torch.manual_seed(1)
+        other = UNet3D(in_channels=1, out_channels=2, f_maps=4, num_levels=2, num_groups=1).eval()
+        predictors = [_predictor(ArrayPredictor, unet3d), _predictor(ArrayPredictor, other, out_channels=2)]
+
+        results = EnsemblePredictor(predictors, disable_tqdm=True)(_dataset(raw))
+        assert len(results) == 2
+        for predictor, result in zip(predictors, results):
+            expected = predictor(_dataset(raw))
+            assert result.shape == expected.shape
+            np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6)
+
+    def test_different_halos(self, unet3d):
+        predictors = [_predictor(ArrayPredictor, unet3d), _predictor(ArrayPredictor, unet3d, patch_halo=(0, 4, 4))]
+        with pytest.raises(ValueError):
+            EnsemblePredictor(predictors)
+
+    def test_skip_failed(self, unet3d, raw):
+        # the number of input channels does not match the dataset, every forward pass fails
+        broken = UNet3D(in_channels=2, out_channels=1, f_maps=4, num_levels=2, num_groups=1).eval()
+        predictors = [_predictor(ArrayPredictor, broken), _predictor(ArrayPredictor, unet3d)]
+        with pytest.raises(RuntimeError):
+            EnsemblePredictor(predictors, disable_tqdm=True)(_dataset(raw))
+
+        ensemble = EnsemblePredictor(predictors, disable_tqdm=True, skip_failed=True)
+        results = ensemble(_dataset(raw))
+        assert list(ensemble.failed) == [0] and results[0] is None
+        np.testing.assert_allclose(results[1], predictors[1](_dataset(raw)), rtol=1e-5, atol=1e-6)
+
+    def test_ensemble_predictions(self, unet3d, raw, monkeypatch):
+        torch.manual_seed(1)
+        models = {
+            'model': unet3d,
+            'other': UNet3D(in_channels=1, out_channels=1, f_maps=4, num_levels=2, num_groups=1).eval(),
+            'broken': UNet3D(in_channels=2, out_channels=1, f_maps=4, num_levels=2, num_groups=1).eval(),
+        }
+        # the models have different halos, with group normalization their predictions depend on the halo
+        halos = {'model': list(HALO), 'other': [4, 8, 8], 'broken': list(HALO)}
+        model_config = {'in_channels': 1, 'out_channels': 1, 'name': 'UNet3D'}
+        monkeypatch.setattr(
+            predictions_module.model_zoo, 'load_model', lambda model_name, **_: (models[model_name], model_config, None)
+        )
+        monkeypatch.setattr(predictions_module, 'get_patch_halo', lambda model_name: halos[model_name])
+
+        kwargs = dict(patch=PATCH, device='cpu', disable_tqdm=True)
+        results = predictions_module.unet_ensemble_predictions(raw, list(models), skip_failed_models=True, **kwargs)
+        # the broken model does not hide the model predicted in the same pass
+        assert set(results) == {'model', 'other'}
+        for model_name, result in results.items():
+            expected = predictions_module.unet_predictions(raw, model_name, None, **kwargs)
+            np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6)
+
+
+class TestCascadePredictions:
+    def test_cascade_skips_background(self, monkeypatch):
+        # a voxel-wise model, boundary probability close to 0 in the background and to 1 in the bright tissue
+        model = torch.nn.Sequential(torch.nn.Conv3d(1, 1, 1), torch.nn.Sigmoid()).eval()
+        torch.nn.init.constant_(model[0].weight, 4)
+        torch.nn.init.constant_(model[0].bias, -4)
+        model_config = {'in_channels': 1, 'out_channels': 1, 'name': 'UNet3D'}
+        monkeypatch.setattr(predictions_module.model_zoo, 'load_model', lambda **kwargs: (model, model_config, None))
+        monkeypatch.setattr(predictions_module, 'get_patch_halo', lambda model_name: list(HALO))
+
+        raw = np.random.RandomState(0).rand(32, 160, 160).astype('float32') * 0.1
+        raw[4:12, 20:50, 100:140] += 1
+        kwargs = dict(patch=PATCH, device='cpu', disable_tqdm=True)
+        expected = predictions_module.unet_predictions(raw, 'model', None, **kwargs)
+        result = predictions_module.unet_cascade_predictions(raw, 'model', **kwargs)
+
+        assert result.shape == expected.shape
+        np.testing.assert_allclose(result[4:12, 20:50, 100:140], expected[4:12, 20:50, 100:140], rtol=1e-5)
+        # the background far from the tissue is not predicted
+        assert np.all(result[-8:, -32:, :32] == 0) and np.all(expected[-8:, -32:, :32] > 0)
+        np.testing.assert_allclose(result, expected, atol=0.1)
+
+
+class TestHaloTiling:
+    def _predictions(self, model, monkeypatch, **kwargs):
+        model_config = {'in_channels': 1, 'out_channels': 1, 'name': 'UNet3D'}
+        monkeypatch.setattr(predictions_module.model_zoo, 'load_model', lambda **_: (model, model_config, None))
+        monkeypatch.setattr(predictions_module, 'get_patch_halo', lambda model_name: list(HALO))
+        raw = np.random.RandomState(0).rand(40, 128, 128).astype('float32')
+        return predictions_module.unet_predictions(raw, 'model', None, patch=PATCH, device='cpu', **kwargs)
+
+    def test_halo_tiling_matches_overlap(self, unet3d, monkeypatch):
+        halo = predictions_module.model_zoo.compute_3D_halo_for_pytorch3dunet(unet3d)
+        expected = self._predictions(unet3d, monkeypatch, disable_tqdm=True, patch_halo=halo)
+        result = self._predictions(unet3d, monkeypatch, disable_tqdm=True, tiling='halo')
+        np.testing.assert_allclose(result, expected, atol=predictions_module.TILING_TOLERANCE)
+
+    def test_fallback_to_overlap(self, unet3d, monkeypatch):
+        monkeypatch.setattr(predictions_module, 'TILING_TOLERANCE', 0)
+        expected = self._predictions(unet3d, monkeypatch, disable_tqdm=True)
+        result = self._predictions(unet3d, monkeypatch, disable_tqdm=True, tiling='halo')
+        np.testing.assert_array_equal(result, expected)
+
+
+class TestPatchCache:
+    def test_cached_predictions(self, unet3d, raw, tmpdir):
+        expected = _predictor(ArrayPredictor, unet3d)(_dataset(raw))
+        cache = PatchCache(Path(tmpdir) / 'cache')
+        result = _predictor(ArrayPredictor, unet3d, patch_cache=cache)(_dataset(raw))
+        np.testing.assert_array_equal(result, expected)
+        num_patches = len(_dataset(raw))
+        assert (cache.hits, cache.misses) == (0, num_patches)
+
+        # a second run loads all the patches, a different model none
+        result = _predictor(ArrayPredictor, unet3d, patch_cache=cache)(_dataset(raw))
+        np.testing.assert_array_equal(result, expected)
+        assert cache.hits == num_patches
+        torch.manual_seed(1)
+        other = UNet3D(in_channels=1, out_channels=1, f_maps=4, num_levels=2, num_groups=1).eval()
+        _predictor(ArrayPredictor, other, patch_cache=cache)(_dataset(raw))
+        assert (cache.hits, cache.misses) == (num_patches, 2 * num_patches)
+
+    def test_lru_eviction(self, tmpdir):
+        prediction = np.zeros((1, 16, 16, 16), dtype='float32')
+        patch_bytes = prediction.nbytes + 128  # with the npy header
+        cache = PatchCache(Path(tmpdir) / 'cache', max_bytes=int(3.5 * patch_bytes))
+        keys = [cache.key('model', torch.full((4,), float(i))) for i in range(4)]
+        for i, key in enumerate(keys[:3]):
+            cache.put(key, prediction + i)
+            os.utime(cache._file(key), (i, i))
+        assert cache.get(keys[0]) is not None  # the first patch is now the most recently used
+
+        cache.put(keys[3], prediction + 3)
+        assert cache.get(keys[1]) is None
+        assert all(cache.get(key) is not None for key in (keys[0], keys[2], keys[3]))
+        assert cache.hit_rate() == 4 / 5
+
+
+class TestAutotune:
+    def test_autotune(self, unet3d, raw, monkeypatch):
+        model_config = {'in_channels': 1, 'out_channels': 1, 'name': 'UNet3D'}
+        monkeypatch.setattr(autotune_module.model_zoo, 'load_model', lambda **_: (unet3d, model_config, None))
+        memory_model = {'fixed_bytes': 0, 'per_sample_bytes': 1000}
+        monkeypatch.setattr(autotune_module, 'get_memory_model', lambda *args: memory_model)
+
+        patch_shapes = [(32, 64, 64), (40, 96, 90)]
+        results = autotune_module.autotune(
+            raw, 'model', device='cpu', patch_shapes=patch_shapes, memory_cap=2500, patch_halo=HALO, repeats=1
+        )
+
+        throughputs = [result['voxels_per_second'] for result in results]
+        assert throughputs == sorted(throughputs, reverse=True)
+        assert {result['patch'] for result in results} == set(patch_shapes)
+        # batches are limited by the memory cap
+        assert {result['batch_size'] for result in results} <= {1, 2}
+        # the overlap of the 0.75 stride is too small for (32, 64, 64) patches
+        assert {result['stride_ratio'] for result in results if result['patch'] == (32, 64, 64)} == {0.5, 0.625}
+
+    def test_center_crop(self, unet3d, tmpdir, monkeypatch):
+        model_config = {'in_channels': 1, 'out_channels': 1, 'name': 'UNet3D'}
+        monkeypatch.setattr(autotune_module.model_zoo, 'load_model', lambda **_: (unet3d, model_config, None))
+        monkeypatch.setattr(
+            autotune_module, 'get_memory_model', lambda *args: {'fixed_bytes': 0, 'per_sample_bytes': 0}
+        )
+        samples = []
+        read_padded_patch = autotune_module.read_padded_patch
+        monkeypatch.setattr(
+            autotune_module,
+            'read_padded_patch',
+            lambda raw, *args: samples.append(raw) or read_padded_patch(raw, *args),
+        )
+
+        raw = np.random.RandomState(0).rand(64, 256, 256).astype('float32')
+        with h5py.File(Path(tmpdir) / 'raw.h5', 'w') as f:
+            f.create_dataset('raw', data=raw)
+            autotune_module.autotune(
+                f['raw'], 'model', device='cpu', patch_shapes=[(32, 64, 64)], memory_cap=0, patch_halo=HALO, repeats=1
+            )
+        # only the center crop of the patch with its halo is read from the file
+        np.testing.assert_array_equal(samples[0], raw[14:50, 92:164, 92:164])
+
+
+class TestShardedPredictor:
+    def test_sharded_matches_array_predictor(self, unet3d, raw):
+        dataset = _dataset(raw)
+        expected = _predictor(ArrayPredictor, unet3d)(dataset)
+
+        # the workers use as many threads as this process, the forward passes then give the same results
+        predictor = _predictor(ShardedPredictor, unet3d, num_workers=2, threads_per_worker=torch.get_num_threads())
+        shards = predictor.shards(dataset)
+        assert [shard['z_start'] for shard in shards[1:]] == [shard['z_stop'] for shard in shards[:-1]]
+        assert shards[0]['z_start'] == 0 and shards[-1]['z_stop'] == raw.shape[0]
+
+        np.testing.assert_array_equal(predictor(dataset), expected)
+
+
+class TestIterativePredictor:
+    def test_matches_sequential_iterations(self, unet3d, raw):
+        predictor = _predictor(ArrayPredictor, unet3d)
+        expected = predictor(_dataset(raw))
+        for _ in range(2):
+            smoothed = image_gaussian_smoothing(expected[0], sigma=1.5)
+            expected = predictor(_dataset(smoothed))
+
+        result = IterativePredictor(predictor, num_iterations=3, sigma=1.5)(_dataset(raw))
+        np.testing.assert_allclose(result, expected, atol=1e-6)
+
+    def test_streaming_matches_per_patch_standardization(self, unet3d, raw):
+        predictor = _predictor(ArrayPredictor, unet3d)
+        expected = predictor(_dataset(raw))
+        for _ in range(2):
+            smoothed = image_gaussian_smoothing(expected[0], sigma=1.5)
+            expected = predictor(_dataset(smoothed, augs=get_test_augmentations(None)))
+
+        result = IterativePredictor(predictor, num_iterations=3, sigma=1.5, streaming=True)(_dataset(raw))
+        np.testing.assert_allclose(result, expected, atol=1e-6)
+
+
+class TestSliceLoader:
+    @pytest.mark.parametrize('global_normalization', [True, False])
+    def test_matches_data_loader(self, raw, global_normalization):
+        augs = None if global_normalization else get_test_augmentations(None)
+        dataset = _dataset(raw, patch=(1, 64, 64), halo=(0, 8, 8), augs=augs)
+        loader = DataLoader(dataset, batch_size=5, collate_fn=default_prediction_collate)
+
+        slice_loader = SliceLoader(dataset, batch_size=5)
+        assert len(slice_loader) == len(loader)
+        for (expected, expected_indices), (batch, indices) in zip(loader, slice_loader):
+            assert list(indices) == list(expected_indices)
+            torch.testing.assert_close(batch, expected)
+
+    def test_2d_predictions(self, raw):
+        torch.manual_seed(0)
+        model = UNet2D(in_channels=1, out_channels=1, f_maps=4, num_levels=2, num_groups=1).eval()
+        dataset = _dataset(raw[:6], patch=(1, 64, 64), halo=(0, 8, 8))
+        predictor = _predictor(ArrayPredictor, model, patch=(1, 64, 64), patch_halo=(0, 8, 8))
+        assert isinstance(predictor.data_loader(dataset), SliceLoader)
+
+        expected = np.zeros((1,) + dataset.raw.shape, dtype='float32')
+        accumulator = PatchAccumulator(expected, 'cpu')
+        with torch.no_grad():
+            for input_, indices in DataLoader(dataset, batch_size=1, collate_fn=default_prediction_collate):
+                accumulator.add(predictor.predict_batch(input_), indices)
+        accumulator.close()
+        np.testing.assert_allclose(predictor(dataset), expected, rtol=1e-5, atol=1e-6)
+
+
+class TestTimeSeries:
+    def test_matches_time_points(self, unet3d):
+        raw = np.random.RandomState(0).rand(3, 24, 100, 90).astype('float32')
+        predictor = _predictor(ArrayPredictor, unet3d)
+        expected = [predictor(_dataset(raw[t])) for t in range(raw.shape[0])]
+
+        # batches mixing the patches of consecutive time points
+        predictor.batch_size = 5
+        datasets = [_dataset(raw[t]) for t in range(raw.shape[0])]
+        assert len(datasets[0]) % predictor.batch_size != 0
+        sinks = [np.zeros_like(pmaps) for pmaps in expected]
+        TimeSeriesPredictor(predictor)(datasets, sinks)
+        for result, pmaps in zip(sinks, expected):
+            np.testing.assert_allclose(result, pmaps, atol=1e-6)
+
+    def test_lazy_time_series(self, unet3d, tmpdir, monkeypatch):
+        model_config = {'in_channels': 1, 'out_channels': 1, 'name': 'UNet3D'}
+        monkeypatch.setattr(predictions_module.model_zoo, 'load_model', lambda **_: (unet3d, model_config, None))
+        monkeypatch.setattr(predictions_module, 'get_patch_halo', lambda model_name: list(HALO))
+        raw = np.random.RandomState(0).rand(2, 24, 100, 90).astype('float32')
+        kwargs = dict(patch=PATCH, device='cpu', disable_tqdm=True)
+        expected = predictions_module.unet_predictions(raw, 'model', None, time_series=True, **kwargs)
+        assert expected.shape == raw.shape
+
+        path, output_path = Path(tmpdir) / 'series.h5', Path(tmpdir) / 'predictions.h5'
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('raw', data=raw, chunks=(1, 8, 32, 32))
+        with h5py.File(path, 'r') as f:
+            assert time_point(f['raw'], 1)[2:4, ..., :5].shape == (2, 100, 5)
+            kwargs.update(predictor='LazyPredictor', output_path=output_path)
+            predictions_module.unet_predictions(f['raw'], 'model', None, time_series=True, **kwargs)
+        with h5py.File(output_path, 'r') as f:
+            for t in range(raw.shape[0]):
+                single = predictions_module.unet_predictions(
+                    raw[t], 'model', None, patch=PATCH, device='cpu', disable_tqdm=True
+                )
+                np.testing.assert_allclose(f[time_point_key('predictions', t)][0], single, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(expected[t], single, rtol=1e-5, atol=1e-6)
+
+
+class TestRescaling:
+    @pytest.mark.parametrize('factor', [(2.0, 0.5, 0.7), (0.5, 1.3, 1.0)])
+    def test_rescaled_volume(self, factor):
+        raw = np.random.RandomState(0).rand(13, 40, 37).astype('float32')
+        volume = RescaledVolume(raw, factor)
+        # 'nearest' clamps the last coordinates, which can exceed the volume by rounding errors
+        expected = zoom(raw, factor, order=1, mode='nearest')
+        assert volume.shape == expected.shape
+        np.testing.assert_allclose(volume[...], expected, atol=1e-6)
+        np.testing.assert_allclose(volume[2:5, ::3, -1], expected[2:5, ::3, -1], atol=1e-6)
+
+    def test_rescaled_predictions(self, unet3d, raw):
+        factor = (1.2, 1.5, 0.8)
+        predictor = _predictor(ArrayPredictor, unet3d)
+        # the patches are normalized with the statistics of the original volume
+        augs = get_test_augmentations(raw)
+        rescaled = zoom(raw, factor, order=1, mode='nearest')
+        expected = predictor(_dataset(rescaled, augs=augs))[0]
+        expected = zoom(expected, np.array(raw.shape) / np.array(rescaled.shape), order=1, mode='nearest')
+
+        pmaps = np.zeros((1,) + raw.shape, dtype='float32')
+        predict_rescaled(predictor, _dataset(RescaledVolume(raw, factor), augs=augs), pmaps)
+        np.testing.assert_allclose(pmaps[0], expected, atol=1e-5)
+
+    def test_skip_background(self, unet3d, monkeypatch):
+        model_config = {'in_channels': 1, 'out_channels': 1, 'name': 'UNet3D'}
+        monkeypatch.setattr(predictions_module.model_zoo, 'load_model', lambda **_: (unet3d, model_config, None))
+        monkeypatch.setattr(predictions_module, 'get_patch_halo', lambda model_name: list(HALO))
+        reads = []
+
+        class RecordedRaw:
+            # the regions of the original volume read by the `RescaledVolume`
+            def __init__(self, raw):
+                self.raw, self.shape, self.ndim, self.dtype = raw, raw.shape, raw.ndim, raw.dtype
+
+            def __getitem__(self, index):
+                reads.append(self.raw[index])
+                return reads[-1]
+
+        class RecordedVolume(RescaledVolume):
+            def __init__(self, raw, factor):
+                super().__init__(RecordedRaw(raw), factor)
+
+        monkeypatch.setattr(predictions_module, 'RescaledVolume', RecordedVolume)
+
+        raw = np.random.RandomState(0).rand(32, 96, 96).astype('float32') * 0.1
+        raw[4:12, 10:40, 50:80] += 1
+        kwargs = dict(patch=PATCH, device='cpu', disable_tqdm=True, rescale_factor=(1.25, 1.5, 1.5))
+        expected = predictions_module.unet_predictions(raw, 'model', None, **kwargs)
+        reads.clear()
+        result = predictions_module.unet_predictions(raw, 'model', None, skip_background=True, **kwargs)
+
+        # the foreground is found on the original volume, only the patches are resampled
+        assert max(read.size for read in reads) < raw.size / 4
+        np.testing.assert_allclose(result[4:12, 10:40, 50:80], expected[4:12, 10:40, 50:80], rtol=1e-5)
+        assert np.all(result[-8:, -24:, :24] == 0) and np.all(expected[-8:, -24:, :24] > 0)
+
+
+class TestLazyPredictor:
+    def test_lazy_matches_array_predictor(self, unet3d, raw, tmpdir):
+        expected = _predictor(ArrayPredictor, unet3d)(_dataset(raw))
+
+        path = Path(tmpdir) / 'lazy.h5'
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('raw', data=raw, chunks=(8, 32, 32))
+        with h5py.File(path, 'a') as f:
+            # the on-disk raw is read patch by patch, without the whole-volume mirror padding
+            dataset = _dataset(f['raw'])
+            assert dataset.raw_padded is None
+            pmaps = create_prediction_dataset(f, 'predictions', expected.shape, PATCH)
+            _predictor(LazyPredictor, unet3d)(dataset, pmaps)
+            result = pmaps[...]
+
+        assert result.shape == expected.shape
+        np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6)
+
+    def test_wrong_output_shape(self, unet3d, raw):
+        output = np.zeros((1,) + raw.shape[:-1] + (1,), dtype='float32')
+        with pytest.raises(ValueError):
+            _predictor(LazyPredictor, unet3d)(_dataset(raw), output)
+
+    def test_normalize_01_lazy(self, tmpdir):
+        pmaps = np.random.RandomState(0).rand(2, 21, 32, 32).astype('float32') * 5 + 1
+        with h5py.File(Path(tmpdir) / 'pmaps.h5', 'w') as f:
+            dataset = create_prediction_dataset(f, 'predictions', pmaps.shape, (8, 32, 32))
+            dataset[...] = pmaps
+            UnetPredictions._normalize_01_lazy(dataset)
+            np.testing.assert_allclose(dataset[...], normalize_01(pmaps), atol=1e-6)
+
+
+class TestMemoryModel:
+    def test_memory_model_cache(self, unet3d, tmpdir, monkeypatch):
+        path = Path(tmpdir) / 'memory_models.yaml'
+        memory_model = get_memory_model(unet3d, 1, (20, 72, 72), 'cpu', path=path)
+        assert memory_model['per_sample_bytes'] > 0 and path.exists()
+
+        # the cached memory model is reused without running the model
+        measured = []
+        monkeypatch.setattr(memory_model_module, 'measure_memory_model', lambda *args: measured.append(args))
+        assert get_memory_model(unet3d, 1, (20, 72, 72), 'cpu', path=path) == memory_model
+        assert not measured
+        get_memory_model(unet3d, 1, (20, 136, 136), 'cpu', path=path)
+        assert len(measured) == 1
+
+    def test_max_batch_size(self):
+        memory_model = {'fixed_bytes': 100, 'per_sample_bytes': 10}
+        assert max_batch_size(memory_model, 100 + 10 * 5) == 4
+        assert max_batch_size(memory_model, 105) == 0
+        assert max_batch_size(memory_model, 10**6) == 128
+        assert max_batch_size(memory_model, None) == 1
+        assert max_batch_size(None, 10**6) == 0